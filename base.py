@@ -1,29 +1,196 @@
+import asyncio
+import functools
+import math
+import queue
+import re
 import sqlite3
+import time
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+
+import metrics
+import migrations
+
+
+DB_CALL_SECONDS = metrics.REGISTRY.histogram(
+    "bot_db_call_seconds",
+    "Время вызова метода AsyncSQL вместе с ожиданием потока и пачки",
+    ("method", "kind"))
+DB_EXEC_SECONDS = metrics.REGISTRY.histogram(
+    "bot_db_exec_seconds", "Время выполнения метода SQL на соединении", ("method",))
+DB_ERRORS = metrics.REGISTRY.counter(
+    "bot_db_errors_total", "Ошибки методов AsyncSQL", ("method",))
+DB_BATCH_SIZE = metrics.REGISTRY.histogram(
+    "bot_db_batch_size", "Записей в одной пачке групповой фиксации",
+    buckets=(1, 2, 4, 8, 16, 32, 64, 128, 256))
+
+# Слова запроса поиска: всё, кроме букв и цифр, - разделители
+SEARCH_WORD = re.compile(r"\w+")
+
+
+# Префикс длиннее самого длинного префиксного индекса FTS5 ищется перебором
+SEARCH_PREFIX_MAX = max(migrations.FTS_PREFIX_LENGTHS)
+
+
+def make_search_query(text, max_words=8):
+    """Превращает пользовательский текст в запрос FTS5: все слова обязательны,
+    последнее (его могли не дописать) - префикс не длиннее SEARCH_PREFIX_MAX,
+    остальные - точные слова. Синтаксис FTS5 (кавычки, OR, NEAR, *) из текста
+    не попадает в запрос. Возвращает None, если искать нечего."""
+    words = SEARCH_WORD.findall(text.lower())[:max_words]
+    if not words:
+        return None
+    terms = [f'"{word}"' for word in words[:-1]]
+    terms.append(f'"{words[-1][:SEARCH_PREFIX_MAX]}"*')
+    return " ".join(terms)
+
+
+EARTH_RADIUS_KM = 6371.0
+
+
+def distance_km(lat1, lon1, lat2, lon2):
+    """Расстояние между точками по поверхности Земли (формула гаверсинусов)"""
+    lat1, lon1, lat2, lon2 = map(math.radians, (lat1, lon1, lat2, lon2))
+    a = (math.sin((lat2 - lat1) / 2) ** 2
+         + math.cos(lat1) * math.cos(lat2) * math.sin((lon2 - lon1) / 2) ** 2)
+    return 2 * EARTH_RADIUS_KM * math.asin(math.sqrt(a))
 
 
 class SQL:
-    def __init__(self, database):
-        self.connection = sqlite3.connect(database)
+    def __init__(self, database, readonly=False, synchronous="NORMAL"):
+        # check_same_thread=False: соединение используется из потоков AsyncSQL,
+        # но каждое соединение в один момент времени занято только одним потоком
+        self.connection = sqlite3.connect(database, timeout=30, check_same_thread=False)
         self.cursor = self.connection.cursor()
+        # WAL позволяет читателям работать параллельно с писателем
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        self.connection.execute(f"PRAGMA synchronous={synchronous}")
+        if readonly:
+            self.connection.execute("PRAGMA query_only=ON")
+        self._in_batch = False
+
+    # Транзакции
+    @contextmanager
+    def transaction(self):
+        """Транзакция одного метода. Внутри run_batch метод становится частью
+        общей транзакции пачки и сам ничего не фиксирует"""
+        if self._in_batch:
+            yield
+        else:
+            with self.connection:
+                yield
+
+    def run_batch(self, calls):
+        """Выполняет несколько методов одной транзакцией (групповая фиксация).
+        
+        calls - список (имя метода, args, kwargs). Каждый вызов выполняется в своей
+        точке сохранения, поэтому ошибка откатывает только его. Возвращает список
+        (успех, результат или исключение) в порядке вызовов.
+        """
+        results = []
+        self._in_batch = True
+        try:
+            # IMMEDIATE: блокировка записи берется сразу (с ожиданием timeout).
+            # При отложенном BEGIN пачка, которая сначала читает (add_dot читает
+            # MAX(id_dot)), при переходе к записи получает "database is locked"
+            # без ожидания, если другой процесс уже записал в базу
+            self.cursor.execute("BEGIN IMMEDIATE")
+            for name, args, kwargs in calls:
+                self.cursor.execute("SAVEPOINT batch_call")
+                started = time.perf_counter()
+                try:
+                    result = getattr(self, name)(*args, **kwargs)
+                except Exception as e:
+                    self.cursor.execute("ROLLBACK TO batch_call")
+                    self.cursor.execute("RELEASE batch_call")
+                    results.append((False, e))
+                else:
+                    self.cursor.execute("RELEASE batch_call")
+                    results.append((True, result))
+                DB_EXEC_SECONDS.observe(time.perf_counter() - started, name)
+            self.connection.commit()
+        except Exception:
+            self.connection.rollback()
+            raise
+        finally:
+            self._in_batch = False
+        return results
 
     # Добавление пользователя в БД
     def add_user(self, id):
         query = "INSERT INTO users (id) VALUES(?)"
-        with self.connection:
+        with self.transaction():
             self.cursor.execute(query, (id,))
-            self.connection.commit()
+
+    # Регистрация пользователя одним запросом
+    def upsert_user(self, id):
+        """Добавляет пользователя, если его нет, и возвращает (is_admin, city)"""
+        query = """
+            INSERT INTO users (id) VALUES(?)
+            ON CONFLICT(id) DO UPDATE SET id = excluded.id
+            RETURNING is_admin, city
+        """
+        with self.transaction():
+            return self.cursor.execute(query, (id,)).fetchone()
 
     # Проверка, есть ли пользователь в БД
     def user_exist(self, id):
         query = "SELECT * FROM users WHERE id = ?"
-        with self.connection:
+        with self.transaction():
             result = self.cursor.execute(query, (id,)).fetchall()
             return bool(len(result))
 
+    # Состояния диалогов
+    def get_user_state(self, user_id):
+        """Получает (status, payload) сохраненного состояния пользователя"""
+        query = "SELECT status, payload FROM user_state WHERE user_id = ?"
+        with self.transaction():
+            return self.cursor.execute(query, (user_id,)).fetchone()
+
+    def save_user_states(self, saved, cleared):
+        """Одной транзакцией записывает состояния [(user_id, status, payload, updated_at)]
+        и удаляет завершенные (список user_id)"""
+        with self.transaction():
+            self.cursor.executemany("""
+                INSERT INTO user_state (user_id, status, payload, updated_at) VALUES(?, ?, ?, ?)
+                ON CONFLICT(user_id) DO UPDATE SET
+                    status = excluded.status,
+                    payload = excluded.payload,
+                    updated_at = excluded.updated_at
+            """, saved)
+            self.cursor.executemany("DELETE FROM user_state WHERE user_id = ?",
+                                    [(user_id,) for user_id in cleared])
+
+    def purge_user_states(self, older_than):
+        """Удаляет состояния, которые не менялись с момента older_than (unix time)"""
+        query = "DELETE FROM user_state WHERE updated_at < ?"
+        with self.transaction():
+            self.cursor.execute(query, (older_than,))
+            return self.cursor.rowcount
+
+    # Отложенное удаление сообщений
+    def get_pending_deletions(self):
+        """Получает все запланированные удаления [(chat_id, message_id, due_at)]"""
+        query = "SELECT chat_id, message_id, due_at FROM pending_deletions"
+        with self.transaction():
+            return self.cursor.execute(query).fetchall()
+
+    def save_pending_deletions(self, added, done):
+        """Одной транзакцией добавляет удаления [(chat_id, message_id, due_at)]
+        и убирает выполненные [(chat_id, message_id)]"""
+        with self.transaction():
+            self.cursor.executemany(
+                "INSERT OR REPLACE INTO pending_deletions (chat_id, message_id, due_at) VALUES(?, ?, ?)",
+                added
+            )
+            self.cursor.executemany(
+                "DELETE FROM pending_deletions WHERE chat_id = ? AND message_id = ?", done
+            )
+
     # Универсальные методы
     def get_field(self, table, id, field):
         query = f"SELECT {field} FROM {table} WHERE id = ?"
-        with self.connection:
+        with self.transaction():
             result = self.cursor.execute(query, (id,)).fetchone()
             if result:
                 return result[0]
@@ -32,22 +199,21 @@ class SQL:
 
     def update_field(self, table, id, field, value):
         query = f"UPDATE {table} SET {field} = ? WHERE id = ?"
-        with self.connection:
+        with self.transaction():
             self.cursor.execute(query, (value, id))
-            self.connection.commit()
 
     # Получить следующий доступный ID
-    def get_next_available_id(self, table):
-        query = f"SELECT MAX(id_dot) FROM {table}"
-        with self.connection:
+    def get_next_available_id(self):
+        query = "SELECT MAX(id_dot) FROM places"
+        with self.transaction():
             result = self.cursor.execute(query).fetchone()
             max_id = result[0] if result[0] is not None else 0
             return max_id + 1
 
-    # Таблица city_krasnoyarsk
-    def add_dot_krasnoyarsk(self, name_dot, type_dot):
+    # Таблица places (места всех городов, id_dot общий для всех городов)
+    def add_dot(self, city, name_dot, type_dot):
         # Сначала получаем следующий доступный ID
-        next_id = self.get_next_available_id("city_krasnoyarsk")
+        next_id = self.get_next_available_id()
 
         # Проверяем, является ли type_dot числом
         try:
@@ -55,87 +221,199 @@ class SQL:
         except ValueError:
             type_value = type_dot
 
-        query = "INSERT INTO city_krasnoyarsk (id_dot, name_dot, type_dot) VALUES(?, ?, ?)"
-        with self.connection:
-            self.cursor.execute(query, (next_id, name_dot, type_value))
-            self.connection.commit()
+        query = "INSERT INTO places (id_dot, city, name_dot, type_dot) VALUES(?, ?, ?, ?)"
+        with self.transaction():
+            self.cursor.execute(query, (next_id, city, name_dot, type_value))
             return next_id
 
-    def get_dots(self, table, id_dot=None):
+    # Импорт и экспорт каталога (см. catalog.py)
+    def import_dots(self, records, batch_size=500, max_errors=1000):
+        """Добавляет места из потока (номер строки, кортеж или ошибка) одной транзакцией.
+        
+        Кортеж - (city, name_dot, type_dot, address, lat, lon, photo_id). Места
+        вставляются пачками через executemany. Дубли (тот же город, название и
+        адрес - в файле или уже в БД) пропускаются. Возвращает отчет: inserted,
+        duplicates, failed и errors - не больше max_errors пар (строка, причина).
+        """
+        report = {"inserted": 0, "duplicates": 0, "failed": 0, "errors": []}
+        seen = set()
+        
+        def skip(line, counter, reason):
+            report[counter] += 1
+            if len(report["errors"]) < max_errors:
+                report["errors"].append((line, reason))
+        
+        def insert(batch):
+            # Дубли с уже сохраненными местами - одним запросом на город пачки
+            existing = set()
+            for city in {row[0] for _, row in batch}:
+                names = [row[1] for _, row in batch if row[0] == city]
+                query = f"""
+                    SELECT name_dot, address FROM places
+                    WHERE city = ? AND name_dot IN ({', '.join('?' * len(names))})
+                """
+                existing.update((city, name, address)
+                                for name, address in self.cursor.execute(query, (city, *names)))
+            rows = []
+            for line, row in batch:
+                if (row[0], row[1], row[3]) in existing:
+                    skip(line, "duplicates", f"уже есть в каталоге: {row[1]}")
+                else:
+                    rows.append(row)
+            # Не get_next_available_id: его собственная транзакция зафиксировала бы пачку
+            next_id = self.cursor.execute("SELECT COALESCE(MAX(id_dot), 0) + 1 FROM places").fetchone()[0]
+            self.cursor.executemany("""
+                INSERT INTO places (id_dot, city, name_dot, type_dot, address, lat, lon, photo_id)
+                VALUES(?, ?, ?, ?, ?, ?, ?, ?)
+            """, [(next_id + i, *row) for i, row in enumerate(rows)])
+            self.cursor.executemany(
+                "INSERT OR IGNORE INTO place_photos (id_dot, file_id) VALUES(?, ?)",
+                [(next_id + i, row[6]) for i, row in enumerate(rows) if row[6]]
+            )
+            report["inserted"] += len(rows)
+        
+        with self.transaction():
+            # Проверка дублей и MAX(id_dot) должны видеть то, во что пишем:
+            # блокировка записи берется до первого чтения (как в run_batch)
+            self.cursor.execute("BEGIN IMMEDIATE")
+            batch = []
+            for line, row in records:
+                if isinstance(row, Exception):
+                    skip(line, "failed", str(row))
+                    continue
+                key = (row[0], row[1], row[3])
+                if key in seen:
+                    skip(line, "duplicates", f"повтор в файле: {row[1]}")
+                    continue
+                seen.add(key)
+                batch.append((line, row))
+                if len(batch) >= batch_size:
+                    insert(batch)
+                    batch = []
+            if batch:
+                insert(batch)
+        report["errors"].sort()
+        return report
+    
+    def iter_dots_export(self, city=None, chunk_size=500):
+        """Строки каталога с агрегатами отзывов (id, city, name, type, address,
+        lat, lon, photo_id, reviews_count, rating_count, rate), читаются порциями"""
+        query = """
+            SELECT id_dot, city, name_dot, type_dot, address, lat, lon, photo_id,
+                   reviews_count, rating_count, rate
+            FROM places
+        """
+        params = ()
+        if city is not None:
+            query += " WHERE city = ?"
+            params = (city,)
+        query += " ORDER BY id_dot"
+        # Свой курсор: self.cursor могут использовать другие методы
+        cursor = self.connection.cursor()
+        try:
+            cursor.execute(query, params)
+            while True:
+                rows = cursor.fetchmany(chunk_size)
+                if not rows:
+                    break
+                yield from rows
+        finally:
+            cursor.close()
+    
+    def get_dots(self, city, id_dot=None):
         if id_dot is None:
-            query = f"SELECT * FROM {table}"
-            with self.connection:
-                return self.cursor.execute(query).fetchall()
+            query = "SELECT * FROM places WHERE city = ? ORDER BY id_dot"
+            with self.transaction():
+                return self.cursor.execute(query, (city,)).fetchall()
         else:
-            query = f"SELECT * FROM {table} WHERE id_dot = ?"
-            with self.connection:
-                return self.cursor.execute(query, (id_dot,)).fetchall()
+            query = "SELECT * FROM places WHERE city = ? AND id_dot = ?"
+            with self.transaction():
+                return self.cursor.execute(query, (city, id_dot)).fetchall()
+
+    def get_dot_city(self, id_dot):
+        query = "SELECT city FROM places WHERE id_dot = ?"
+        with self.transaction():
+            result = self.cursor.execute(query, (id_dot,)).fetchone()
+            return result[0] if result else None
+
+    def update_dot_name(self, id_dot, name_dot):
+        query = "UPDATE places SET name_dot = ? WHERE id_dot = ?"
+        with self.transaction():
+            self.cursor.execute(query, (name_dot, id_dot))
 
-    def get_id_dot_krasnoyarsk(self, name_dot):
-        query = "SELECT id_dot FROM city_krasnoyarsk WHERE name_dot = ?"
-        with self.connection:
-            result = self.cursor.execute(query, (name_dot,)).fetchone()
+    def update_dot_type(self, id_dot, type_dot):
+        query = "UPDATE places SET type_dot = ? WHERE id_dot = ?"
+        with self.transaction():
+            self.cursor.execute(query, (type_dot, id_dot))
+
+    def delete_dot(self, id_dot):
+        query = "DELETE FROM places WHERE id_dot = ?"
+        with self.transaction():
+            self.cursor.execute(query, (id_dot,))
+            return self.cursor.rowcount > 0
+
+    def get_id_dot(self, city, name_dot):
+        query = "SELECT id_dot FROM places WHERE city = ? AND name_dot = ?"
+        with self.transaction():
+            result = self.cursor.execute(query, (city, name_dot)).fetchone()
             if result:
                 return result[0]
             else:
                 return None
 
-    # Инициализация таблиц для фото, избранного и отзывов
+    # Инициализация и миграции схемы
     def init_tables(self):
-        """Создает необходимые таблицы, если их нет"""
-        # Таблица для избранного
-        self.cursor.execute("""
-            CREATE TABLE IF NOT EXISTS favourites (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                user_id INTEGER NOT NULL,
-                dot_id INTEGER NOT NULL,
-                UNIQUE(user_id, dot_id)
-            )
-        """)
-        
-        # Таблица для отзывов
-        self.cursor.execute("""
-            CREATE TABLE IF NOT EXISTS reviews (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                user_id INTEGER NOT NULL,
-                dot_id INTEGER NOT NULL,
-                review_text TEXT,
-                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-            )
-        """)
-        
-        # Добавляем поле photo_id в city_krasnoyarsk, если его нет
-        try:
-            self.cursor.execute("ALTER TABLE city_krasnoyarsk ADD COLUMN photo_id TEXT")
-        except:
-            pass  # Колонка уже существует
-        
-        # Добавляем поле rating в reviews, если его нет
-        try:
-            self.cursor.execute("ALTER TABLE reviews ADD COLUMN rating INTEGER")
-        except:
-            pass  # Колонка уже существует
-        
-        # Добавление address
-        try:
-            self.cursor.execute("ALTER TABLE city_krasnoyarsk ADD COLUMN address TEXT")
-        except:
-            pass
-        
-        self.connection.commit()
-    
-    # Работа с фото мест
-    def update_dot_photo(self, dot_id, photo_id):
-        """Обновляет photo_id для места"""
-        query = "UPDATE city_krasnoyarsk SET photo_id = ? WHERE id_dot = ?"
-        with self.connection:
-            self.cursor.execute(query, (photo_id, dot_id))
-            self.connection.commit()
+        """Применяет недостающие миграции схемы (см. migrations.py)"""
+        return migrations.migrate(self.connection)
+    
+    # Агрегаты отзывов (поддерживаются триггерами, см. migrations.py)
+    def backfill_dot_stats(self):
+        """Полностью пересчитывает агрегаты отзывов для всех мест"""
+        with self.transaction():
+            self.cursor.execute(migrations.BACKFILL_DOT_STATS.format(table="places"))
+    
+    def get_dot_stats(self, dot_id):
+        """Получает агрегаты отзывов места: 
+        (количество отзывов, количество оценок, средняя, максимальная, минимальная)"""
+        query = """
+            SELECT reviews_count, rating_count, rate, max_rate, min_rate
+            FROM places WHERE id_dot = ?
+        """
+        with self.transaction():
+            return self.cursor.execute(query, (dot_id,)).fetchone()
+    
+    # Галерея фото мест (обложку и число фото в places поддерживают триггеры)
+    def add_dot_photo(self, dot_id, file_id, limit=None):
+        """Добавляет фото в галерею места, если в ней меньше limit фото.
+        Возвращает число фото в галерее"""
+        query = """
+            INSERT OR IGNORE INTO place_photos (id_dot, file_id)
+            SELECT id_dot, :file_id FROM places
+            WHERE id_dot = :dot_id AND (:limit IS NULL OR photos_count < :limit)
+        """
+        with self.transaction():
+            self.cursor.execute(query, {"file_id": file_id, "dot_id": dot_id, "limit": limit})
+            result = self.cursor.execute(
+                "SELECT photos_count FROM places WHERE id_dot = ?", (dot_id,)
+            ).fetchone()
+            return result[0] if result else 0
+    
+    def clear_dot_photos(self, dot_id):
+        """Удаляет все фото места. Возвращает количество удаленных"""
+        with self.transaction():
+            self.cursor.execute("DELETE FROM place_photos WHERE id_dot = ?", (dot_id,))
+            return self.cursor.rowcount
+    
+    def get_dot_photos(self, dot_id):
+        """Получает file_id фото места в порядке добавления (первое - обложка)"""
+        query = "SELECT file_id FROM place_photos WHERE id_dot = ? ORDER BY id"
+        with self.transaction():
+            return [row[0] for row in self.cursor.execute(query, (dot_id,))]
     
     def get_dot_photo(self, dot_id):
-        """Получает photo_id места"""
-        query = "SELECT photo_id FROM city_krasnoyarsk WHERE id_dot = ?"
-        with self.connection:
+        """Получает обложку (первое фото галереи) места"""
+        query = "SELECT photo_id FROM places WHERE id_dot = ?"
+        with self.transaction():
             result = self.cursor.execute(query, (dot_id,)).fetchone()
             return result[0] if result and result[0] else None
     
@@ -143,82 +421,547 @@ class SQL:
     def add_to_favourites(self, user_id, dot_id):
         """Добавляет место в избранное пользователя"""
         query = "INSERT OR IGNORE INTO favourites (user_id, dot_id) VALUES(?, ?)"
-        with self.connection:
+        with self.transaction():
             self.cursor.execute(query, (user_id, dot_id))
-            self.connection.commit()
             return self.cursor.rowcount > 0
     
     def remove_from_favourites(self, user_id, dot_id):
         """Удаляет место из избранного пользователя"""
         query = "DELETE FROM favourites WHERE user_id = ? AND dot_id = ?"
-        with self.connection:
+        with self.transaction():
             self.cursor.execute(query, (user_id, dot_id))
-            self.connection.commit()
             return self.cursor.rowcount > 0
     
     def is_favourite(self, user_id, dot_id):
         """Проверяет, находится ли место в избранном"""
         query = "SELECT 1 FROM favourites WHERE user_id = ? AND dot_id = ?"
-        with self.connection:
+        with self.transaction():
             result = self.cursor.execute(query, (user_id, dot_id)).fetchone()
             return bool(result)
     
-    def get_favourite_dots(self, user_id):
-        """Получает список избранных мест пользователя"""
+    def get_favourite_dots(self, user_id, city):
+        """Получает список избранных мест пользователя в городе"""
         query = """
-            SELECT d.* FROM city_krasnoyarsk d
+            SELECT d.* FROM places d
             INNER JOIN favourites f ON d.id_dot = f.dot_id
-            WHERE f.user_id = ?
+            WHERE f.user_id = ? AND d.city = ?
+        """
+        with self.transaction():
+            return self.cursor.execute(query, (user_id, city)).fetchall()
+    
+    # Лента мест для списков (всегда в пределах одного города).
+    # version - версия карточки места для кэша отрисовки, photos_count - число
+    # фото в галерее (photo_id - её обложка)
+    FEED_QUERY = """
+        SELECT d.id_dot, d.name_dot, d.type_dot, d.photo_id, d.address,
+               f.dot_id IS NOT NULL AS is_fav,
+               d.reviews_count, d.rate, d.version, d.photos_count
+        FROM places d
+        LEFT JOIN favourites f ON f.dot_id = d.id_dot AND f.user_id = ?
+    """
+    
+    def get_dots_feed(self, user_id, city, favourites_only=False):
+        """Получает места города одним запросом вместе с флагом избранного
+        пользователя, количеством отзывов и средней оценкой"""
+        query = self.FEED_QUERY + " WHERE d.city = ?"
+        if favourites_only:
+            query += " AND f.dot_id IS NOT NULL"
+        query += " ORDER BY d.id_dot"
+        with self.transaction():
+            return self.cursor.execute(query, (user_id, city)).fetchall()
+    
+    def get_dot_feed(self, user_id, id_dot):
+        """Получает одно место в формате ленты"""
+        query = self.FEED_QUERY + " WHERE d.id_dot = ?"
+        with self.transaction():
+            return self.cursor.execute(query, (user_id, id_dot)).fetchone()
+    
+    def get_dots_page(self, user_id, city, after_id=None, before_id=None, limit=5):
+        """Получает страницу ленты мест города (keyset-пагинация по id_dot).
+        
+        after_id - страница после этого места, before_id - страница перед ним,
+        без курсора - первая страница. Возвращает (места, есть_предыдущая, есть_следующая).
+        """
+        with self.transaction():
+            if before_id is not None:
+                query = self.FEED_QUERY + """
+                    WHERE d.city = ? AND d.id_dot < ? ORDER BY d.id_dot DESC LIMIT ?
+                """
+                rows = self.cursor.execute(query, (user_id, city, before_id, limit + 1)).fetchall()
+                has_prev = len(rows) > limit
+                rows = rows[:limit][::-1]
+                has_next = bool(rows) and self._dot_exists_after(city, rows[-1][0])
+            else:
+                query = self.FEED_QUERY + """
+                    WHERE d.city = ? AND d.id_dot > ? ORDER BY d.id_dot LIMIT ?
+                """
+                cursor = after_id if after_id is not None else -1
+                rows = self.cursor.execute(query, (user_id, city, cursor, limit + 1)).fetchall()
+                has_next = len(rows) > limit
+                rows = rows[:limit]
+                has_prev = bool(rows) and self._dot_exists_before(city, rows[0][0])
+            return rows, has_prev, has_next
+    
+    def _dot_exists_after(self, city, id_dot):
+        query = "SELECT EXISTS(SELECT 1 FROM places WHERE city = ? AND id_dot > ?)"
+        return bool(self.cursor.execute(query, (city, id_dot)).fetchone()[0])
+    
+    def _dot_exists_before(self, city, id_dot):
+        query = "SELECT EXISTS(SELECT 1 FROM places WHERE city = ? AND id_dot < ?)"
+        return bool(self.cursor.execute(query, (city, id_dot)).fetchone()[0])
+    
+    # Полнотекстовый поиск (индексы places_fts и reviews_fts, см. migrations.py)
+    SEARCH_QUERY = """
+        WITH hits (dot_id, score) AS (
+            SELECT p.id_dot, bm25(places_fts, 10.0, 3.0)
+            FROM places_fts
+            JOIN places p ON p.id_dot = places_fts.rowid
+            WHERE places_fts MATCH :query AND p.city = :city
+            UNION ALL
+            SELECT dot_id, score * 0.3
+            FROM (
+                SELECT r.dot_id, bm25(reviews_fts) AS score
+                FROM reviews_fts
+                JOIN reviews r ON r.id = reviews_fts.rowid
+                JOIN places p ON p.id_dot = r.dot_id
+                WHERE reviews_fts MATCH :query AND p.city = :city
+                ORDER BY reviews_fts.rowid DESC LIMIT :review_hits
+            )
+        ),
+        ranked (dot_id, score) AS (
+            SELECT dot_id, SUM(score) FROM hits GROUP BY dot_id
+        )
+        SELECT d.id_dot, d.name_dot, d.type_dot, d.photo_id, d.address,
+               f.dot_id IS NOT NULL AS is_fav,
+               d.reviews_count, d.rate, d.version, d.photos_count
+        FROM ranked h
+        JOIN places d ON d.id_dot = h.dot_id
+        LEFT JOIN favourites f ON f.dot_id = d.id_dot AND f.user_id = :user_id
+        WHERE d.city = :city
+        ORDER BY h.score, d.id_dot
+        LIMIT :limit
+    """
+    
+    def search_dots(self, user_id, city, text, limit=10, review_hits=500):
+        """Ищет места города по названию, адресу и текстам отзывов.
+        
+        Возвращает строки в формате ленты, лучшие совпадения первыми. Совпадение
+        в названии весит больше, чем в адресе, а совпадения в отзывах - меньше
+        всего. Совпадения оцениваются только для мест города (и в названиях,
+        и в отзывах). Из отзывов учитываются только review_hits самых новых
+        совпадений в городе: FTS5 отдает их по rowid и останавливается на
+        LIMIT, а сортировка по релевантности потребовала бы оценить все
+        совпавшие отзывы. Цена - частое слово не найдет место только по
+        старым отзывам, если в городе больше review_hits более новых отзывов
+        с этим словом.
+        """
+        query = make_search_query(text)
+        if query is None:
+            return []
+        params = {"query": query, "user_id": user_id, "city": city,
+                  "limit": limit, "review_hits": review_hits}
+        with self.transaction():
+            return self.cursor.execute(self.SEARCH_QUERY, params).fetchall()
+    
+    # Рейтинг мест (таблица place_scores, см. migrations.py)
+    def get_top_dots(self, user_id, city, type_dot, limit=10):
+        """Получает лучшие места города данного типа по байесовской оценке.
+        
+        Рейтинг уже посчитан триггерами, поэтому запрос - чтение первых limit
+        записей индекса idx_place_scores_rank (CROSS JOIN закрепляет place_scores
+        внешней таблицей, чтобы планировщик не начал с places). Возвращает список (строка ленты, оценка), лучшие первыми.
+        """
+        query = """
+            SELECT d.id_dot, d.name_dot, d.type_dot, d.photo_id, d.address,
+                   f.dot_id IS NOT NULL AS is_fav,
+                   d.reviews_count, d.rate, d.version, d.photos_count, s.score
+            FROM place_scores s
+            CROSS JOIN places d ON d.id_dot = s.id_dot
+            LEFT JOIN favourites f ON f.dot_id = d.id_dot AND f.user_id = ?
+            WHERE s.city = ? AND s.type_dot = ?
+            ORDER BY s.score DESC, s.id_dot
+            LIMIT ?
+        """
+        with self.transaction():
+            rows = self.cursor.execute(query, (user_id, city, type_dot, limit)).fetchall()
+            return [(row[:-1], row[-1]) for row in rows]
+    
+    # Координаты мест (индекс places_rtree, см. migrations.py)
+    def set_dot_location(self, id_dot, lat, lon):
+        """Сохраняет координаты места"""
+        query = "UPDATE places SET lat = ?, lon = ? WHERE id_dot = ?"
+        with self.transaction():
+            self.cursor.execute(query, (lat, lon, id_dot))
+            return self.cursor.rowcount > 0
+    
+    def get_nearest_dots(self, user_id, lat, lon, limit=5, radius_km=0.5, max_radius_km=50.0):
+        """Ищет limit ближайших к точке мест (в любом городе) не дальше max_radius_km.
+        
+        Прямоугольник вокруг точки удваивается, пока в нём не окажется limit мест.
+        Расстояние до limit-го из них - верхняя граница ответа, поэтому второй
+        запрос к R-дереву берет прямоугольник этого радиуса, а расстояния до
+        кандидатов считаются точно. Возвращает список (строка ленты, расстояние
+        в км), ближайшие первыми.
+        """
+        with self.transaction():
+            while True:
+                nearest = self._dots_in_box(lat, lon, radius_km)
+                if len(nearest) >= limit or radius_km >= max_radius_km:
+                    break
+                radius_km = min(radius_km * 2, max_radius_km)
+            
+            # limit-е место могло лежать в углу прямоугольника, а ближе него -
+            # места за его сторонами: добираем их по точному радиусу
+            if len(nearest) >= limit and nearest[limit - 1][0] > radius_km:
+                nearest = self._dots_in_box(lat, lon, nearest[limit - 1][0])
+            nearest = [(distance, id_dot) for distance, id_dot in nearest[:limit]
+                       if distance <= max_radius_km]
+            if not nearest:
+                return []
+            
+            rows = self._feed_by_ids(user_id, [id_dot for _, id_dot in nearest])
+            return [(row, distance) for row, (distance, _) in zip(rows, nearest) if row is not None]
+    
+    def get_dots_feed_by_ids(self, user_id, ids):
+        """Получает места в формате ленты в порядке ids (удаленные пропускаются)"""
+        with self.transaction():
+            return [row for row in self._feed_by_ids(user_id, ids) if row is not None]
+    
+    def _feed_by_ids(self, user_id, ids):
+        """Строки ленты в порядке ids, None - для несуществующих мест"""
+        if not ids:
+            return []
+        query = self.FEED_QUERY + f" WHERE d.id_dot IN ({', '.join('?' * len(ids))})"
+        rows = {row[0]: row for row in self.cursor.execute(query, (user_id, *ids))}
+        return [rows.get(id_dot) for id_dot in ids]
+    
+    # Взаимодействия пользователей с местами для рекомендаций (см. recommend.py):
+    # избранное - вес 1, отзыв - по оценке от 0 (1★) до 1 (5★), без оценки - 0.5
+    INTERACTIONS_QUERY = """
+        SELECT user_id, dot_id, MAX(weight) FROM (
+            SELECT user_id, dot_id, 1.0 AS weight FROM favourites {where}
+            UNION ALL
+            SELECT user_id, dot_id, COALESCE((rating - 1) / 4.0, 0.5) FROM reviews {where}
+        )
+        GROUP BY user_id, dot_id HAVING MAX(weight) > 0
+    """
+    
+    def get_interactions(self):
+        """Получает все взаимодействия [(user_id, dot_id, вес)]"""
+        with self.transaction():
+            return self.cursor.execute(self.INTERACTIONS_QUERY.format(where="")).fetchall()
+    
+    def get_user_interactions(self, user_id):
+        """Получает взаимодействия пользователя [(dot_id, вес)]"""
+        query = self.INTERACTIONS_QUERY.format(where="WHERE user_id = :user_id")
+        with self.transaction():
+            return [row[1:] for row in self.cursor.execute(query, {"user_id": user_id})]
+    
+    def get_dot_cities(self):
+        """Получает города всех мест [(id_dot, city)]"""
+        with self.transaction():
+            return self.cursor.execute("SELECT id_dot, city FROM places").fetchall()
+    
+    def _dots_in_box(self, lat, lon, radius_km):
+        """Места в прямоугольнике, описанном вокруг круга радиуса radius_km:
+        список (точное расстояние, id_dot) по возрастанию расстояния"""
+        query = """
+            SELECT d.id_dot, d.lat, d.lon FROM places_rtree r
+            JOIN places d ON d.id_dot = r.id
+            WHERE r.min_lat >= ? AND r.max_lat <= ? AND r.min_lon >= ? AND r.max_lon <= ?
         """
-        with self.connection:
-            return self.cursor.execute(query, (user_id,)).fetchall()
+        dlat = math.degrees(radius_km / EARTH_RADIUS_KM)
+        # Градус долготы короче к полюсам
+        dlon = dlat / max(math.cos(math.radians(lat)), 0.01)
+        rows = self.cursor.execute(query, (lat - dlat, lat + dlat, lon - dlon, lon + dlon))
+        return sorted((distance_km(lat, lon, dot_lat, dot_lon), id_dot)
+                      for id_dot, dot_lat, dot_lon in rows)
     
     # Работа с отзывами
     def add_review(self, user_id, dot_id, review_text, rating=None):
         """Добавляет отзыв о месте"""
         query = "INSERT INTO reviews (user_id, dot_id, review_text, rating) VALUES(?, ?, ?, ?)"
-        with self.connection:
+        with self.transaction():
             self.cursor.execute(query, (user_id, dot_id, review_text, rating))
-            self.connection.commit()
             return self.cursor.lastrowid
     
     def update_review_rating(self, review_id, rating):
         """Обновляет оценку в отзыве"""
         query = "UPDATE reviews SET rating = ? WHERE id = ?"
-        with self.connection:
+        with self.transaction():
             self.cursor.execute(query, (rating, review_id))
-            self.connection.commit()
     
     def get_dot_reviews(self, dot_id, limit=10):
         """Получает отзывы о месте"""
         query = "SELECT user_id, review_text, rating, created_at FROM reviews WHERE dot_id = ? ORDER BY created_at DESC LIMIT ?"
-        with self.connection:
+        with self.transaction():
             return self.cursor.execute(query, (dot_id, limit)).fetchall()
     
+    def get_dot_reviews_page(self, dot_id, older_than=None, newer_than=None, limit=5):
+        """Получает страницу отзывов о месте, новые первыми (keyset-пагинация
+        по (created_at, id) и индексу idx_reviews_dot_created).
+        
+        older_than - страница отзывов старше отзыва с этим id, newer_than - новее
+        него, без курсора - самые новые. Каждая страница читает не больше limit + 1
+        строк индекса, сколько бы отзывов ни было у места. Возвращает (отзывы,
+        есть_новее, есть_старше); отзыв - (id, user_id, review_text, rating, created_at).
+        """
+        columns = "SELECT id, user_id, review_text, rating, created_at FROM reviews WHERE dot_id = ?"
+        with self.transaction():
+            if newer_than is not None:
+                query = columns + """
+                    AND (created_at, id) > (SELECT created_at, id FROM reviews WHERE id = ?)
+                    ORDER BY created_at, id LIMIT ?
+                """
+                rows = self.cursor.execute(query, (dot_id, newer_than, limit + 1)).fetchall()
+                has_newer = len(rows) > limit
+                rows = rows[:limit][::-1]
+                has_older = bool(rows) and self._review_exists(dot_id, "<", rows[-1][0])
+            else:
+                if older_than is not None:
+                    query = columns + """
+                        AND (created_at, id) < (SELECT created_at, id FROM reviews WHERE id = ?)
+                        ORDER BY created_at DESC, id DESC LIMIT ?
+                    """
+                    params = (dot_id, older_than, limit + 1)
+                else:
+                    query = columns + " ORDER BY created_at DESC, id DESC LIMIT ?"
+                    params = (dot_id, limit + 1)
+                rows = self.cursor.execute(query, params).fetchall()
+                has_older = len(rows) > limit
+                rows = rows[:limit]
+                has_newer = bool(rows) and self._review_exists(dot_id, ">", rows[0][0])
+            return rows, has_newer, has_older
+    
+    def _review_exists(self, dot_id, op, review_id):
+        """Есть ли у места отзыв старше ("<") или новее (">") отзыва review_id"""
+        query = f"""
+            SELECT EXISTS(SELECT 1 FROM reviews WHERE dot_id = ?
+                AND (created_at, id) {op} (SELECT created_at, id FROM reviews WHERE id = ?))
+        """
+        return bool(self.cursor.execute(query, (dot_id, review_id)).fetchone()[0])
+    
     def get_review_by_user_dot(self, user_id, dot_id):
         """Получает отзыв пользователя о месте"""
         query = "SELECT id, review_text, rating FROM reviews WHERE user_id = ? AND dot_id = ?"
-        with self.connection:
+        with self.transaction():
             return self.cursor.execute(query, (user_id, dot_id)).fetchone()
     
     def has_user_reviewed(self, user_id, dot_id):
         """Проверяет, оставил ли пользователь отзыв"""
         query = "SELECT 1 FROM reviews WHERE user_id = ? AND dot_id = ?"
-        with self.connection:
+        with self.transaction():
             result = self.cursor.execute(query, (user_id, dot_id)).fetchone()
             return bool(result)
     
     def set_dot_address(self, id_dot, address):
-        query = "UPDATE city_krasnoyarsk SET address = ? WHERE id_dot = ?"
-        with self.connection:
+        query = "UPDATE places SET address = ? WHERE id_dot = ?"
+        with self.transaction():
             self.cursor.execute(query, (address, id_dot))
-            self.connection.commit()
     def get_dot_address(self, id_dot):
-        query = "SELECT address FROM city_krasnoyarsk WHERE id_dot = ?"
-        with self.connection:
+        query = "SELECT address FROM places WHERE id_dot = ?"
+        with self.transaction():
             r = self.cursor.execute(query, (id_dot,)).fetchone()
             return r[0] if r and r[0] else None
     
     # Закрытие соединения
     def close(self):
-        self.connection.close()
\ No newline at end of file
+        self.connection.close()
+
+
+class AsyncSQL:
+    """Асинхронный интерфейс к SQL.
+
+    Запросы выполняются в потоках, а не в event loop. Все записи идут через одно
+    соединение-писатель, чтения - через небольшой пул соединений-читателей,
+    поэтому чтения не ждут записей и друг друга (SQLite в режиме WAL).
+    Методы те же, что у SQL, только их нужно вызывать через await.
+
+    Записи, пришедшие в течение batch_latency секунд (но не больше batch_size),
+    выполняются одной транзакцией на писателе (групповая фиксация): один commit
+    на пачку вместо commit на каждый клик. Каждый вызывающий получает результат
+    своего метода (lastrowid, rowcount и т.п.) или своё исключение.
+    """
+
+    # Методы SQL, которые только читают данные
+    READ_METHODS = frozenset({
+        "user_exist",
+        "get_field",
+        "get_user_state",
+        "get_pending_deletions",
+        "get_next_available_id",
+        "get_dots",
+        "get_dot_city",
+        "get_id_dot",
+        "get_dot_photo",
+        "get_dot_photos",
+        "is_favourite",
+        "get_favourite_dots",
+        "get_dots_feed",
+        "get_dot_feed",
+        "get_dots_page",
+        "get_dot_stats",
+        "get_dot_reviews",
+        "get_dot_reviews_page",
+        "get_review_by_user_dot",
+        "has_user_reviewed",
+        "get_dot_address",
+        "search_dots",
+        "get_nearest_dots",
+        "get_top_dots",
+        "get_dots_feed_by_ids",
+        "get_interactions",
+        "get_user_interactions",
+        "get_dot_cities",
+    })
+
+    # Методы, которые сами управляют транзакциями и не объединяются в пачки
+    DIRECT_METHODS = frozenset({
+        "init_tables",
+        "backfill_dot_stats",
+        "import_dots",
+    })
+
+    # Служебные методы SQL, недоступные через AsyncSQL
+    HIDDEN_METHODS = frozenset({
+        "transaction",
+        "run_batch",
+        "iter_dots_export",
+    })
+
+    def __init__(self, database, readers=4, batch_latency=0.003, batch_size=64,
+                 synchronous="NORMAL"):
+        self.database = database
+        self.batch_latency = batch_latency
+        self.batch_size = batch_size
+        self._writer = SQL(database, synchronous=synchronous)
+        self._writer_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="sql-writer")
+        self._readers = queue.SimpleQueue()
+        for _ in range(readers):
+            self._readers.put(SQL(database, readonly=True))
+        self._reader_executor = ThreadPoolExecutor(max_workers=readers, thread_name_prefix="sql-reader")
+        self._pending = []  # [(имя метода, args, kwargs, future)]
+        self._flush_handle = None
+        self.batches = 0
+        self.batched_writes = 0
+
+    def _read(self, name, *args, **kwargs):
+        """Выполняет метод на свободном соединении-читателе"""
+        reader = self._readers.get()
+        try:
+            with DB_EXEC_SECONDS.time(name):
+                return getattr(reader, name)(*args, **kwargs)
+        finally:
+            self._readers.put(reader)
+
+    def _write(self, name, *args, **kwargs):
+        """Выполняет метод на соединении-писателе"""
+        with DB_EXEC_SECONDS.time(name):
+            return getattr(self._writer, name)(*args, **kwargs)
+
+    # Групповая фиксация записей
+    def _submit_write(self, name, args, kwargs):
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        self._pending.append((name, args, kwargs, future))
+        if len(self._pending) >= self.batch_size:
+            self._flush()
+        elif self._flush_handle is None:
+            self._flush_handle = loop.call_later(self.batch_latency, self._flush)
+        return future
+
+    def _flush(self):
+        """Отправляет накопленные записи писателю одной пачкой"""
+        if self._flush_handle is not None:
+            self._flush_handle.cancel()
+            self._flush_handle = None
+        batch, self._pending = self._pending, []
+        if not batch:
+            return
+
+        self.batches += 1
+        self.batched_writes += len(batch)
+        DB_BATCH_SIZE.observe(len(batch))
+        calls = [(name, args, kwargs) for name, args, kwargs, _ in batch]
+        futures = [future for _, _, _, future in batch]
+        loop = asyncio.get_running_loop()
+        done = loop.run_in_executor(self._writer_executor, self._writer.run_batch, calls)
+        done.add_done_callback(functools.partial(self._deliver, futures))
+
+    @staticmethod
+    def _deliver(futures, done):
+        """Раздает результаты пачки вызывающим"""
+        if done.exception() is not None:
+            # Не удалось зафиксировать транзакцию - ошибка у всех участников
+            for future in futures:
+                if not future.done():
+                    future.set_exception(done.exception())
+            return
+        for future, (ok, result) in zip(futures, done.result()):
+            if future.done():
+                continue
+            if ok:
+                future.set_result(result)
+            else:
+                future.set_exception(result)
+
+    def write_stats(self):
+        """Количество пачек, записей в них и средний размер пачки"""
+        return {
+            "batches": self.batches,
+            "writes": self.batched_writes,
+            "avg_batch": self.batched_writes / self.batches if self.batches else 0.0,
+            "pending": len(self._pending),
+        }
+
+    def _call_write(self, name, *args, **kwargs):
+        return self._submit_write(name, args, kwargs)
+
+    @staticmethod
+    def _make_method(name, executor, call):
+        async def method(*args, **kwargs):
+            loop = asyncio.get_running_loop()
+            return await loop.run_in_executor(
+                executor, functools.partial(call, name, *args, **kwargs)
+            )
+        return method
+
+    def __getattr__(self, name):
+        if (name.startswith("_") or name in self.HIDDEN_METHODS
+                or not callable(getattr(SQL, name, None))):
+            raise AttributeError(name)
+
+        if name in self.READ_METHODS:
+            kind = "read"
+            call = self._make_method(name, self._reader_executor, self._read)
+        elif name in self.DIRECT_METHODS:
+            kind = "direct"
+            call = self._make_method(name, self._writer_executor, self._write)
+        else:
+            kind = "write"
+            call = functools.partial(self._call_write, name)
+
+        async def method(*args, **kwargs):
+            started = time.perf_counter()
+            try:
+                return await call(*args, **kwargs)
+            except Exception:
+                DB_ERRORS.inc(name)
+                raise
+            finally:
+                DB_CALL_SECONDS.observe(time.perf_counter() - started, name, kind)
+
+        method.__name__ = name
+        # Кэшируем обёртку, чтобы не создавать её на каждый вызов
+        setattr(self, name, method)
+        return method
+
+    async def close(self):
+        """Дожидается выполнения запросов и закрывает все соединения"""
+        self._flush()
+        loop = asyncio.get_running_loop()
+        await loop.run_in_executor(self._writer_executor, self._writer.close)
+        self._writer_executor.shutdown(wait=True)
+        self._reader_executor.shutdown(wait=True)
+        while not self._readers.empty():
+            self._readers.get().close()
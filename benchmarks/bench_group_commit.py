@@ -0,0 +1,86 @@
+"""Бенчмарк групповой фиксации записей AsyncSQL.
+
+Много пользователей одновременно переключают избранное и оставляют отзывы.
+Сравнивается запись без объединения (batch_size=1) и с объединением в пачки.
+
+Запуск из корня репозитория:
+    python -m benchmarks.bench_group_commit --users 200 --writes 20
+"""
+import argparse
+import asyncio
+import os
+import tempfile
+import time
+
+from base import AsyncSQL, SQL
+
+
+async def user_session(db, user_id, writes, places, latencies):
+    for i in range(writes):
+        dot_id = (user_id + i) % places + 1
+        started = time.perf_counter()
+        if i % 3 == 0:
+            await db.add_review(user_id, dot_id, "Хорошее место", rating=None)
+        elif i % 3 == 1:
+            await db.add_to_favourites(user_id, dot_id)
+        else:
+            await db.remove_from_favourites(user_id, dot_id)
+        latencies.append(time.perf_counter() - started)
+
+
+async def run(path, users, writes, places, batch_size, batch_latency, synchronous):
+    db = AsyncSQL(path, batch_size=batch_size, batch_latency=batch_latency,
+                  synchronous=synchronous)
+    latencies = []
+    started = time.perf_counter()
+    await asyncio.gather(*[
+        user_session(db, user_id, writes, places, latencies) for user_id in range(users)
+    ])
+    elapsed = time.perf_counter() - started
+    stats = db.write_stats()
+    await db.close()
+    latencies.sort()
+    return {
+        "writes_per_sec": len(latencies) / elapsed,
+        "latency_avg_ms": sum(latencies) / len(latencies) * 1000,
+        "latency_p95_ms": latencies[int(len(latencies) * 0.95)] * 1000,
+        "avg_batch": stats["avg_batch"],
+    }
+
+
+def prepare(path, places):
+    db = SQL(path)
+    db.init_tables()
+    for i in range(places):
+        db.add_dot("krasnoyarsk", f"Место {i}", i % 5 + 1)
+    db.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--users", type=int, default=200)
+    parser.add_argument("--writes", type=int, default=20)
+    parser.add_argument("--places", type=int, default=100)
+    parser.add_argument("--batch-size", type=int, default=64)
+    parser.add_argument("--batch-latency", type=float, default=0.003)
+    args = parser.parse_args()
+
+    print(f"{'synchronous':<12} {'режим':<10} {'записей/с':>10} {'ср. мс':>8} "
+          f"{'p95 мс':>8} {'пачка':>6}")
+    for synchronous in ("NORMAL", "FULL"):
+        for label, batch_size, batch_latency in (
+            ("по одной", 1, 0.0),
+            ("пачками", args.batch_size, args.batch_latency),
+        ):
+            with tempfile.TemporaryDirectory() as tmp:
+                path = os.path.join(tmp, "bench.db")
+                prepare(path, args.places)
+                result = asyncio.run(run(path, args.users, args.writes, args.places,
+                                         batch_size, batch_latency, synchronous))
+            print(f"{synchronous:<12} {label:<10} {result['writes_per_sec']:>10.0f} "
+                  f"{result['latency_avg_ms']:>8.2f} {result['latency_p95_ms']:>8.2f} "
+                  f"{result['avg_batch']:>6.1f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,385 @@
+"""Бенчмарк слоя данных base.SQL на синтетических базах разного размера.
+
+Для каждого размера создается временная база: места трех городов (с адресами,
+координатами и фото), пользователи, отзывы, избранное и состояния диалогов.
+Затем замеряется время каждого метода SQL на случайных аргументах, а также
+путь данных списков (handle_places_list, handle_favorites) через AsyncSQL.
+Для каждого замера сохраняется план выполнения его запросов (EXPLAIN QUERY
+PLAN), поэтому при сравнении запусков видно не только замедление, но и смену
+плана (например, пропавший индекс).
+
+Запуск из корня репозитория:
+    python -m benchmarks.bench_sql --sizes 1000,100000 --output bench_sql.json
+    python -m benchmarks.bench_sql --sizes 1000000 --compare bench_sql.json
+"""
+import argparse
+import asyncio
+import json
+import os
+import platform
+import random
+import re
+import sqlite3
+import statistics
+import tempfile
+import time
+
+from base import AsyncSQL, SQL
+
+CITIES = {
+    "krasnoyarsk": (56.01, 92.87),
+    "novosibirsk": (55.03, 82.92),
+    "irkutsk": (52.29, 104.28),
+}
+WORDS = ("кафе кофе пицца суши бургер музей парк отель магазин театр набережная "
+         "уютно вкусно дорого дешево быстро долго чисто шумно тихо красиво "
+         "персонал обслуживание интерьер вид река мост центр завтрак ужин").split()
+STREETS = ("Мира", "Ленина", "Карла Маркса", "Маерчака", "Партизана Железняка",
+           "Взлетная", "Кирова", "Советская")
+
+
+# ==================== ДАННЫЕ ====================
+def generate(path, places, reviews_per_place, favourites_per_user, seed):
+    """Создает базу и заполняет её синтетическими данными. Возвращает её размеры"""
+    rng = random.Random(seed)
+    users = max(100, places // 10)
+    reviews = places * reviews_per_place
+    cities = list(CITIES)
+
+    db = SQL(path)
+    db.init_tables()
+    connection = db.connection
+
+    def place_rows():
+        for id_dot in range(1, places + 1):
+            city = cities[id_dot % len(cities)]
+            lat, lon = CITIES[city]
+            yield (id_dot, city, " ".join(rng.choices(WORDS, k=2)).capitalize(),
+                   rng.randint(1, 5),
+                   f"ул. {rng.choice(STREETS)}, {rng.randint(1, 200)}",
+                   f"photo{id_dot}" if id_dot % 2 else None,
+                   lat + rng.uniform(-0.15, 0.15), lon + rng.uniform(-0.25, 0.25))
+
+    def review_rows():
+        for _ in range(reviews):
+            yield (rng.randint(1, users), rng.randint(1, places),
+                   " ".join(rng.choices(WORDS, k=rng.randint(3, 20))),
+                   rng.randint(1, 5) if rng.random() > 0.1 else None,
+                   f"2025-{rng.randint(1, 12):02d}-{rng.randint(1, 28):02d} "
+                   f"{rng.randint(0, 23):02d}:{rng.randint(0, 59):02d}:00")
+
+    def photo_rows():
+        # Галерея у мест с обложкой: обложка и до 4 фото после неё
+        for id_dot in range(1, places + 1, 2):
+            for number in range(rng.randint(1, 5)):
+                yield id_dot, f"photo{id_dot}" + (f"_{number}" if number else "")
+
+    def favourite_rows():
+        for user_id in range(1, users + 1):
+            for _ in range(favourites_per_user):
+                yield user_id, rng.randint(1, places)
+
+    started = time.perf_counter()
+    with connection:
+        connection.executemany(
+            "INSERT INTO users (id, city) VALUES(?, ?)",
+            ((user_id, cities[user_id % len(cities)]) for user_id in range(1, users + 1)))
+        connection.executemany(
+            "INSERT INTO places (id_dot, city, name_dot, type_dot, address, photo_id, lat, lon) "
+            "VALUES(?, ?, ?, ?, ?, ?, ?, ?)", place_rows())
+        connection.executemany(
+            "INSERT OR IGNORE INTO place_photos (id_dot, file_id) VALUES(?, ?)", photo_rows())
+        # Агрегаты, полнотекстовый индекс и R-дерево заполняются триггерами
+        connection.executemany(
+            "INSERT INTO reviews (user_id, dot_id, review_text, rating, created_at) "
+            "VALUES(?, ?, ?, ?, ?)", review_rows())
+        connection.executemany(
+            "INSERT OR IGNORE INTO favourites (user_id, dot_id) VALUES(?, ?)", favourite_rows())
+        connection.executemany(
+            "INSERT INTO user_state (user_id, status, payload, updated_at) VALUES(?, ?, ?, ?)",
+            ((user_id, 201, '{"review_place_id":1}', time.time())
+             for user_id in range(1, users + 1, 10)))
+    connection.execute("ANALYZE")
+    db.close()
+
+    return {
+        "places": places,
+        "users": users,
+        "reviews": reviews,
+        "favourites": users * favourites_per_user,
+        "build_seconds": round(time.perf_counter() - started, 2),
+        "db_bytes": os.path.getsize(path),
+    }
+
+
+# ==================== ЗАМЕРЫ ====================
+# Таблица и её псевдоним в запросе: "FROM places d", "JOIN favourites f"
+TABLE_ALIAS = re.compile(r"\b(?:FROM|JOIN)\s+(\w+)(?:\s+(?:AS\s+)?(\w+))?", re.IGNORECASE)
+
+
+class PlanRecorder:
+    """Собирает запросы, выполненные соединением, их планы выполнения и
+    полные просмотры обычных таблиц (SCAN без поиска по индексу)"""
+
+    def __init__(self, connection):
+        self.connection = connection
+        self.statements = []
+        # Обычные таблицы: без виртуальных (FTS5, R-дерево) и их служебных таблиц
+        virtual = [name for name, in connection.execute(
+            "SELECT name FROM sqlite_master WHERE type = 'table' AND sql LIKE 'CREATE VIRTUAL%'")]
+        self.tables = {name for name, in connection.execute(
+            "SELECT name FROM sqlite_master WHERE type = 'table' AND name NOT LIKE 'sqlite_%'")
+            if name not in virtual and not any(name.startswith(f"{v}_") for v in virtual)}
+
+    def __enter__(self):
+        self.statements = []
+        self.connection.set_trace_callback(self.statements.append)
+        return self
+
+    def __exit__(self, *exc):
+        self.connection.set_trace_callback(None)
+
+    def plans(self):
+        """Возвращает (планы запросов, полные просмотры таблиц)"""
+        plans, scans = [], set()
+        for statement in dict.fromkeys(self.statements):
+            head = statement.lstrip().split(None, 1)[0].upper()
+            # Служебные запросы FTS5 и R-дерева обращаются к таблицам как main.*
+            if head not in ("SELECT", "WITH", "INSERT", "UPDATE", "DELETE") or "main'." in statement \
+                    or "main." in statement:
+                continue
+            try:
+                rows = self.connection.execute(f"EXPLAIN QUERY PLAN {statement}").fetchall()
+            except sqlite3.Error:
+                continue
+            plan = [row[3] for row in rows]
+            plans.append(plan)
+
+            aliases = {}
+            for table, alias in TABLE_ALIAS.findall(statement):
+                aliases[table] = table
+                if alias:
+                    aliases[alias] = table
+            for step in plan:
+                match = re.match(r"SCAN (\w+)", step)
+                if match and aliases.get(match.group(1)) in self.tables:
+                    scans.add(f"{aliases[match.group(1)]}: {step}")
+        return plans, sorted(scans)
+
+
+def sql_cases(db, sizes, rng):
+    """(имя замера, функция) для каждого метода SQL. Сначала чтения, потом записи"""
+    places, users = sizes["places"], sizes["users"]
+    city = lambda: rng.choice(list(CITIES))
+    dot = lambda: rng.randint(1, places)
+    user = lambda: rng.randint(1, users)
+
+    def near():
+        # Точка рядом с центром одного города (места разбросаны на ±0.15/±0.25)
+        lat, lon = CITIES[city()]
+        return lat + rng.uniform(-0.1, 0.1), lon + rng.uniform(-0.2, 0.2)
+
+    def page_middle():
+        after = rng.randint(1, places)
+        return db.get_dots_page(user(), city(), after_id=after)
+
+    def page_before():
+        before = rng.randint(1, places)
+        return db.get_dots_page(user(), city(), before_id=before)
+
+    return [
+        ("upsert_user", lambda: db.upsert_user(user())),
+        ("user_exist", lambda: db.user_exist(user())),
+        ("get_field", lambda: db.get_field("users", user(), "city")),
+        ("get_user_state", lambda: db.get_user_state(user())),
+        ("get_next_available_id", lambda: db.get_next_available_id()),
+        ("get_dots", lambda: db.get_dots(city())),
+        ("get_dots[id]", lambda: db.get_dots(city(), id_dot=dot())),
+        ("get_dot_city", lambda: db.get_dot_city(dot())),
+        ("get_id_dot", lambda: db.get_id_dot(city(), " ".join(rng.choices(WORDS, k=2)).capitalize())),
+        ("get_dot_stats", lambda: db.get_dot_stats(dot())),
+        ("get_dot_photo", lambda: db.get_dot_photo(dot())),
+        ("get_dot_photos", lambda: db.get_dot_photos(dot())),
+        ("get_dot_address", lambda: db.get_dot_address(dot())),
+        ("is_favourite", lambda: db.is_favourite(user(), dot())),
+        ("get_favourite_dots", lambda: db.get_favourite_dots(user(), city())),
+        ("get_dots_feed", lambda: db.get_dots_feed(user(), city())),
+        ("get_dots_feed[favourites]", lambda: db.get_dots_feed(user(), city(), favourites_only=True)),
+        ("get_dot_feed", lambda: db.get_dot_feed(user(), dot())),
+        ("get_dots_page[first]", lambda: db.get_dots_page(user(), city())),
+        ("get_dots_page[after]", page_middle),
+        ("get_dots_page[before]", page_before),
+        ("get_dot_reviews", lambda: db.get_dot_reviews(dot(), limit=20)),
+        ("get_dot_reviews_page[first]", lambda: db.get_dot_reviews_page(dot())),
+        ("get_dot_reviews_page[older]", lambda: db.get_dot_reviews_page(
+            dot(), older_than=rng.randint(1, sizes["reviews"]))),
+        ("get_review_by_user_dot", lambda: db.get_review_by_user_dot(user(), dot())),
+        ("has_user_reviewed", lambda: db.has_user_reviewed(user(), dot())),
+        ("search_dots", lambda: db.search_dots(user(), city(), rng.choice(WORDS))),
+        ("search_dots[2 words]", lambda: db.search_dots(user(), city(), " ".join(rng.sample(WORDS, 2)))),
+        ("get_nearest_dots", lambda: db.get_nearest_dots(user(), *near())),
+        ("get_top_dots", lambda: db.get_top_dots(user(), city(), rng.randint(1, 5))),
+        # Записи (каждая - отдельная транзакция, как при batch_size=1)
+        ("add_review", lambda: db.add_review(user(), dot(), "Синтетический отзыв", rating=None)),
+        ("update_review_rating", lambda: db.update_review_rating(rng.randint(1, sizes["reviews"]),
+                                                                 rng.randint(1, 5))),
+        ("add_to_favourites", lambda: db.add_to_favourites(user(), dot())),
+        ("remove_from_favourites", lambda: db.remove_from_favourites(user(), dot())),
+        ("update_dot_name", lambda: db.update_dot_name(dot(), " ".join(rng.choices(WORDS, k=2)))),
+        ("set_dot_location", lambda: db.set_dot_location(dot(), *near())),
+        ("save_user_states", lambda: db.save_user_states([(user(), 1, None, time.time())], [user()])),
+    ]
+
+
+def measure(name, function, recorder, repeat, budget):
+    """Выполняет function до repeat раз (но не дольше budget секунд)"""
+    with recorder:
+        result = function()
+    plans, scans = recorder.plans()
+
+    timings = []
+    deadline = time.perf_counter() + budget
+    while len(timings) < repeat and (not timings or time.perf_counter() < deadline):
+        started = time.perf_counter()
+        result = function()
+        timings.append(time.perf_counter() - started)
+
+    if isinstance(result, tuple) and len(result) == 3 and isinstance(result[0], list):
+        result = result[0]  # get_dots_page, get_dot_reviews_page: (строки, флаг, флаг)
+    rows = len(result) if isinstance(result, list) else int(result is not None)
+    timings.sort()
+    return {
+        "case": name,
+        "runs": len(timings),
+        "rows": rows,
+        "min_us": round(timings[0] * 1e6, 1),
+        "p50_us": round(statistics.median(timings) * 1e6, 1),
+        "p95_us": round(timings[min(len(timings) - 1, int(len(timings) * 0.95))] * 1e6, 1),
+        "mean_us": round(statistics.fmean(timings) * 1e6, 1),
+        "plans": plans,
+        "full_scans": scans,
+    }
+
+
+async def list_paths(path, sizes, repeat, seed):
+    """Путь данных списков мест и избранного так, как его видит обработчик"""
+    rng = random.Random(seed)
+    db = AsyncSQL(path)
+    users = sizes["users"]
+    cases = [
+        ("handle_places_list", lambda: db.get_dots_page(rng.randint(1, users),
+                                                        rng.choice(list(CITIES)), limit=5)),
+        ("handle_favorites", lambda: db.get_dots_feed(rng.randint(1, users),
+                                                      rng.choice(list(CITIES)),
+                                                      favourites_only=True)),
+    ]
+    results = []
+    for name, function in cases:
+        timings = []
+        for _ in range(repeat):
+            started = time.perf_counter()
+            await function()
+            timings.append(time.perf_counter() - started)
+        timings.sort()
+        results.append({
+            "case": f"async:{name}",
+            "runs": len(timings),
+            "p50_us": round(statistics.median(timings) * 1e6, 1),
+            "p95_us": round(timings[int(len(timings) * 0.95)] * 1e6, 1),
+            "mean_us": round(statistics.fmean(timings) * 1e6, 1),
+        })
+    await db.close()
+    return results
+
+
+def run_size(places, args):
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, "bench.db")
+        print(f"\n=== {places} мест: генерация...", flush=True)
+        sizes = generate(path, places, args.reviews_per_place, args.favourites_per_user, args.seed)
+        print(f"    {sizes}", flush=True)
+
+        db = SQL(path)
+        recorder = PlanRecorder(db.connection)
+        rng = random.Random(args.seed)
+        results = []
+        for name, function in sql_cases(db, sizes, rng):
+            result = measure(name, function, recorder, args.repeat, args.budget)
+            results.append(result)
+            scans = f"  {'; '.join(result['full_scans'])}" if result["full_scans"] else ""
+            print(f"    {name:<28} {result['p50_us']:>10.1f} {result['p95_us']:>10.1f} "
+                  f"{result['rows']:>8}{scans}", flush=True)
+        db.close()
+
+        for result in asyncio.run(list_paths(path, sizes, args.repeat, args.seed)):
+            results.append(result)
+            print(f"    {result['case']:<28} {result['p50_us']:>10.1f} {result['p95_us']:>10.1f}")
+    return {"dataset": sizes, "results": results}
+
+
+# ==================== СРАВНЕНИЕ ====================
+def compare(previous, current, threshold):
+    """Печатает замеры, которые замедлились больше чем на threshold, и смену планов"""
+    old = {(run["dataset"]["places"], result["case"]): result
+           for run in previous["runs"] for result in run["results"]}
+    found = 0
+    for run in current["runs"]:
+        for result in run["results"]:
+            key = (run["dataset"]["places"], result["case"])
+            before = old.get(key)
+            if before is None:
+                continue
+            ratio = result["p50_us"] / before["p50_us"] if before["p50_us"] else 1.0
+            if ratio > 1 + threshold:
+                found += 1
+                print(f"МЕДЛЕННЕЕ {key[0]} {key[1]}: {before['p50_us']} -> {result['p50_us']} мкс "
+                      f"(x{ratio:.2f})")
+            if before.get("plans") != result.get("plans"):
+                found += 1
+                print(f"ПЛАН {key[0]} {key[1]}:\n    было: {before.get('plans')}\n"
+                      f"    стало: {result.get('plans')}")
+    print(f"\nИзменений: {found}")
+    return found
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--sizes", default="1000,100000",
+                        help="количества мест через запятую, например 1000,100000,1000000")
+    parser.add_argument("--reviews-per-place", type=int, default=3)
+    parser.add_argument("--favourites-per-user", type=int, default=10)
+    parser.add_argument("--repeat", type=int, default=200, help="повторов каждого замера")
+    parser.add_argument("--budget", type=float, default=2.0, help="секунд на один замер")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--output", help="куда записать результаты (JSON)")
+    parser.add_argument("--compare", help="JSON предыдущего запуска для сравнения")
+    parser.add_argument("--threshold", type=float, default=0.25,
+                        help="допустимое замедление медианы при сравнении (доля)")
+    args = parser.parse_args()
+
+    print(f"{'замер':<32} {'p50 мкс':>10} {'p95 мкс':>10} {'строк':>8}")
+    report = {
+        "meta": {
+            "created_at": time.strftime("%Y-%m-%dT%H:%M:%S"),
+            "python": platform.python_version(),
+            "sqlite": sqlite3.sqlite_version,
+            "platform": platform.platform(),
+            "args": vars(args),
+        },
+        "runs": [run_size(int(size), args) for size in args.sizes.split(",")],
+    }
+
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            json.dump(report, f, ensure_ascii=False, indent=1)
+        print(f"\nРезультаты записаны в {args.output}")
+
+    if args.compare:
+        with open(args.compare, encoding="utf-8") as f:
+            previous = json.load(f)
+        if compare(previous, report, args.threshold):
+            raise SystemExit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,207 @@
+"""Бенчмарк приема обновлений: webhook против polling.
+
+Локальный сервер изображает Bot API: отдает обновления через getUpdates
+(long polling) и отвечает на остальные методы. В режиме webhook те же
+обновления отправляются POST-запросами в WebhookServer. Измеряется время от
+появления обновления до вызова обработчика и пропускная способность.
+Сетевая задержка до настоящего Telegram в измерение не входит.
+
+Запуск из корня репозитория:
+    python -m benchmarks.bench_webhook --updates 2000 --rate 500 --handler-ms 5
+"""
+import argparse
+import asyncio
+import json
+import time
+
+from aiohttp import ClientSession, web
+from aiogram import Bot, Dispatcher
+from aiogram.client.session.aiohttp import AiohttpSession
+from aiogram.client.telegram import TelegramAPIServer
+
+from webhook import SECRET_HEADER, WebhookServer
+
+TOKEN = "123456:BENCHMARK-TOKEN"
+SECRET = "bench-secret"
+
+
+def make_update(update_id):
+    chat = {"id": 1000 + update_id % 100, "type": "private", "first_name": "Bench"}
+    return {
+        "update_id": update_id,
+        "message": {
+            "message_id": update_id,
+            "date": int(time.time()),
+            "chat": chat,
+            "from": {"id": chat["id"], "is_bot": False, "first_name": "Bench"},
+            "text": "ping",
+        },
+    }
+
+
+class FakeBotAPI:
+    """Минимальный Bot API: getMe, getUpdates с long polling, остальное - ok"""
+
+    def __init__(self):
+        self.pending = []
+        self._arrived = asyncio.Event()
+        self._runner = None
+        self.port = None
+
+    async def start(self):
+        app = web.Application()
+        app.router.add_post("/bot{token}/{method}", self._handle)
+        self._runner = web.AppRunner(app, access_log=None)
+        await self._runner.setup()
+        site = web.TCPSite(self._runner, "127.0.0.1", 0)
+        await site.start()
+        self.port = site._server.sockets[0].getsockname()[1]
+
+    async def stop(self):
+        await self._runner.cleanup()
+
+    def push(self, update):
+        self.pending.append(update)
+        self._arrived.set()
+
+    async def _handle(self, request):
+        method = request.match_info["method"].lower()
+        params = await request.post()
+        if method == "getme":
+            result = {"id": 123456, "is_bot": True, "first_name": "Bench", "username": "bench_bot"}
+        elif method == "getupdates":
+            result = await self._get_updates(int(params.get("offset", 0)),
+                                             float(params.get("timeout", 0)))
+        else:
+            result = True
+        return web.json_response({"ok": True, "result": result})
+
+    async def _get_updates(self, offset, timeout):
+        self.pending = [update for update in self.pending if update["update_id"] >= offset]
+        if not self.pending:
+            self._arrived.clear()
+            try:
+                await asyncio.wait_for(self._arrived.wait(), timeout)
+            except asyncio.TimeoutError:
+                pass
+        return self.pending[:100]
+
+
+def make_dispatcher(total, handler_ms, sent, latencies, done):
+    dp = Dispatcher()
+
+    @dp.message()
+    async def on_message(message):
+        latencies.append(time.perf_counter() - sent[message.message_id])
+        if handler_ms:
+            await asyncio.sleep(handler_ms / 1000)
+        if len(latencies) == total:
+            done.set()
+
+    return dp
+
+
+async def produce(total, rate, deliver, sent):
+    """Выпускает обновления с постоянной частотой rate в секунду"""
+    started = time.perf_counter()
+    tasks = []
+    for update_id in range(1, total + 1):
+        delay = started + (update_id - 1) / rate - time.perf_counter()
+        if delay > 0:
+            await asyncio.sleep(delay)
+        sent[update_id] = time.perf_counter()
+        tasks.append(asyncio.create_task(deliver(make_update(update_id))))
+    await asyncio.gather(*tasks)
+
+
+async def bench_polling(api, bot, total, rate, handler_ms):
+    sent, latencies, done = {}, [], asyncio.Event()
+    dp = make_dispatcher(total, handler_ms, sent, latencies, done)
+
+    async def deliver(update):
+        api.push(update)
+
+    polling = asyncio.create_task(dp.start_polling(
+        bot, handle_signals=False, close_bot_session=False, polling_timeout=10
+    ))
+    await asyncio.sleep(0.2)  # getMe и первый getUpdates
+    started = time.perf_counter()
+    await produce(total, rate, deliver, sent)
+    await done.wait()
+    elapsed = time.perf_counter() - started
+    await dp.stop_polling()
+    await polling
+    return latencies, elapsed, {}
+
+
+async def bench_webhook(bot, total, rate, handler_ms, queue_size, workers):
+    sent, latencies, done = {}, [], asyncio.Event()
+    dp = make_dispatcher(total, handler_ms, sent, latencies, done)
+    server = WebhookServer(dp, bot, url="", secret=SECRET, path="/webhook",
+                           host="127.0.0.1", port=0, queue_size=queue_size, workers=workers)
+    await server.start(register=False)
+    port = server._runner.addresses[0][1]
+    url = f"http://127.0.0.1:{port}/webhook"
+
+    async with ClientSession() as session:
+        # Запрос без секрета должен быть отклонен
+        async with session.post(url, json=make_update(0)) as response:
+            assert response.status == 401, response.status
+
+        async def deliver(update):
+            body = json.dumps(update)
+            headers = {SECRET_HEADER: SECRET, "Content-Type": "application/json"}
+            while True:
+                async with session.post(url, data=body, headers=headers) as response:
+                    if response.status != 503:
+                        return
+                # Как Telegram: очередь полна - повторить позже
+                await asyncio.sleep(0.05)
+
+        started = time.perf_counter()
+        await produce(total, rate, deliver, sent)
+        await done.wait()
+        elapsed = time.perf_counter() - started
+    await server.stop()
+    return latencies, elapsed, server.stats()
+
+
+def report(label, latencies, elapsed, extra):
+    latencies = sorted(latencies)
+    pct = lambda q: latencies[min(len(latencies) - 1, int(len(latencies) * q))] * 1000
+    print(f"{label:<10} {len(latencies) / elapsed:>10.0f} {pct(0.5):>8.2f} {pct(0.95):>8.2f} "
+          f"{pct(0.99):>8.2f} {latencies[-1] * 1000:>8.2f}  "
+          f"{extra.get('overflowed', '-')!s:>8}")
+
+
+async def run(args):
+    api = FakeBotAPI()
+    await api.start()
+    session = AiohttpSession(api=TelegramAPIServer.from_base(f"http://127.0.0.1:{api.port}"))
+    bot = Bot(TOKEN, session=session)
+    try:
+        print(f"{'режим':<10} {'обн./с':>10} {'p50 мс':>8} {'p95 мс':>8} {'p99 мс':>8} "
+              f"{'max мс':>8}  {'503':>8}")
+        result = await bench_polling(api, bot, args.updates, args.rate, args.handler_ms)
+        report("polling", *result)
+        result = await bench_webhook(bot, args.updates, args.rate, args.handler_ms,
+                                     args.queue_size, args.workers)
+        report("webhook", *result)
+    finally:
+        await session.close()
+        await api.stop()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--updates", type=int, default=2000)
+    parser.add_argument("--rate", type=float, default=500, help="обновлений в секунду")
+    parser.add_argument("--handler-ms", type=float, default=5, help="время работы обработчика")
+    parser.add_argument("--queue-size", type=int, default=1000)
+    parser.add_argument("--workers", type=int, default=32)
+    args = parser.parse_args()
+    asyncio.run(run(args))
+
+
+if __name__ == "__main__":
+    main()
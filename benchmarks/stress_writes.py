@@ -0,0 +1,78 @@
+"""Проверка записи в одну базу из нескольких процессов (режим workers.py).
+
+Каждый процесс выполняет пачки SQL.run_batch из add_dot (читает MAX(id_dot),
+потом вставляет) и add_to_favourites - как пачки групповой фиксации
+обработчиков. Все пачки должны выполниться без ошибок, а в базе должно
+оказаться ровно processes * batches мест. Код выхода 1 - если это не так.
+
+Запуск из корня репозитория:
+    python -m benchmarks.stress_writes --processes 4 --batches 300
+"""
+import argparse
+import multiprocessing
+import os
+import sys
+import tempfile
+import time
+
+from base import SQL
+
+
+def writer(path, index, batches, errors):
+    db = SQL(path)
+    failed = 0
+    for i in range(batches):
+        try:
+            results = db.run_batch([
+                ("add_dot", ("krasnoyarsk", f"Место {index}-{i}", 1), {}),
+                ("add_to_favourites", (index + 1, i + 1), {}),
+            ])
+        except Exception:
+            failed += 2
+            continue
+        failed += sum(1 for ok, _ in results if not ok)
+    db.close()
+    errors.put(failed)
+
+
+def run(processes, batches):
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, "stress.db")
+        db = SQL(path)
+        db.init_tables()
+        db.close()
+
+        context = multiprocessing.get_context("spawn")
+        errors = context.Queue()
+        workers = [context.Process(target=writer, args=(path, index, batches, errors))
+                   for index in range(processes)]
+        started = time.perf_counter()
+        for process in workers:
+            process.start()
+        failed = sum(errors.get() for _ in workers)
+        for process in workers:
+            process.join()
+        elapsed = time.perf_counter() - started
+
+        db = SQL(path)
+        inserted = db.connection.execute("SELECT COUNT(*) FROM places").fetchone()[0]
+        db.close()
+    return inserted, failed, elapsed
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--processes", type=int, default=4)
+    parser.add_argument("--batches", type=int, default=300)
+    args = parser.parse_args()
+
+    expected = args.processes * args.batches
+    inserted, failed, elapsed = run(args.processes, args.batches)
+    print(f"процессов: {args.processes}, пачек: {expected}, мест: {inserted}/{expected}, "
+          f"ошибок: {failed}, {elapsed:.1f} с")
+    if inserted != expected or failed:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,109 @@
+from collections import OrderedDict
+
+
+class UserProfile:
+    """Данные пользователя, нужные на каждом обновлении"""
+
+    __slots__ = ("id", "is_admin", "city")
+
+    def __init__(self, id, is_admin, city):
+        self.id = id
+        self.is_admin = is_admin
+        self.city = city
+
+
+class UserCache:
+    """LRU-кэш профилей пользователей перед AsyncSQL.
+
+    При промахе пользователь регистрируется и читается одним upsert-запросом,
+    дальше профиль берется из памяти. Изменения через update_field сразу
+    пишутся и в БД, и в кэш. Правки таблицы users в обход кэша (например,
+    выдача прав администратора вручную) станут видны после вытеснения профиля
+    или перезапуска бота. Состояние диалога хранится отдельно, в state.StateStore.
+    """
+
+    def __init__(self, db, maxsize=10000, default_city=None):
+        self._db = db
+        self.default_city = default_city  # Город пользователей, которые его не выбирали
+        self.maxsize = maxsize
+        self._profiles = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    async def get(self, user_id) -> UserProfile:
+        """Возвращает профиль, при необходимости регистрируя пользователя"""
+        profile = self._profiles.get(user_id)
+        if profile is not None:
+            self._profiles.move_to_end(user_id)
+            self.hits += 1
+            return profile
+
+        self.misses += 1
+        is_admin, city = await self._db.upsert_user(user_id)
+        profile = UserProfile(user_id, bool(is_admin), city or self.default_city)
+        self._put(profile)
+        return profile
+
+    async def add_user(self, user_id) -> UserProfile:
+        """Регистрирует пользователя (то же, что get)"""
+        return await self.get(user_id)
+
+    async def update_field(self, user_id, field, value):
+        """Обновляет поле пользователя в БД и в кэше"""
+        await self._db.update_field("users", user_id, field, value)
+        profile = self._profiles.get(user_id)
+        if profile is not None and field in UserProfile.__slots__:
+            setattr(profile, field, value)
+
+    def invalidate(self, user_id):
+        """Убирает профиль из кэша - следующий get перечитает его из БД"""
+        self._profiles.pop(user_id, None)
+
+    def _put(self, profile):
+        self._profiles[profile.id] = profile
+        self._profiles.move_to_end(profile.id)
+        while len(self._profiles) > self.maxsize:
+            self._profiles.popitem(last=False)
+
+    def __len__(self):
+        return len(self._profiles)
+
+
+class CardCache:
+    """LRU-кэш отрисованных карточек мест.
+
+    Рядом с карточкой хранится версия места (places.version): триггеры в БД
+    выдают ей новое значение общего счетчика при вставке и каждом изменении
+    места, в том числе при новых отзывах, поэтому место, получившее id
+    удаленного, не совпадет с его карточкой.
+    Версия приходит в той же строке ленты, что и само место, поэтому устаревшая
+    карточка распознается без дополнительных запросов и отрисовывается заново.
+    """
+
+    def __init__(self, maxsize=5000):
+        self.maxsize = maxsize
+        self._cards = OrderedDict()  # id места -> (версия, карточка)
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, place_id, version, render, *args):
+        """Карточка места этой версии; при промахе - render(*args)"""
+        entry = self._cards.get(place_id)
+        if entry is not None and entry[0] == version:
+            self._cards.move_to_end(place_id)
+            self.hits += 1
+            return entry[1]
+
+        self.misses += 1
+        card = render(*args)
+        self._cards[place_id] = (version, card)
+        self._cards.move_to_end(place_id)
+        while len(self._cards) > self.maxsize:
+            self._cards.popitem(last=False)
+        return card
+
+    def invalidate(self, place_id):
+        self._cards.pop(place_id, None)
+
+    def __len__(self):
+        return len(self._cards)
@@ -0,0 +1,150 @@
+"""Компактные callback_data кнопок и маршрутизация нажатий по ним.
+
+callback_data имеет вид "код:поле:поле...", где код - короткое имя действия
+(1-2 символа), а поля кодируются по типам: int - в base36, bool - 1/0,
+str - как есть. Все поля обязательны: пустое поле - ошибка. Например, кнопка "Вперёд" списка мест
+с курсором 123456 - "pp:1:2n9c" вместо "places_next_123456". Telegram
+ограничивает callback_data 64 байтами, pack проверяет это при создании кнопки.
+
+Нажатие разбирается один раз: код ищется в словаре, поля превращаются в
+namedtuple действия, и обработчик получает готовые типизированные данные.
+Кнопки, которые нельзя разобрать (старый формат, удаленное действие,
+испорченные поля), распознаются до вызова обработчика. Права тоже
+проверяются здесь: действие с admin=True не вызывается для остальных.
+"""
+import re
+from collections import namedtuple
+
+MAX_LENGTH = 64  # Предел callback_data в Telegram, байт
+SEPARATOR = ":"
+DIGITS = "0123456789abcdefghijklmnopqrstuvwxyz"
+# Число, как его пишет encode_int: int() принял бы и " 1", и "1_0"
+INT_FIELD = re.compile(r"-?[0-9a-z]+")
+
+# Итог CallbackRouter.dispatch
+DISPATCHED = "dispatched"
+STALE = "stale"
+FORBIDDEN = "forbidden"
+
+
+class CallbackError(ValueError):
+    """callback_data нельзя собрать или разобрать"""
+
+
+def encode_int(value: int) -> str:
+    if value < 0:
+        return "-" + encode_int(-value)
+    result = ""
+    while True:
+        value, digit = divmod(value, 36)
+        result = DIGITS[digit] + result
+        if not value:
+            return result
+
+
+def _encode(value, kind) -> str:
+    if value is None:
+        raise CallbackError("Пустое значение поля")
+    if kind is bool:
+        return "1" if value else "0"
+    if kind is int:
+        return encode_int(value)
+    value = str(value)
+    if not value:
+        raise CallbackError("Пустое значение поля")
+    if SEPARATOR in value:
+        raise CallbackError(f"Символ '{SEPARATOR}' в значении поля: {value!r}")
+    return value
+
+
+def _decode(text: str, kind):
+    if not text:
+        raise CallbackError("Пустое значение поля")
+    if kind is bool:
+        if text not in ("0", "1"):
+            raise CallbackError(f"Некорректное логическое значение: {text!r}")
+        return text == "1"
+    if kind is int:
+        if not INT_FIELD.fullmatch(text):
+            raise CallbackError(f"Некорректное число: {text!r}")
+        return int(text, 36)
+    return text
+
+
+class Action:
+    """Действие кнопки: код в callback_data, поля и обработчик"""
+
+    __slots__ = ("name", "code", "types", "payload", "handler", "admin")
+
+    def __init__(self, name, code, fields, handler, admin=False):
+        self.name = name
+        self.code = code
+        self.admin = admin  # Только для администраторов
+        self.types = tuple(kind for _, kind in fields)
+        self.payload = namedtuple(name, [field for field, _ in fields])
+        self.handler = handler
+
+
+class CallbackRouter:
+    """Таблица действий кнопок: сборка callback_data и вызов обработчика"""
+
+    def __init__(self):
+        self._by_code = {}
+        self._by_name = {}
+
+    def action(self, name, code, *fields, admin=False):
+        """Декоратор обработчика действия. fields - пары (имя поля, тип);
+        admin=True - действие доступно только администраторам"""
+        if SEPARATOR in code:
+            raise CallbackError(f"Символ '{SEPARATOR}' в коде действия {name}")
+
+        def register(handler):
+            if code in self._by_code or name in self._by_name:
+                raise CallbackError(f"Действие {name} ({code}) уже зарегистрировано")
+            action = Action(name, code, fields, handler, admin)
+            self._by_code[code] = action
+            self._by_name[name] = action
+            return handler
+
+        return register
+
+    def pack(self, name, *values) -> str:
+        """callback_data для кнопки действия name с полями values"""
+        action = self._by_name[name]
+        if len(values) != len(action.types):
+            raise CallbackError(f"{name}: ожидается полей {len(action.types)}, передано {len(values)}")
+        data = SEPARATOR.join([action.code] + [_encode(value, kind)
+                                               for value, kind in zip(values, action.types)])
+        if len(data.encode()) > MAX_LENGTH:
+            raise CallbackError(f"{name}: callback_data длиннее {MAX_LENGTH} байт: {data!r}")
+        return data
+
+    def unpack(self, data):
+        """(действие, данные) из callback_data; CallbackError - если разобрать нельзя"""
+        code, separator, rest = (data or "").partition(SEPARATOR)
+        action = self._by_code.get(code)
+        if action is None:
+            raise CallbackError(f"Неизвестное действие: {data!r}")
+        parts = rest.split(SEPARATOR) if separator else []
+        if len(parts) != len(action.types):
+            raise CallbackError(f"Некорректные поля действия {action.name}: {data!r}")
+        return action, action.payload._make(_decode(part, kind)
+                                            for part, kind in zip(parts, action.types))
+
+    def action_name(self, data) -> str:
+        """Имя действия по callback_data без разбора полей (например, для метрик)"""
+        action = self._by_code.get((data or "").partition(SEPARATOR)[0])
+        return action.name if action is not None else "unknown"
+
+    async def dispatch(self, call, *args, is_admin=False):
+        """Вызывает обработчик действия: handler(call, *args, данные).
+        Возвращает DISPATCHED, STALE (callback_data разобрать нельзя) или
+        FORBIDDEN (действие для администраторов, а is_admin ложно)"""
+        try:
+            action, payload = self.unpack(call.data)
+        except CallbackError:
+            return STALE
+        if action.admin and not is_admin:
+            return FORBIDDEN
+        await action.handler(call, *args, payload)
+        return DISPATCHED
@@ -0,0 +1,228 @@
+"""Импорт и экспорт каталога мест файлами CSV и JSON.
+
+Файлы читаются потоково: CSV - построчно, JSON - по одному объекту (JSON Lines
+или массив объектов), так что в памяти одновременно только текущая строка.
+Каждая строка проверяется и превращается в кортеж для SQL.import_dots или в
+ошибку с номером строки. Экспорт (export_places) пишет места с агрегатами
+отзывов, читая их из БД порциями.
+
+Колонки (и ключи JSON): name, type, address, city, lat, lon, photo_id.
+Обязательны name и type; без city место попадает в город по умолчанию.
+Файл экспорта можно загрузить обратно: лишние колонки игнорируются. Строка CSV,
+в которой значений больше или меньше, чем колонок в заголовке, - ошибка строки.
+"""
+import csv
+import json
+import os
+
+IMPORT_FIELDS = ("name", "type", "address", "city", "lat", "lon", "photo_id")
+REQUIRED_FIELDS = ("name", "type")
+TEXT_FIELDS = ("name", "address", "city", "photo_id")
+EXPORT_FIELDS = ("id", "city", "name", "type", "address", "lat", "lon", "photo_id",
+                 "reviews_count", "rating_count", "rate")
+NAME_LIMIT = 200
+ADDRESS_LIMIT = 300
+READ_CHUNK = 64 * 1024
+
+
+class RowError(ValueError):
+    """Строку файла нельзя импортировать"""
+
+
+def detect_format(filename):
+    """csv или json по расширению файла (None - неизвестный формат)"""
+    extension = os.path.splitext(filename or "")[1].lower()
+    if extension == ".csv":
+        return "csv"
+    if extension in (".json", ".jsonl", ".ndjson"):
+        return "json"
+    return None
+
+
+def normalize_text(value):
+    """Строка без лишних пробелов ("" и None - None)"""
+    if value is None:
+        return None
+    value = " ".join(str(value).split())
+    return value or None
+
+
+# ==================== ЧТЕНИЕ ====================
+def _read_csv(file):
+    reader = csv.reader(file)
+    header = [name.strip().lower() for name in next(reader, [])]
+    missing = [name for name in REQUIRED_FIELDS if name not in header]
+    if missing:
+        yield 1, RowError(f"в заголовке нет колонок: {', '.join(missing)}")
+        return
+    while True:
+        # Номер первой строки записи: значение в кавычках может занимать несколько строк
+        line = reader.line_num + 1
+        try:
+            values = next(reader)
+        except StopIteration:
+            return
+        except csv.Error as e:
+            yield line, RowError(f"некорректная строка CSV: {e}")
+            continue
+        if not values:
+            continue
+        if len(values) != len(header):
+            yield line, RowError(f"значений в строке {len(values)}, колонок в заголовке {len(header)}")
+            continue
+        yield line, dict(zip(header, values))
+
+
+def _read_json(file):
+    """Объекты из JSON Lines или из массива JSON, по одному"""
+    decoder = json.JSONDecoder()
+    buffer, position, line, eof = "", 0, 1, False
+    in_array = None
+
+    def fill():
+        nonlocal buffer, position, eof
+        chunk = file.read(READ_CHUNK)
+        buffer = buffer[position:] + chunk
+        position = 0
+        eof = not chunk
+
+    while True:
+        # Пропуск пробелов и разделителей между объектами
+        while True:
+            while position < len(buffer) and buffer[position] in " \t\r\n,[]":
+                char = buffer[position]
+                if char == "\n":
+                    line += 1
+                elif char == "[" and in_array is None:
+                    in_array = True
+                position += 1
+            if position < len(buffer) or eof:
+                break
+            fill()
+        if position >= len(buffer):
+            return
+        if in_array is None:
+            in_array = False
+
+        # Объект может не поместиться в прочитанную часть - дочитываем
+        while True:
+            try:
+                record, end = decoder.raw_decode(buffer, position)
+                break
+            except json.JSONDecodeError as e:
+                if eof:
+                    yield line, RowError(f"некорректный JSON: {e.msg}")
+                    return
+                fill()
+        yield line, record
+        line += buffer.count("\n", position, end)
+        position = end
+
+
+def parse_record(record, default_city, cities, types):
+    """Проверяет запись файла и возвращает кортеж для SQL.import_dots:
+    (city, name_dot, type_dot, address, lat, lon, photo_id)"""
+    if not isinstance(record, dict):
+        raise RowError("ожидается объект с полями")
+    record = {str(key).strip().lower(): value for key, value in record.items() if key is not None}
+    for field in TEXT_FIELDS:
+        value = record.get(field)
+        if isinstance(value, (dict, list)):
+            raise RowError(f"поле {field} должно быть строкой")
+        if isinstance(value, str) and "\ufffd" in value:
+            raise RowError(f"поле {field}: файл не в кодировке UTF-8")
+
+    name = normalize_text(record.get("name"))
+    if not name:
+        raise RowError("не указано название (name)")
+    if len(name) > NAME_LIMIT:
+        raise RowError(f"название длиннее {NAME_LIMIT} символов")
+
+    try:
+        type_dot = int(str(record.get("type")).strip())
+    except ValueError:
+        raise RowError(f"тип (type) должен быть числом: {record.get('type')!r}") from None
+    if type_dot not in types:
+        raise RowError(f"неизвестный тип: {type_dot}")
+
+    address = normalize_text(record.get("address"))
+    if address and len(address) > ADDRESS_LIMIT:
+        raise RowError(f"адрес длиннее {ADDRESS_LIMIT} символов")
+
+    city = normalize_text(record.get("city")) or default_city
+    if city not in cities:
+        raise RowError(f"неизвестный город: {city}")
+
+    lat, lon = record.get("lat"), record.get("lon")
+    if lat in (None, "") and lon in (None, ""):
+        lat = lon = None
+    else:
+        try:
+            lat, lon = float(lat), float(lon)
+        except (TypeError, ValueError):
+            raise RowError("координаты (lat, lon) должны быть числами") from None
+        if not (-90 <= lat <= 90 and -180 <= lon <= 180):
+            raise RowError("координаты вне допустимого диапазона")
+
+    photo_id = normalize_text(record.get("photo_id"))
+    return city, name, type_dot, address, lat, lon, photo_id
+
+
+def read_places(path, file_format, default_city, cities, types):
+    """Потоково читает файл и выдает (номер строки, кортеж места или RowError)"""
+    # Байты не в UTF-8 заменяются на U+FFFD: ошибкой становится только их строка
+    with open(path, encoding="utf-8-sig", errors="replace", newline="") as file:
+        records = _read_csv(file) if file_format == "csv" else _read_json(file)
+        for line, record in records:
+            if isinstance(record, RowError):
+                yield line, record
+                continue
+            try:
+                place = parse_record(record, default_city, cities, types)
+            except RowError as e:
+                place = e
+            except Exception as e:
+                # Одна испорченная строка не прерывает импорт остальных
+                place = RowError(f"некорректная строка: {e}")
+            yield line, place
+
+
+# ==================== ЗАПИСЬ ====================
+def write_places(rows, path, file_format):
+    """Пишет строки SQL.iter_dots_export в файл. Возвращает количество мест"""
+    count = 0
+    # utf-8-sig: Excel открывает такой CSV с кириллицей без вопросов о кодировке
+    encoding = "utf-8-sig" if file_format == "csv" else "utf-8"
+    with open(path, "w", encoding=encoding, newline="") as file:
+        if file_format == "csv":
+            writer = csv.writer(file)
+            writer.writerow(EXPORT_FIELDS)
+            for row in rows:
+                writer.writerow(row)
+                count += 1
+        else:
+            for row in rows:
+                file.write(json.dumps(dict(zip(EXPORT_FIELDS, row)), ensure_ascii=False))
+                file.write("\n")
+                count += 1
+    return count
+
+
+def write_errors(errors, path):
+    """Отчет об ошибках импорта: CSV со строкой файла и причиной"""
+    with open(path, "w", encoding="utf-8-sig", newline="") as file:
+        writer = csv.writer(file)
+        writer.writerow(("line", "error"))
+        writer.writerows(errors)
+
+
+def export_places(database, path, file_format, city=None):
+    """Выгружает каталог (или места одного города) в файл через отдельное
+    соединение только для чтения. Выполняется в потоке, а не в event loop"""
+    from base import SQL
+
+    db = SQL(database, readonly=True)
+    try:
+        return write_places(db.iter_dots_export(city), path, file_format)
+    finally:
+        db.close()
@@ -1,2 +1,33 @@
 TOKEN = "{ваш токен}"
 
+# Режим получения обновлений: "polling" или "webhook"
+MODE = "polling"
+
+# Настройки webhook (используются только в режиме "webhook")
+WEBHOOK_URL = "https://example.com/webhook"  # Публичный HTTPS-адрес, который вызывает Telegram
+WEBHOOK_PATH = "/webhook"                    # Путь, который слушает локальный сервер
+WEBHOOK_SECRET = "{секретная строка}"        # 1-256 символов: A-Z, a-z, 0-9, _ и -
+WEBAPP_HOST = "0.0.0.0"
+WEBAPP_PORT = 8080
+WEBHOOK_QUEUE_SIZE = 1000  # Сколько принятых обновлений может ждать обработки
+WEBHOOK_WORKERS = 32       # Сколько обновлений обрабатывается одновременно
+
+# Многопроцессный режим (python workers.py): сколько процессов-обработчиков
+# запускать. Обновления одного пользователя всегда попадают в один процесс.
+WORKER_PROCESSES = 4
+WORKER_QUEUE_SIZE = 1000  # Сколько обновлений может ждать каждый процесс
+
+# Метрики Prometheus: http://METRICS_HOST:METRICS_PORT/metrics (None - выключены).
+# В многопроцессном режиме обработчик N слушает порт METRICS_PORT + N.
+METRICS_HOST = "0.0.0.0"
+METRICS_PORT = 9100
+
+# Логи: файл с ротацией по размеру (в многопроцессном режиме у каждого
+# обработчика свой файл: bot_debug.worker-N.log)
+LOG_FILE = "bot_debug.log"
+LOG_MAX_BYTES = 10 * 1024 * 1024
+LOG_BACKUP_COUNT = 5
+# Частые сообщения (на каждое обновление): не больше LOG_SAMPLE_RATE в секунду
+# каждого вида после первых LOG_SAMPLE_BURST, остальные отбрасываются
+LOG_SAMPLE_RATE = 5
+LOG_SAMPLE_BURST = 20
@@ -0,0 +1,155 @@
+import asyncio
+import heapq
+import logging
+import time
+
+logger = logging.getLogger(__name__)
+
+
+class DeletionScheduler:
+    """Отложенное удаление сообщений (временные подсказки бота).
+
+    Все запланированные удаления лежат в одной куче по времени удаления, и их
+    выполняет одна задача: она спит до ближайшего срока, забирает все
+    наступившие удаления и удаляет сообщения каждого чата одним запросом
+    deleteMessages (до batch_size штук). Новые удаления раз в flush_interval
+    секунд одной транзакцией пишутся в таблицу pending_deletions, поэтому
+    после перезапуска бота подсказки всё равно удаляются. Удаления, которые
+    успели выполниться до записи, в БД не попадают вовсе.
+    """
+
+    def __init__(self, db, delete, flush_interval=2.0, batch_size=100,
+                 max_age=47 * 3600, owns=None):
+        self._db = db
+        self._delete = delete  # async delete(chat_id, [message_id, ...])
+        self.flush_interval = flush_interval
+        self.batch_size = batch_size
+        # Telegram не дает удалять сообщения старше 48 часов
+        self.max_age = max_age
+        # Какие чаты обслуживает этот процесс (в многопроцессном режиме)
+        self.owns = owns
+        self._heap = []  # (время удаления, chat_id, message_id)
+        self._added = {}  # ещё не записанные в БД: (chat_id, message_id) -> время
+        self._done = []  # выполненные, которые нужно убрать из БД
+        self._wakeup = asyncio.Event()
+        self._tasks = []
+        self.deleted = 0
+        self.failed = 0
+        self.batches = 0
+
+    # ---------- Жизненный цикл ----------
+    async def start(self):
+        """Загружает удаления, не выполненные до перезапуска, и запускает задачи"""
+        expired = time.time() - self.max_age
+        loaded = 0
+        for chat_id, message_id, due in await self._db.get_pending_deletions():
+            if self.owns is not None and not self.owns(chat_id):
+                continue
+            if due < expired:
+                self._done.append((chat_id, message_id))
+                continue
+            heapq.heappush(self._heap, (due, chat_id, message_id))
+            loaded += 1
+        if loaded:
+            logger.info(f"Загружено отложенных удалений: {loaded}")
+        if not self._tasks:
+            self._tasks = [asyncio.create_task(self._run()),
+                           asyncio.create_task(self._run_flush())]
+
+    async def stop(self):
+        """Останавливает задачи; невыполненные удаления остаются в БД"""
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+        await self.flush()
+
+    # ---------- Планирование ----------
+    def schedule(self, chat_id, message_id, delay):
+        """Удалить сообщение через delay секунд"""
+        due = time.time() + delay
+        if not self._heap or due < self._heap[0][0]:
+            # Новый ближайший срок - разбудить задачу, чтобы она пересчитала сон
+            self._wakeup.set()
+        heapq.heappush(self._heap, (due, chat_id, message_id))
+        self._added[(chat_id, message_id)] = due
+
+    def stats(self):
+        """Размер очереди и счетчики"""
+        return {
+            "pending": len(self._heap),
+            "unsaved": len(self._added),
+            "deleted": self.deleted,
+            "failed": self.failed,
+            "batches": self.batches,
+        }
+
+    def __len__(self):
+        return len(self._heap)
+
+    # ---------- Выполнение ----------
+    async def _run(self):
+        while True:
+            self._wakeup.clear()
+            timeout = self._heap[0][0] - time.time() if self._heap else None
+            if timeout is None or timeout > 0:
+                try:
+                    await asyncio.wait_for(self._wakeup.wait(), timeout)
+                except asyncio.TimeoutError:
+                    pass
+                continue
+
+            # Все наступившие удаления, сгруппированные по чатам
+            now = time.time()
+            chats = {}
+            while self._heap and self._heap[0][0] <= now:
+                _, chat_id, message_id = heapq.heappop(self._heap)
+                chats.setdefault(chat_id, []).append(message_id)
+
+            await asyncio.gather(*(
+                self._delete_batch(chat_id, message_ids[i:i + self.batch_size])
+                for chat_id, message_ids in chats.items()
+                for i in range(0, len(message_ids), self.batch_size)
+            ))
+
+    async def _delete_batch(self, chat_id, message_ids):
+        self.batches += 1
+        try:
+            await self._delete(chat_id, message_ids)
+            self.deleted += len(message_ids)
+        except asyncio.CancelledError:
+            # Остановка бота: удаление выполнится после перезапуска
+            for message_id in message_ids:
+                heapq.heappush(self._heap, (time.time(), chat_id, message_id))
+            raise
+        except Exception as e:
+            # Сообщения уже удалены пользователем или слишком старые - не повторяем
+            self.failed += len(message_ids)
+            logger.debug(f"Не удалось удалить сообщения {message_ids} в чате {chat_id}: {e}")
+        for message_id in message_ids:
+            key = (chat_id, message_id)
+            if self._added.pop(key, None) is None:
+                self._done.append(key)
+
+    # ---------- Сброс в БД ----------
+    async def flush(self):
+        """Записывает новые удаления и убирает выполненные"""
+        added, self._added = self._added, {}
+        done, self._done = self._done, []
+        if not added and not done:
+            return
+        try:
+            await self._db.save_pending_deletions(
+                [(chat_id, message_id, due) for (chat_id, message_id), due in added.items()],
+                done
+            )
+        except Exception as e:
+            logger.error(f"Не удалось сохранить отложенные удаления: {e}")
+            # Повторим при следующем сбросе
+            self._added = {**added, **self._added}
+            self._done = done + self._done
+
+    async def _run_flush(self):
+        while True:
+            await asyncio.sleep(self.flush_interval)
+            await self.flush()
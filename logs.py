@@ -0,0 +1,97 @@
+import atexit
+import logging
+import logging.handlers
+import queue
+import threading
+import time
+
+FORMAT = '%(asctime)s - %(name)s - %(levelname)s - %(message)s'
+
+
+class DeferredQueueHandler(logging.handlers.QueueHandler):
+    """QueueHandler, который не форматирует запись в вызывающем потоке.
+
+    Стандартный QueueHandler.prepare сразу собирает текст сообщения - то есть
+    в event loop. Очередь здесь внутри процесса, поэтому запись передается
+    как есть, и сообщение форматируется в потоке QueueListener.
+    """
+
+    def prepare(self, record):
+        return record
+
+
+class SamplingFilter(logging.Filter):
+    """Ограничивает частоту однотипных сообщений.
+
+    Однотипные - с одинаковым шаблоном (record.msg), поэтому сообщения должны
+    форматироваться лениво: logger.info("Кнопка от %s", name). Каждому шаблону
+    разрешено burst сообщений сразу и rate в секунду дальше; остальные
+    отбрасываются, а их количество дописывается к следующему пропущенному
+    сообщению. Предупреждения и ошибки проходят всегда.
+    """
+
+    def __init__(self, rate=5.0, burst=20):
+        super().__init__()
+        self.rate = rate
+        self.burst = burst
+        self._buckets = {}  # шаблон -> [токены, время обновления, отброшено]
+        self._lock = threading.Lock()
+        self.dropped = 0
+
+    def filter(self, record):
+        if record.levelno >= logging.WARNING:
+            return True
+        now = time.monotonic()
+        with self._lock:
+            bucket = self._buckets.get(record.msg)
+            if bucket is None:
+                bucket = self._buckets[record.msg] = [self.burst, now, 0]
+            tokens = min(self.burst, bucket[0] + (now - bucket[1]) * self.rate)
+            bucket[1] = now
+            if tokens < 1:
+                bucket[0] = tokens
+                bucket[2] += 1
+                self.dropped += 1
+                return False
+            bucket[0] = tokens - 1
+            skipped, bucket[2] = bucket[2], 0
+        if skipped:
+            record.msg = f"{record.msg} [пропущено похожих: {skipped}]"
+        return True
+
+
+def setup_logging(path, level=logging.INFO, max_bytes=10 * 1024 * 1024, backup_count=5):
+    """Логирование через очередь: обработчики получают только запись в очередь,
+    а файл (с ротацией по размеру) и консоль пишет фоновый поток.
+
+    Возвращает QueueListener; он останавливается при выходе из процесса,
+    дописав оставшиеся записи.
+    """
+    formatter = logging.Formatter(FORMAT)
+    file_handler = logging.handlers.RotatingFileHandler(
+        path, maxBytes=max_bytes, backupCount=backup_count, encoding='utf-8'
+    )
+    stream_handler = logging.StreamHandler()
+    for handler in (file_handler, stream_handler):
+        handler.setFormatter(formatter)
+
+    records = queue.SimpleQueue()
+    listener = logging.handlers.QueueListener(records, file_handler, stream_handler,
+                                              respect_handler_level=True)
+    root = logging.getLogger()
+    root.setLevel(level)
+    for handler in root.handlers[:]:
+        root.removeHandler(handler)
+    root.addHandler(DeferredQueueHandler(records))
+
+    listener.start()
+    atexit.register(listener.stop)
+    return listener
+
+
+def sampled_logger(name, rate=5.0, burst=20):
+    """Логгер для частых сообщений (на каждое обновление) с SamplingFilter"""
+    logger = logging.getLogger(name)
+    if not any(isinstance(f, SamplingFilter) for f in logger.filters):
+        logger.addFilter(SamplingFilter(rate, burst))
+    return logger
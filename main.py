@@ -1,9 +1,26 @@
 import config
 import logging
 import asyncio
+import multiprocessing
+import os
+import tempfile
+import time
 from aiogram import Bot, Dispatcher
-from aiogram.types import InlineKeyboardMarkup, InlineKeyboardButton
-from base import SQL
+from aiogram.client.session.middlewares.base import BaseRequestMiddleware
+from aiogram.types import (InlineKeyboardMarkup, InlineKeyboardButton,
+                           ReplyKeyboardMarkup, KeyboardButton, FSInputFile,
+                           InputMediaPhoto)
+from base import AsyncSQL
+from callbacks import CallbackRouter, STALE, FORBIDDEN
+from sender import SendScheduler
+from cache import CardCache, UserCache
+from state import StateStore
+from deleter import DeletionScheduler
+from recommend import Recommender
+from webhook import WebhookServer
+import catalog
+import metrics
+import logs
 
 # ==================== КОНСТАНТЫ ====================
 ADMIN_STATUS = {
@@ -11,15 +28,39 @@ ADMIN_STATUS = {
     "ADD_TYPE": 2,      # Добавление типа места
     "ADD_ADDRESS": 3,   # Новый шаг
     "ADD_PHOTO": 4,     # Фото теперь 4-й
+    "ADD_LOCATION": 5,  # Геопозиция (между адресом и фото)
+    "IMPORT": 6,        # Ожидание файла CSV/JSON с местами
     "EDIT_NAME": 101,   # Изменение названия
-    "EDIT_TYPE": 102    # Изменение типа
+    "EDIT_TYPE": 102,   # Изменение типа
+    "EDIT_LOCATION": 103,  # Изменение геопозиции
+    "EDIT_PHOTOS": 104     # Добавление фото в галерею
 }
 
 USER_STATUS = {
     "ADD_REVIEW": 201,  # Ввод отзыва
-    "ADD_RATING": 202   # Ввод оценки
+    "ADD_RATING": 202,  # Ввод оценки
+    "SEARCH": 203       # Ввод поискового запроса
 }
 
+PLACES_PAGE_SIZE = 5  # Мест на одной странице списка
+MEDIA_GROUP_SIZE = 10  # Больше фото в одну медиагруппу Telegram не принимает
+PLACE_PHOTOS_LIMIT = 10  # Фото в галерее места: вся галерея - одна медиагруппа
+MESSAGE_LIMIT = 4096  # Предел длины текста сообщения в Telegram
+REVIEWS_PAGE_SIZE = 5  # Отзывов на одной странице
+REVIEW_TEXT_LIMIT = 600  # Длинные отзывы обрезаются по границе слова
+SEARCH_RESULTS_LIMIT = 10  # Сколько лучших результатов поиска показывать
+NEARBY_LIMIT = 5  # Сколько ближайших мест показывать
+NEARBY_MAX_KM = 50  # Места дальше не считаются "рядом"
+TOP_LIMIT = 10  # Сколько мест в рейтинге лучших
+RECOMMEND_LIMIT = 10  # Сколько мест рекомендовать
+
+CITIES = {
+    "krasnoyarsk": "Красноярск",
+    "novosibirsk": "Новосибирск",
+    "irkutsk": "Иркутск"
+}
+DEFAULT_CITY = "krasnoyarsk"  # Город пользователей, которые его не выбирали
+
 PLACE_TYPES = {
     1: "🏨 Отель",
     2: "☕ Кафе",
@@ -30,88 +71,456 @@ PLACE_TYPES = {
 
 # ==================== НАСТРОЙКА ЛОГГИРОВАНИЯ ====================
 def setup_logging():
-    """Настройка логирования"""
-    logging.basicConfig(
-        level=logging.INFO,
-        format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
-        handlers=[
-            logging.FileHandler('bot_debug.log', encoding='utf-8'),
-            logging.StreamHandler()
-        ]
-    )
-    return logging.getLogger(__name__)
+    """Настройка логирования: файл и консоль пишет фоновый поток (см. logs.py)"""
+    path = config.LOG_FILE
+    process = multiprocessing.current_process().name
+    if process != "MainProcess":
+        # Процессы-обработчики (workers.py) ротируют каждый свой файл
+        base, ext = os.path.splitext(path)
+        path = f"{base}.{process}{ext}"
+    logs.setup_logging(path, max_bytes=config.LOG_MAX_BYTES, backup_count=config.LOG_BACKUP_COUNT)
 
-logger = setup_logging()
+logger = logging.getLogger(__name__)
+# Сообщения на каждое обновление: ленивое форматирование и ограничение частоты
+updates_logger = logs.sampled_logger(f"{__name__}.updates", rate=config.LOG_SAMPLE_RATE,
+                                     burst=config.LOG_SAMPLE_BURST)
 
 # ==================== ИНИЦИАЛИЗАЦИЯ ====================
-db = SQL('db.db')
-db.init_tables()
-bot = Bot(token=config.TOKEN)
+# При импорте создаются только объекты в памяти, к которым привязываются обработчики.
+# Модуль импортируют и дочерние процессы: spawn (пул Recommender) выполняет main.py
+# заново как __mp_main__, поэтому логи, БД и бот создаются в init(), а не здесь.
 dp = Dispatcher()
-user_sessions = {}  # Временные данные пользователей
+actions = CallbackRouter()  # Действия кнопок: код в callback_data -> обработчик
+cards = CardCache(maxsize=5000)  # Отрисованные карточки мест (текст и кнопки)
+sender = SendScheduler(global_rate=25, chat_rate=1, chat_burst=3)
+db = users = states = recommender = deleter = bot = None
 
-logger.info("Бот инициализирован")
+def init():
+    """Логирование, соединения с БД и бот - один раз в процессе, который запускает бота"""
+    global db, users, states, recommender, deleter, bot
+    if db is not None:
+        return
+    setup_logging()
+    db = AsyncSQL('db.db', batch_latency=0.003, batch_size=64)  # Записи объединяются в пачки
+    users = UserCache(db, maxsize=10000, default_city=DEFAULT_CITY)  # Профили (is_admin, city)
+    states = StateStore(db, ttl=1800, flush_interval=2.0)  # Статусы и данные диалогов
+    recommender = Recommender(db, rebuild_interval=3600, rebuild_changes=200)  # Модель - в отдельном процессе
+    deleter = DeletionScheduler(db, lambda chat_id, message_ids: delete_messages(chat_id, message_ids))
+    bot = Bot(token=config.TOKEN)
+    bot.session.middleware(TelegramMetrics())
+    logger.info("Бот инициализирован")
 
-# ==================== ВСПОМОГАТЕЛЬНЫЕ ФУНКЦИИ ====================
-async def delete_message_after(message, delay: int = 5) -> None:
-    """Удаляет сообщение через указанное время"""
+# ==================== МЕТРИКИ ====================
+HANDLER_SECONDS = metrics.REGISTRY.histogram(
+    "bot_handler_seconds", "Время обработки обновления", ("handler",))
+HANDLER_ERRORS = metrics.REGISTRY.counter(
+    "bot_handler_errors_total", "Ошибки обработки обновлений", ("handler",))
+TELEGRAM_SECONDS = metrics.REGISTRY.histogram(
+    "bot_telegram_request_seconds", "Время запроса к Bot API", ("method",))
+TELEGRAM_ERRORS = metrics.REGISTRY.counter(
+    "bot_telegram_errors_total", "Ошибки запросов к Bot API", ("method", "error"))
+metrics.REGISTRY.gauge("bot_send_queue_depth", "Запросов в очереди отправки",
+                       lambda: sender.stats()["depth"])
+metrics.REGISTRY.gauge("bot_pending_deletions", "Сообщений, ожидающих удаления",
+                       lambda: len(deleter))
+metrics.REGISTRY.gauge("bot_dialog_states", "Состояний диалогов в памяти",
+                       lambda: len(states))
+metrics.REGISTRY.gauge("bot_user_cache_size", "Профилей в кэше пользователей",
+                       lambda: len(users))
+
+STATUS_NAMES = {code: name for name, code in {**ADMIN_STATUS, **USER_STATUS}.items()}
+metrics_server = None
+
+def callback_handler_name(callback_data: str) -> str:
+    """Имя обработчика кнопки для метрик: имя действия без его данных"""
+    return "callback:" + actions.action_name(callback_data)
+
+async def observe_handler(name: str, handler, event, data):
+    started = time.perf_counter()
     try:
-        await asyncio.sleep(delay)
-        await message.delete()
-    except Exception as e:
-        logger.debug(f"Не удалось удалить сообщение: {e}")
+        return await handler(event, data)
+    except Exception:
+        HANDLER_ERRORS.inc(name)
+        raise
+    finally:
+        HANDLER_SECONDS.observe(time.perf_counter() - started, name)
+
+@dp.message.outer_middleware()
+async def message_metrics(handler, message, data):
+    """Время обработки сообщения по статусу диалога пользователя"""
+    state = await states.get(message.from_user.id)
+    name = "message:" + STATUS_NAMES.get(state.status, "MENU")
+    return await observe_handler(name, handler, message, data)
+
+@dp.callback_query.outer_middleware()
+async def callback_metrics(handler, call, data):
+    """Время обработки нажатия кнопки по действию"""
+    return await observe_handler(callback_handler_name(call.data), handler, call, data)
+
+class TelegramMetrics(BaseRequestMiddleware):
+    """Время и ошибки запросов к Bot API по методам"""
+    
+    async def __call__(self, make_request, bot, method):
+        name = type(method).__name__
+        started = time.perf_counter()
+        try:
+            return await make_request(bot, method)
+        except Exception as e:
+            TELEGRAM_ERRORS.inc(name, type(e).__name__)
+            raise
+        finally:
+            TELEGRAM_SECONDS.observe(time.perf_counter() - started, name)
+
+# ==================== ОТПРАВКА СООБЩЕНИЙ ====================
+# Все запросы к Telegram идут через очередь sender с лимитами на бота и на чат.
+# Если запрос устарел (ttl) и был выброшен, функции возвращают None.
+CALLBACK_ANSWER_TTL = 10  # Telegram ждёт ответ на кнопку не дольше 15 секунд
+
+async def send_text(message, text: str, reply_markup=None, key=None, ttl=None):
+    """Отправляет текст в чат сообщения"""
+    return await sender.send(
+        message.chat.id,
+        lambda: message.answer(text, reply_markup=reply_markup),
+        key=key, ttl=ttl
+    )
+
+async def send_photo(message, photo, caption: str = None, reply_markup=None):
+    """Отправляет фото в чат сообщения"""
+    return await sender.send(
+        message.chat.id,
+        lambda: message.answer_photo(photo=photo, caption=caption, reply_markup=reply_markup)
+    )
+
+async def send_media_group(message, media):
+    """Отправляет от 2 до MEDIA_GROUP_SIZE фото одним запросом"""
+    return await sender.send(message.chat.id, lambda: message.answer_media_group(media))
+
+async def edit_text(message, text: str, reply_markup=None):
+    """Редактирует сообщение; частые правки одного сообщения схлопываются в последнюю"""
+    return await sender.send(
+        message.chat.id,
+        lambda: message.edit_text(text, reply_markup=reply_markup),
+        key=("edit", message.message_id)
+    )
+
+async def send_document(message, path: str, filename: str, caption: str = None):
+    """Отправляет файл в чат сообщения"""
+    return await sender.send(
+        message.chat.id,
+        lambda: message.answer_document(FSInputFile(path, filename=filename), caption=caption)
+    )
+
+async def delete_message(message):
+    """Удаляет сообщение"""
+    return await sender.send(message.chat.id, message.delete,
+                             key=("delete", message.message_id))
+
+async def delete_message_by_id(chat_id: int, message_id: int):
+    """Удаляет сообщение по id"""
+    return await sender.send(chat_id, lambda: bot.delete_message(chat_id, message_id),
+                             key=("delete", message_id))
+
+async def delete_messages(chat_id: int, message_ids):
+    """Удаляет несколько сообщений чата одним запросом (не больше 100)"""
+    return await sender.send(chat_id, lambda: bot.delete_messages(chat_id, message_ids))
 
+async def answer_callback(call, text: str = None):
+    """Отвечает на нажатие кнопки (ограничивается только общим лимитом)"""
+    return await sender.send(None, lambda: call.answer(text), ttl=CALLBACK_ANSWER_TTL)
+
+# ==================== ВСПОМОГАТЕЛЬНЫЕ ФУНКЦИИ ====================
 async def send_temporary_message(context, text: str, delay: int = 3, 
                                  reply_markup=None):
     """Отправляет временное сообщение с автоматическим удалением"""
-    if hasattr(context, 'message'):
-        sent_msg = await context.message.answer(text, reply_markup=reply_markup)
-    else:
-        sent_msg = await context.answer(text, reply_markup=reply_markup)
+    message = context.message if hasattr(context, 'message') else context
+    # Подсказка, которая не успела уйти до своего удаления, уже не нужна
+    sent_msg = await send_text(message, text, reply_markup=reply_markup, ttl=delay)
     
-    asyncio.create_task(delete_message_after(sent_msg, delay))
+    if sent_msg:
+        deleter.schedule(sent_msg.chat.id, sent_msg.message_id, delay)
     return sent_msg
 
+def shorten_text(text: str, limit: int) -> str:
+    """Обрезает текст до limit символов по границе слова"""
+    if not text or len(text) <= limit:
+        return text or ""
+    cut = text.rfind(" ", 0, limit)
+    return text[:cut if cut > 0 else limit].rstrip() + "…"
+
 def get_place_type_name(type_id: int) -> str:
     """Возвращает читаемое название типа места"""
     return PLACE_TYPES.get(type_id, f"📋 Тип {type_id}")
 
-def get_user_session(user_id: int) -> dict:
-    """Возвращает или создает сессию пользователя"""
-    if user_id not in user_sessions:
-        user_sessions[user_id] = {}
-    return user_sessions[user_id]
-
 # ==================== КЛАВИАТУРЫ ====================
 def create_admin_keyboard() -> InlineKeyboardMarkup:
     """Создает клавиатуру для администратора"""
     return InlineKeyboardMarkup(inline_keyboard=[
-        [InlineKeyboardButton(text="➕ Добавить место", callback_data="add_place")],
-        [InlineKeyboardButton(text="⚙️ Управлять местами", callback_data="manage_places")],
-        [InlineKeyboardButton(text="📍 Места в Красноярске", callback_data="places_list")],
-        [InlineKeyboardButton(text="⭐ Мои места", callback_data="my_places")],
-        [InlineKeyboardButton(text="❤️ Избранные", callback_data="favorites")]
+        [InlineKeyboardButton(text="➕ Добавить место", callback_data=actions.pack("add_place"))],
+        [InlineKeyboardButton(text="⚙️ Управлять местами", callback_data=actions.pack("manage_places"))],
+        [InlineKeyboardButton(text="📥 Импорт мест", callback_data=actions.pack("import_places")),
+         InlineKeyboardButton(text="📤 Экспорт мест", callback_data=actions.pack("export_places"))],
+        [InlineKeyboardButton(text="📍 Места в городе", callback_data=actions.pack("places_list"))],
+        [InlineKeyboardButton(text="🔎 Поиск", callback_data=actions.pack("search"))],
+        [InlineKeyboardButton(text="🧭 Рядом со мной", callback_data=actions.pack("nearby"))],
+        [InlineKeyboardButton(text="🏆 Лучшие места", callback_data=actions.pack("top"))],
+        [InlineKeyboardButton(text="✨ Рекомендуем вам", callback_data=actions.pack("recommend"))],
+        [InlineKeyboardButton(text="⭐ Мои места", callback_data=actions.pack("my_places"))],
+        [InlineKeyboardButton(text="❤️ Избранные", callback_data=actions.pack("favorites"))],
+        [InlineKeyboardButton(text="🏙️ Сменить город", callback_data=actions.pack("choose_city"))]
     ])
 
 def create_user_keyboard() -> InlineKeyboardMarkup:
     """Создает клавиатуру для обычного пользователя"""
     return InlineKeyboardMarkup(inline_keyboard=[
-        [InlineKeyboardButton(text="📍 Места в Красноярске", callback_data="places_list")],
-        [InlineKeyboardButton(text="⭐ Мои места", callback_data="my_places")],
-        [InlineKeyboardButton(text="❤️ Избранные", callback_data="favorites")]
+        [InlineKeyboardButton(text="📍 Места в городе", callback_data=actions.pack("places_list"))],
+        [InlineKeyboardButton(text="🔎 Поиск", callback_data=actions.pack("search"))],
+        [InlineKeyboardButton(text="🧭 Рядом со мной", callback_data=actions.pack("nearby"))],
+        [InlineKeyboardButton(text="🏆 Лучшие места", callback_data=actions.pack("top"))],
+        [InlineKeyboardButton(text="✨ Рекомендуем вам", callback_data=actions.pack("recommend"))],
+        [InlineKeyboardButton(text="⭐ Мои места", callback_data=actions.pack("my_places"))],
+        [InlineKeyboardButton(text="❤️ Избранные", callback_data=actions.pack("favorites"))],
+        [InlineKeyboardButton(text="🏙️ Сменить город", callback_data=actions.pack("choose_city"))]
     ])
 
-def create_place_management_keyboard(place_id: int, is_favorite: bool = False) -> InlineKeyboardMarkup:
-    """Создает клавиатуру для управления конкретным местом"""
-    fav_text = "💔 Убрать" if is_favorite else "❤️ В избранное"
-    fav_callback = f"remove_fav_{place_id}" if is_favorite else f"add_fav_{place_id}"
-    
+def create_city_keyboard(current_city: str) -> InlineKeyboardMarkup:
+    """Создает клавиатуру выбора города"""
+    return InlineKeyboardMarkup(inline_keyboard=[
+        [InlineKeyboardButton(text=f"✅ {name}" if code == current_city else name,
+                              callback_data=actions.pack("set_city", code))]
+        for code, name in CITIES.items()
+    ])
+
+def create_top_types_keyboard() -> InlineKeyboardMarkup:
+    """Создает клавиатуру выбора типа мест для рейтинга"""
     return InlineKeyboardMarkup(inline_keyboard=[
-        [InlineKeyboardButton(text=fav_text, callback_data=fav_callback)],
-        [InlineKeyboardButton(text="✅ Посетил", callback_data=f"visited_{place_id}")],
-        [InlineKeyboardButton(text="💬 Отзывы", callback_data=f"reviews_{place_id}")]
+        [InlineKeyboardButton(text=name, callback_data=actions.pack("top_type", type_id))]
+        for type_id, name in PLACE_TYPES.items()
     ])
 
+def create_location_request_keyboard() -> ReplyKeyboardMarkup:
+    """Создает клавиатуру с кнопкой отправки геопозиции"""
+    return ReplyKeyboardMarkup(
+        keyboard=[[KeyboardButton(text="📍 Отправить геопозицию", request_location=True)]],
+        resize_keyboard=True,
+        one_time_keyboard=True
+    )
+
+def get_city_name(city: str) -> str:
+    """Возвращает читаемое название города"""
+    return CITIES.get(city, city)
+
+def render_place_buttons(place_id: int, reviews_count: int, photos_count: int = 0):
+    """Кнопки карточки места: пара кнопок избранного (добавить, убрать)
+    и остальные ряды, одинаковые для всех пользователей"""
+    fav_buttons = (
+        InlineKeyboardButton(text="❤️ В избранное", callback_data=actions.pack("add_favorite", place_id)),
+        InlineKeyboardButton(text="💔 Убрать", callback_data=actions.pack("remove_favorite", place_id))
+    )
+    rows = [
+        [InlineKeyboardButton(text="✅ Посетил", callback_data=actions.pack("visited", place_id))],
+        [InlineKeyboardButton(text=f"💬 Отзывы ({reviews_count})", callback_data=actions.pack("reviews", place_id))]
+    ]
+    # Обложка уже в карточке, галерея нужна, только если фото несколько
+    if photos_count > 1:
+        rows.append([InlineKeyboardButton(text=f"🖼 Все фото ({photos_count})",
+                                          callback_data=actions.pack("photos", place_id))])
+    return fav_buttons, rows
+
+def format_distance(distance_km: float) -> str:
+    """Возвращает читаемое расстояние"""
+    if distance_km < 1:
+        return f"{round(distance_km * 1000)} м"
+    return f"{distance_km:.1f} км"
+
+def format_place_card(place) -> str:
+    """Формирует текст карточки места из строки SQL.get_dots_feed"""
+    name, place_type, address = place[1], place[2], place[4]
+    reviews_count, avg_rating = place[6], place[7]
+    
+    text = f"📝 {name}\n{get_place_type_name(place_type)}\n"
+    text += f"📫 Адрес: {address or '—'}\n"
+    if avg_rating:
+        text += f"⭐ Средняя оценка: {avg_rating:.1f}/5.0   "
+    text += f"💬 Отзывов: {reviews_count}\n"
+    return text
+
+def create_places_page(places, has_prev: bool, has_next: bool, city: str):
+    """Формирует текст и клавиатуру страницы списка мест"""
+    text = f"📍 Места — {get_city_name(city)}:\n\n"
+    buttons = []
+    
+    for idx, place in enumerate(places, 1):
+        text += f"{idx}. {place_card_text(place)}\n"
+        buttons.append([place_open_button(place, idx)])
+    
+    # Курсоры страниц - id первого и последнего места на текущей странице
+    nav = []
+    if has_prev:
+        nav.append(InlineKeyboardButton(text="⬅️ Назад", callback_data=actions.pack("places_page", False, places[0][0])))
+    if has_next:
+        nav.append(InlineKeyboardButton(text="Вперёд ➡️", callback_data=actions.pack("places_page", True, places[-1][0])))
+    if nav:
+        buttons.append(nav)
+    
+    return text, InlineKeyboardMarkup(inline_keyboard=buttons)
+
+def create_search_results(places, query: str):
+    """Формирует текст и клавиатуру результатов поиска"""
+    text = f"🔎 Результаты по запросу «{query}»:\n\n"
+    buttons = []
+    
+    for idx, place in enumerate(places, 1):
+        text += f"{idx}. {place_card_text(place)}\n"
+        buttons.append([place_open_button(place, idx)])
+    
+    return text, InlineKeyboardMarkup(inline_keyboard=buttons)
+
+def create_recommendations(places):
+    """Формирует текст и клавиатуру рекомендованных мест"""
+    text = "✨ Рекомендуем вам:\n\n"
+    buttons = []
+    
+    for idx, place in enumerate(places, 1):
+        text += f"{idx}. {place_card_text(place)}\n"
+        buttons.append([place_open_button(place, idx)])
+    
+    return text, InlineKeyboardMarkup(inline_keyboard=buttons)
+
+def create_nearby_results(nearest):
+    """Формирует текст и клавиатуру ближайших мест: nearest - список (место, км)"""
+    text = "🧭 Ближайшие места:\n\n"
+    buttons = []
+    
+    for idx, (place, distance) in enumerate(nearest, 1):
+        text += f"{idx}. 📏 {format_distance(distance)}\n{place_card_text(place)}\n"
+        buttons.append([InlineKeyboardButton(text=f"{idx}. {place[1]} ({format_distance(distance)})", 
+                                             callback_data=actions.pack("place", place[0]))])
+    
+    return text, InlineKeyboardMarkup(inline_keyboard=buttons)
+
+def render_list_buttons(place_id: int, reviews_count: int):
+    """Кнопки места в ряду списка карточек: пара кнопок избранного (добавить,
+    убрать), отзывы и пустой словарь кнопок открытия по номеру в списке"""
+    fav_buttons = (
+        InlineKeyboardButton(text="❤️", callback_data=actions.pack("add_favorite", place_id)),
+        InlineKeyboardButton(text="💔", callback_data=actions.pack("remove_favorite", place_id))
+    )
+    reviews_button = InlineKeyboardButton(text=f"💬 {reviews_count}", callback_data=actions.pack("reviews", place_id))
+    return fav_buttons, reviews_button, {}
+
+def render_place_card(place):
+    """Отрисовывает карточку места: текст, кнопки (см. render_place_buttons)
+    и кнопки для списков (см. render_list_buttons)"""
+    return (format_place_card(place), *render_place_buttons(place[0], place[6], place[9]),
+            render_list_buttons(place[0], place[6]))
+
+def get_place_card(place):
+    """Карточка места из кэша по id и версии (place[8]):
+    (текст, кнопки избранного, ряды, кнопки для списков)"""
+    return cards.get(place[0], place[8], render_place_card, place)
+
+def place_open_button(place, idx: int) -> InlineKeyboardButton:
+    """Кнопка "N. Название" из кэша карточки: создается один раз на номер"""
+    open_buttons = get_place_card(place)[3][2]
+    button = open_buttons.get(idx)
+    if button is None:
+        button = open_buttons[idx] = InlineKeyboardButton(text=f"{idx}. {place[1]}",
+                                                          callback_data=actions.pack("place", place[0]))
+    return button
+
+def place_card_text(place) -> str:
+    """Текст карточки места из кэша"""
+    return get_place_card(place)[0]
+
+def create_top_results(top, type_dot: int, city: str):
+    """Формирует текст и клавиатуру рейтинга: top - список (место, оценка)"""
+    text = f"🏆 Лучшие: {get_place_type_name(type_dot)} — {get_city_name(city)}\n\n"
+    buttons = []
+    
+    for idx, (place, score) in enumerate(top, 1):
+        text += f"{idx}. 🏆 {score:.2f}\n{place_card_text(place)}\n"
+        buttons.append([place_open_button(place, idx)])
+    buttons.append([InlineKeyboardButton(text="⬅️ Другой тип", callback_data=actions.pack("top"))])
+    
+    return text, InlineKeyboardMarkup(inline_keyboard=buttons)
+
+def create_cards_keyboard(places, start: int) -> InlineKeyboardMarkup:
+    """Клавиатура пачки карточек: по ряду на место - открыть карточку,
+    избранное и отзывы. Номера совпадают с номерами в подписях.
+    Кнопки берутся из кэша карточек, от пользователя зависит только выбор
+    кнопки избранного"""
+    buttons = []
+    for idx, place in enumerate(places, start):
+        fav_buttons, reviews_button, _ = get_place_card(place)[3]
+        buttons.append([place_open_button(place, idx), fav_buttons[bool(place[5])], reviews_button])
+    return InlineKeyboardMarkup(inline_keyboard=buttons)
+
+async def send_text_cards(message, places, start: int):
+    """Отправляет карточки текстом с номерами от start: не больше
+    MEDIA_GROUP_SIZE мест и MESSAGE_LIMIT символов в сообщении"""
+    batch, text = [], ""
+    for idx, place in enumerate(places, start):
+        card = f"{idx}. {place_card_text(place)}\n"
+        if batch and (len(batch) >= MEDIA_GROUP_SIZE or len(text) + len(card) > MESSAGE_LIMIT):
+            await send_text(message, text, reply_markup=create_cards_keyboard(batch, idx - len(batch)))
+            batch, text = [], ""
+        batch.append(place)
+        text += card
+    if batch:
+        await send_text(message, text,
+                        reply_markup=create_cards_keyboard(batch, start + len(places) - len(batch)))
+
+async def send_place_cards(message, places):
+    """Отправляет список карточек пачками: места с фото - медиагруппами до
+    MEDIA_GROUP_SIZE обложек с карточками в подписях, места без фото - общим
+    текстом. После каждой медиагруппы - сообщение с кнопками её мест
+    (у медиагруппы своих кнопок быть не может). Примерно 2 запроса на 10 мест
+    вместо 10"""
+    with_photo = [place for place in places if place[3]]
+    without_photo = [place for place in places if not place[3]]
+    
+    for i in range(0, len(with_photo), MEDIA_GROUP_SIZE):
+        batch = with_photo[i:i + MEDIA_GROUP_SIZE]
+        media = [InputMediaPhoto(media=place[3], caption=f"{idx}. {place_card_text(place)}")
+                 for idx, place in enumerate(batch, i + 1)]
+        try:
+            if len(media) == 1:
+                # В медиагруппе минимум 2 фото; одно фото уходит вместе с кнопками
+                await send_photo(message, media[0].media, caption=media[0].caption,
+                                 reply_markup=create_cards_keyboard(batch, i + 1))
+                continue
+            await send_media_group(message, media)
+        except Exception as e:
+            # Например, устаревший file_id: карточки пачки уходят текстом
+            logger.error(f"Ошибка отправки медиагруппы: {e}")
+            await send_text_cards(message, batch, i + 1)
+            continue
+        await send_text(message, f"👆 Места {i + 1}–{i + len(batch)}",
+                        reply_markup=create_cards_keyboard(batch, i + 1))
+    
+    await send_text_cards(message, without_photo, len(with_photo) + 1)
+
+async def send_place_card(call, place):
+    """Отправляет карточку места (с фото, если оно есть)"""
+    place_id, photo_id, is_fav = place[0], place[3], place[5]
+    message_text, fav_buttons, rows, _ = get_place_card(place)
+    # От пользователя зависит только кнопка избранного
+    keyboard = InlineKeyboardMarkup(inline_keyboard=[[fav_buttons[bool(is_fav)]]] + rows)
+    
+    try:
+        if photo_id:
+            await send_photo(
+                call.message,
+                photo=photo_id,
+                caption=message_text,
+                reply_markup=keyboard
+            )
+        else:
+            await send_text(call.message, message_text, reply_markup=keyboard)
+    except Exception as e:
+        logger.error(f"Ошибка отправки места {place_id}: {e}")
+        await send_text(call.message, message_text, reply_markup=keyboard)
+
 # ==================== ОБРАБОТКА СООБЩЕНИЙ ====================
 @dp.message()
 async def handle_message(message):
@@ -119,25 +528,59 @@ async def handle_message(message):
     user_id = message.from_user.id
     username = message.from_user.username or f"user_{user_id}"
     
-    # Регистрация пользователя
-    if not db.user_exist(user_id):
-        logger.info(f"Новый пользователь: {username}")
-        db.add_user(user_id)
-    
-    status = db.get_field("users", user_id, "status")
-    is_admin = db.get_field("users", user_id, "is_admin")
-    session = get_user_session(user_id)
+    # Регистрация пользователя (после первого сообщения - без запросов к БД)
+    profile = await users.get(user_id)
+    is_admin = profile.is_admin
+    state = await states.get(user_id)
+    status = state.status
+    session = state.data
     
     # Обработка фото для администратора
-    if message.photo and is_admin and status == ADMIN_STATUS["ADD_PHOTO"]:
-        await handle_admin_photo(message, user_id, username, session)
+    if message.photo and is_admin and status in (ADMIN_STATUS["ADD_PHOTO"], ADMIN_STATUS["EDIT_PHOTOS"]):
+        await handle_admin_photo(message, user_id, username, status, session)
+        return
+    
+    # Файл с местами для импорта; на остальные сообщения - подсказка
+    if is_admin and status == ADMIN_STATUS["IMPORT"]:
+        if message.document:
+            await handle_import(message, user_id, username, profile.city)
+        elif message.text and message.text.lower() in ['отмена', 'cancel', '/cancel']:
+            await states.reset(user_id)
+            await send_text(message, "Импорт отменён", reply_markup=create_admin_keyboard())
+        else:
+            await send_text(message, "📎 Пришлите файл .csv или .json с местами "
+                                     "(документом) или напишите 'отмена'")
+        return
+    
+    # Геопозиция: координаты места от администратора или поиск ближайших мест
+    if message.location:
+        if is_admin and status in (ADMIN_STATUS["ADD_LOCATION"], ADMIN_STATUS["EDIT_LOCATION"]):
+            await handle_admin_location(message, user_id, username, status, session)
+        else:
+            await handle_nearby(message, user_id)
         return
     
     # Обработка текстовых сообщений
     if not message.text:
         return
     
-    logger.info(f"Сообщение от {username}: {message.text[:50]}...")
+    updates_logger.info("Сообщение от %s: %.50s", username, message.text)
+    
+    # Поиск: команда /search <запрос> или текст после кнопки "Поиск"
+    if message.text.startswith("/search"):
+        query = message.text[len("/search"):].strip()
+        if query:
+            await handle_search(message, user_id, query)
+        else:
+            await states.set(user_id, USER_STATUS["SEARCH"])
+            await send_temporary_message(message, "🔎 Что ищем? Название, адрес или слово из отзыва:",
+                                         delay=10)
+        return
+    
+    if status == USER_STATUS["SEARCH"]:
+        await states.reset(user_id)
+        await handle_search(message, user_id, message.text)
+        return
     
     # Обработка статусов пользователя
     if status == USER_STATUS["ADD_REVIEW"]:
@@ -157,41 +600,145 @@ async def handle_message(message):
     await show_user_menu(message, user_id, session)
 
 # ==================== ОБРАБОТКА ФОТО АДМИНИСТРАТОРА ====================
-async def handle_admin_photo(message, user_id: int, username: str, session: dict):
-    """Обработка фото при добавлении места администратором"""
-    if "place_id" not in session:
-        await message.answer("⚠️ Сессия утеряна. Начните заново.", 
-                           reply_markup=create_admin_keyboard())
+async def handle_admin_photo(message, user_id: int, username: str,
+                             status: int, session: dict):
+    """Добавление фото в галерею места (при создании места или из управления)"""
+    key = "place_id" if status == ADMIN_STATUS["ADD_PHOTO"] else "edit_place_id"
+    if key not in session:
+        await send_text(message, "⚠️ Сессия утеряна. Начните заново.", 
+                        reply_markup=create_admin_keyboard())
         return
     
-    place_id = session["place_id"]
+    place_id = session[key]
     photo_file_id = message.photo[-1].file_id
     
     try:
-        db.update_dot_photo(place_id, photo_file_id)
-        logger.info(f"Админ {username} добавил фото к месту {place_id}")
-        await message.answer("✅ Фото успешно добавлено!", 
-                           reply_markup=create_admin_keyboard())
-        db.update_field("users", user_id, "status", 0)
-        del user_sessions[user_id]
+        count = await db.add_dot_photo(place_id, photo_file_id, limit=PLACE_PHOTOS_LIMIT)
+        logger.info(f"Админ {username} добавил фото к месту {place_id} (всего: {count})")
+        if count >= PLACE_PHOTOS_LIMIT:
+            await send_text(message, f"✅ В галерее {count} фото - это максимум",
+                            reply_markup=create_admin_keyboard())
+            await states.reset(user_id)
+        else:
+            # Альбом приходит отдельными сообщениями - подсказки удаляются сами
+            await send_temporary_message(message, f"✅ Фото добавлено ({count}/{PLACE_PHOTOS_LIMIT}). "
+                                                  "Пришлите ещё или напишите 'готово'", delay=10)
     except Exception as e:
         logger.error(f"Ошибка добавления фото: {e}")
-        await message.answer(f"❌ Ошибка: {str(e)}")
+        await send_text(message, f"❌ Ошибка: {str(e)}")
+
+# ==================== ИМПОРТ И ЭКСПОРТ МЕСТ ====================
+IMPORT_MAX_SIZE = 20 * 1024 * 1024  # Бот может скачать файл не больше 20 МБ
+
+def temp_path(suffix: str) -> str:
+    """Путь для временного файла (файл создает вызывающий)"""
+    handle, path = tempfile.mkstemp(suffix=suffix)
+    os.close(handle)
+    return path
+
+async def handle_import(message, user_id: int, username: str, city: str):
+    """Загрузка мест из файла CSV или JSON"""
+    document = message.document
+    file_format = catalog.detect_format(document.file_name)
+    if file_format is None:
+        await send_text(message, "⚠️ Пришлите файл .csv или .json")
+        return
+    if document.file_size and document.file_size > IMPORT_MAX_SIZE:
+        await send_text(message, "⚠️ Файл больше 20 МБ, разделите его на части")
+        return
+    
+    await states.reset(user_id)
+    path = temp_path("." + file_format)
+    errors_path = None
+    try:
+        await bot.download(document, destination=path)
+        # Файл читается потоково прямо во время вставки в БД
+        report = await db.import_dots(
+            catalog.read_places(path, file_format, city, set(CITIES), set(PLACE_TYPES))
+        )
+        logger.info(f"Админ {username} импортировал {document.file_name}: "
+                    f"добавлено {report['inserted']}, дублей {report['duplicates']}, "
+                    f"ошибок {report['failed']}")
+        text = (f"📥 Импорт {document.file_name}\n"
+                f"✅ Добавлено: {report['inserted']}\n"
+                f"🔁 Дубли пропущены: {report['duplicates']}\n"
+                f"❌ Строк с ошибками: {report['failed']}")
+        await send_text(message, text, reply_markup=create_admin_keyboard())
+        if report["errors"]:
+            errors_path = temp_path(".csv")
+            catalog.write_errors(report["errors"], errors_path)
+            await send_document(message, errors_path, "import_errors.csv",
+                                caption="Строки, которые не были добавлены")
+    except Exception as e:
+        logger.error(f"Ошибка импорта мест: {e}")
+        await send_text(message, f"❌ Ошибка импорта: {str(e)}",
+                        reply_markup=create_admin_keyboard())
+    finally:
+        for file_path in (path, errors_path):
+            if file_path:
+                os.remove(file_path)
+
+# ==================== ОБРАБОТКА ГЕОПОЗИЦИИ ====================
+async def handle_admin_location(message, user_id: int, username: str, 
+                                status: int, session: dict):
+    """Сохранение координат места администратором"""
+    key = "place_id" if status == ADMIN_STATUS["ADD_LOCATION"] else "edit_place_id"
+    if key not in session:
+        await send_text(message, "⚠️ Сессия утеряна. Начните заново.", 
+                        reply_markup=create_admin_keyboard())
+        return
+    
+    place_id = session[key]
+    location = message.location
+    
+    try:
+        await db.set_dot_location(place_id, location.latitude, location.longitude)
+        logger.info(f"Админ {username} указал координаты места {place_id}")
+    except Exception as e:
+        logger.error(f"Ошибка сохранения координат: {e}")
+        await send_text(message, f"❌ Ошибка: {str(e)}")
+        return
+    
+    if status == ADMIN_STATUS["ADD_LOCATION"]:
+        await states.set_status(user_id, ADMIN_STATUS["ADD_PHOTO"])
+        await send_text(message, "✅ Геопозиция сохранена!\n\n"
+                                 f"📸 Отправьте фото места (до {PLACE_PHOTOS_LIMIT}) и напишите 'готово' "
+                                 "(или 'пропустить'):")
+    else:
+        await send_text(message, "✅ Геопозиция успешно изменена", 
+                        reply_markup=create_admin_keyboard())
+        await states.reset(user_id)
+
+async def handle_nearby(message, user_id: int):
+    """Ближайшие к пользователю места"""
+    location = message.location
+    nearest = await db.get_nearest_dots(user_id, location.latitude, location.longitude,
+                                        limit=NEARBY_LIMIT, max_radius_km=NEARBY_MAX_KM)
+    updates_logger.info("Поиск мест рядом: найдено %d", len(nearest))
+    
+    if not nearest:
+        await send_temporary_message(message, f"🧭 В радиусе {NEARBY_MAX_KM} км мест не найдено", 
+                                     delay=5)
+        return
+    
+    text, keyboard = create_nearby_results(nearest)
+    await send_text(message, text, reply_markup=keyboard)
 
 # ==================== ОБРАБОТКА ОТЗЫВА ПОЛЬЗОВАТЕЛЯ ====================
 async def handle_user_review(message, user_id: int, username: str, session: dict):
     """Обработка отзыва пользователя"""
     if "review_place_id" not in session:
-        await message.answer("⚠️ Сессия утеряна. Попробуйте снова.")
+        await send_text(message, "⚠️ Сессия утеряна. Попробуйте снова.")
         return
     
     place_id = session["review_place_id"]
     review_text = message.text
     
     try:
-        review_id = db.add_review(user_id, place_id, review_text, rating=None)
+        review_id = await db.add_review(user_id, place_id, review_text, rating=None)
+        recommender.touch(user_id)
         session["review_id"] = review_id
-        db.update_field("users", user_id, "status", USER_STATUS["ADD_RATING"])
+        await states.set_status(user_id, USER_STATUS["ADD_RATING"])
         
         logger.info(f"Пользователь {username} оставил отзыв о месте {place_id}")
         await send_temporary_message(message, 
@@ -199,32 +746,32 @@ async def handle_user_review(message, user_id: int, username: str, session: dict
                                    delay=10)
     except Exception as e:
         logger.error(f"Ошибка сохранения отзыва: {e}")
-        await message.answer("❌ Не удалось сохранить отзыв. Попробуйте позже.")
+        await send_text(message, "❌ Не удалось сохранить отзыв. Попробуйте позже.")
 
 # ==================== ОБРАБОТКА ОЦЕНКИ ПОЛЬЗОВАТЕЛЯ ====================
 async def handle_user_rating(message, user_id: int, username: str, session: dict):
     """Обработка оценки пользователя"""
     if "review_id" not in session:
-        await message.answer("⚠️ Сессия утеряна. Попробуйте снова.")
+        await send_text(message, "⚠️ Сессия утеряна. Попробуйте снова.")
         return
     
     try:
         rating = int(message.text)
         if 1 <= rating <= 5:
             review_id = session["review_id"]
-            db.update_review_rating(review_id, rating)
+            await db.update_review_rating(review_id, rating)
+            recommender.touch(user_id)
             
             logger.info(f"Пользователь {username} поставил оценку {rating}")
             
-            is_admin = db.get_field("users", user_id, "is_admin")
-            kb = create_admin_keyboard() if is_admin else create_user_keyboard()
+            profile = await users.get(user_id)
+            kb = create_admin_keyboard() if profile.is_admin else create_user_keyboard()
             
             await send_temporary_message(message, 
                                        f"✅ Спасибо! Вы поставили оценку {rating}⭐", 
                                        delay=5, reply_markup=kb)
             
-            db.update_field("users", user_id, "status", 0)
-            del user_sessions[user_id]
+            await states.reset(user_id)
         else:
             await send_temporary_message(message, 
                                        "❌ Оценка должна быть от 1 до 5. Попробуйте снова:", 
@@ -234,6 +781,21 @@ async def handle_user_rating(message, user_id: int, username: str, session: dict
                                    "❌ Пожалуйста, введите число от 1 до 5:", 
                                    delay=5)
 
+# ==================== ПОИСК МЕСТ ====================
+async def handle_search(message, user_id: int, query: str):
+    """Полнотекстовый поиск мест города по названию, адресу и отзывам"""
+    profile = await users.get(user_id)
+    places = await db.search_dots(user_id, profile.city, query, limit=SEARCH_RESULTS_LIMIT)
+    updates_logger.info("Поиск '%.50s' в %s: найдено %d", query, profile.city, len(places))
+    
+    if not places:
+        await send_temporary_message(message, f"🔎 По запросу «{query}» ничего не найдено", 
+                                     delay=5)
+        return
+    
+    text, keyboard = create_search_results(places, query)
+    await send_text(message, text, reply_markup=keyboard)
+
 # ==================== ОБРАБОТКА СТАТУСОВ АДМИНИСТРАТОРА ====================
 async def handle_admin_status(message, user_id: int, username: str, 
                             status: int, session: dict):
@@ -242,44 +804,45 @@ async def handle_admin_status(message, user_id: int, username: str,
     # Шаг 1: Добавление названия места
     if status == ADMIN_STATUS["ADD_NAME"]:
         session["place_name"] = message.text.strip()
-        next_id = db.get_next_available_id("city_krasnoyarsk")
+        next_id = await db.get_next_available_id()
         
         logger.info(f"Админ {username} начал добавление места: '{message.text}'")
         
-        await message.answer(
+        await send_text(
+            message,
             f"✅ Название сохранено\n📝 Следующий ID: {next_id}\n\n"
             f"Введите тип места (цифра 1-5):\n"
             f"1 - 🏨 Отель\n2 - ☕ Кафе\n3 - 🏛️ Достопримечательность\n"
             f"4 - 🛒 Продуктовый магазин\n5 - 🏪 Фирменный магазин"
         )
-        db.update_field("users", user_id, "status", ADMIN_STATUS["ADD_TYPE"])
+        await states.set_status(user_id, ADMIN_STATUS["ADD_TYPE"])
         return
     
     # Шаг 2: Добавление типа места
     if status == ADMIN_STATUS["ADD_TYPE"]:
         if "place_name" not in session:
-            await message.answer("⚠️ Сессия утеряна. Начните заново.", 
-                               reply_markup=create_admin_keyboard())
+            await send_text(message, "⚠️ Сессия утеряна. Начните заново.", 
+                            reply_markup=create_admin_keyboard())
             return
         
         try:
             place_type = int(message.text)
             session["place_type"] = place_type
-            await message.answer("Теперь введите адрес места (строкой):")
-            db.update_field("users", user_id, "status", ADMIN_STATUS["ADD_ADDRESS"])
+            await send_text(message, "Теперь введите адрес места (строкой):")
+            await states.set_status(user_id, ADMIN_STATUS["ADD_ADDRESS"])
         except ValueError:
-            await message.answer("❌ Пожалуйста, введите число от 1 до 5")
+            await send_text(message, "❌ Пожалуйста, введите число от 1 до 5")
         except Exception as e:
             logger.error(f"Ошибка при добавлении места: {e}")
-            await message.answer(f"❌ Ошибка: {str(e)}", 
-                               reply_markup=create_admin_keyboard())
+            await send_text(message, f"❌ Ошибка: {str(e)}", 
+                            reply_markup=create_admin_keyboard())
         return
     
     # Шаг 3: Добавление адреса
     if status == ADMIN_STATUS["ADD_ADDRESS"]:
         if "place_name" not in session or "place_type" not in session:
-            await message.answer("⚠️ Сессия утеряна. Начните заново.", 
-                               reply_markup=create_admin_keyboard())
+            await send_text(message, "⚠️ Сессия утеряна. Начните заново.", 
+                            reply_markup=create_admin_keyboard())
             return
         
         address = message.text.strip()
@@ -288,32 +851,45 @@ async def handle_admin_status(message, user_id: int, username: str,
         place_type = session["place_type"]
         
         try:
-            place_id = db.add_dot_krasnoyarsk(place_name, place_type)
-            db.set_dot_address(place_id, address)
+            place_city = session.get("place_city", DEFAULT_CITY)
+            place_id = await db.add_dot(place_city, place_name, place_type)
+            await db.set_dot_address(place_id, address)
             session["place_id"] = place_id
             
             logger.info(f"Админ {username} добавил место: ID={place_id}")
-            db.update_field("users", user_id, "status", ADMIN_STATUS["ADD_PHOTO"])
+            await states.set_status(user_id, ADMIN_STATUS["ADD_LOCATION"])
             
-            await message.answer(
+            await send_text(
+                message,
                 f"✅ Место добавлено!\n📍 {place_name}\n🔢 ID: {place_id}\n"
                 f"📋 Тип: {get_place_type_name(place_type)}\n📫 Адрес: {address}\n\n"
-                f"📸 Отправьте фото для места (или напишите 'пропустить'):"
+                f"📌 Отправьте геопозицию места (скрепка → Геопозиция) "
+                f"или напишите 'пропустить':"
             )
         except Exception as e:
             logger.error(f"Ошибка при добавлении места: {e}")
-            await message.answer(f"❌ Ошибка: {str(e)}", 
-                               reply_markup=create_admin_keyboard())
+            await send_text(message, f"❌ Ошибка: {str(e)}", 
+                            reply_markup=create_admin_keyboard())
+        return
+    
+    # Шаг 4: Обработка пропуска геопозиции
+    if status == ADMIN_STATUS["ADD_LOCATION"]:
+        if message.text.lower() in ['пропустить', 'skip', 'нет']:
+            await states.set_status(user_id, ADMIN_STATUS["ADD_PHOTO"])
+            await send_text(message, f"📸 Отправьте фото места (до {PLACE_PHOTOS_LIMIT}) и напишите 'готово' "
+                                     "(или 'пропустить'):")
+        else:
+            await send_text(message, "📌 Отправьте геопозицию (скрепка → Геопозиция) "
+                                     "или напишите 'пропустить'")
         return
     
-    # Шаг 4: Обработка пропуска фото
+    # Шаг 5: Завершение или пропуск фото
     if status == ADMIN_STATUS["ADD_PHOTO"]:
-        if message.text and message.text.lower() in ['пропустить', 'skip', 'нет']:
-            await message.answer("✅ Место создано без фото.", 
-                               reply_markup=create_admin_keyboard())
-            db.update_field("users", user_id, "status", 0)
-            if user_id in user_sessions:
-                del user_sessions[user_id]
+        if message.text and message.text.lower() in ['пропустить', 'skip', 'нет', 'готово', 'done']:
+            has_photo = await db.get_dot_photo(session.get("place_id"))
+            await send_text(message, "✅ Место создано." if has_photo else "✅ Место создано без фото.", 
+                            reply_markup=create_admin_keyboard())
+            await states.reset(user_id)
             return
     
     # Редактирование названия места
@@ -326,6 +902,20 @@ async def handle_admin_status(message, user_id: int, username: str,
         await handle_edit_type(message, user_id, session)
         return
     
+    # Галерея места: ждём фото или завершение
+    if status == ADMIN_STATUS["EDIT_PHOTOS"]:
+        if message.text.lower() in ['готово', 'done', 'нет']:
+            await send_text(message, "✅ Галерея сохранена.", reply_markup=create_admin_keyboard())
+            await states.reset(user_id)
+        else:
+            await send_text(message, "📸 Пришлите фото места или напишите 'готово'")
+        return
+    
+    # Редактирование геопозиции: ждём сообщение с геопозицией
+    if status == ADMIN_STATUS["EDIT_LOCATION"]:
+        await send_text(message, "📌 Отправьте геопозицию места (скрепка → Геопозиция)")
+        return
+    
     # Показать админ-меню по умолчанию
     await show_admin_menu(message, user_id, session)
 
@@ -333,78 +923,74 @@ async def handle_admin_status(message, user_id: int, username: str,
 async def handle_edit_name(message, user_id: int, session: dict):
     """Обработка изменения названия места"""
     if "edit_place_id" not in session:
-        await message.answer("⚠️ Сессия утеряна.", reply_markup=create_admin_keyboard())
+        await send_text(message, "⚠️ Сессия утеряна.", reply_markup=create_admin_keyboard())
         return
     
     place_id = session["edit_place_id"]
     new_name = message.text
     
     try:
-        db.cursor.execute("UPDATE city_krasnoyarsk SET name_dot = ? WHERE id_dot = ?", 
-                         (new_name, place_id))
-        db.connection.commit()
+        await db.update_dot_name(place_id, new_name)
         
-        await message.answer(f"✅ Название успешно изменено на: {new_name}", 
-                           reply_markup=create_admin_keyboard())
-        db.update_field("users", user_id, "status", 0)
-        del user_sessions[user_id]
+        await send_text(message, f"✅ Название успешно изменено на: {new_name}", 
+                        reply_markup=create_admin_keyboard())
+        await states.reset(user_id)
     except Exception as e:
         logger.error(f"Ошибка изменения названия: {e}")
-        await message.answer("❌ Не удалось изменить название.")
+        await send_text(message, "❌ Не удалось изменить название.")
 
 async def handle_edit_type(message, user_id: int, session: dict):
     """Обработка изменения типа места"""
     if "edit_place_id" not in session:
-        await message.answer("⚠️ Сессия утеряна.", reply_markup=create_admin_keyboard())
+        await send_text(message, "⚠️ Сессия утеряна.", reply_markup=create_admin_keyboard())
         return
     
     place_id = session["edit_place_id"]
     
     try:
         new_type = int(message.text)
-        db.cursor.execute("UPDATE city_krasnoyarsk SET type_dot = ? WHERE id_dot = ?", 
-                         (new_type, place_id))
-        db.connection.commit()
+        await db.update_dot_type(place_id, new_type)
         
-        await message.answer(f"✅ Тип успешно изменён на: {get_place_type_name(new_type)}", 
-                           reply_markup=create_admin_keyboard())
-        db.update_field("users", user_id, "status", 0)
-        del user_sessions[user_id]
+        await send_text(message, f"✅ Тип успешно изменён на: {get_place_type_name(new_type)}", 
+                        reply_markup=create_admin_keyboard())
+        await states.reset(user_id)
     except ValueError:
-        await message.answer("❌ Пожалуйста, введите число от 1 до 5")
+        await send_text(message, "❌ Пожалуйста, введите число от 1 до 5")
     except Exception as e:
         logger.error(f"Ошибка изменения типа: {e}")
-        await message.answer("❌ Не удалось изменить тип.")
+        await send_text(message, "❌ Не удалось изменить тип.")
 
 # ==================== ПОКАЗ МЕНЮ ====================
 async def show_admin_menu(message, user_id: int, session: dict):
     """Показать меню администратора"""
-    logger.info(f"Админ открыл админ-меню")
+    updates_logger.info("Админ открыл админ-меню")
     
     # Удалить предыдущее меню
     if "last_menu_message_id" in session:
         try:
-            await bot.delete_message(user_id, session["last_menu_message_id"])
+            await delete_message_by_id(user_id, session["last_menu_message_id"])
         except:
             pass
     
-    sent_msg = await message.answer("🛠️ Меню администратора:", 
-                                  reply_markup=create_admin_keyboard())
-    session["last_menu_message_id"] = sent_msg.message_id
+    sent_msg = await send_text(message, "🛠️ Меню администратора:", 
+                               reply_markup=create_admin_keyboard(), key="menu")
+    if sent_msg:
+        session["last_menu_message_id"] = sent_msg.message_id
 
 async def show_user_menu(message, user_id: int, session: dict):
     """Показать меню пользователя"""
-    logger.info(f"Пользователь открыл главное меню")
+    updates_logger.info("Пользователь открыл главное меню")
     
     if "last_menu_message_id" in session:
         try:
-            await bot.delete_message(user_id, session["last_menu_message_id"])
+            await delete_message_by_id(user_id, session["last_menu_message_id"])
         except:
             pass
     
-    sent_msg = await message.answer("Главное меню:", 
-                                  reply_markup=create_user_keyboard())
-    session["last_menu_message_id"] = sent_msg.message_id
+    sent_msg = await send_text(message, "Главное меню:", 
+                               reply_markup=create_user_keyboard(), key="menu")
+    if sent_msg:
+        session["last_menu_message_id"] = sent_msg.message_id
 
 # ==================== ОБРАБОТКА КНОПОК ====================
 @dp.callback_query()
@@ -414,75 +1000,84 @@ async def handle_callback(call):
     username = call.from_user.username or f"user_{user_id}"
     callback_data = call.data
     
-    logger.info(f"Кнопка от {username}: {callback_data}")
+    updates_logger.info("Кнопка от %s: %s", username, callback_data)
     
     # Регистрация пользователя
-    if not db.user_exist(user_id):
-        logger.info(f"Новый пользователь через кнопку: {username}")
-        db.add_user(user_id)
-    
-    # Обработка конкретных действий
-    if callback_data == "add_place":
-        await handle_add_place(call, user_id, username)
-    
-    elif callback_data == "manage_places":
-        await handle_manage_places(call, user_id, username)
-    
-    elif callback_data == "places_list":
-        await handle_places_list(call, user_id, username)
-    
-    elif callback_data == "my_places":
-        await handle_my_places(call, user_id)
-    
-    elif callback_data == "favorites":
-        await handle_favorites(call, user_id)
-    
-    # Обработка редактирования мест
-    elif callback_data.startswith("edit_name_"):
-        await handle_edit_name_callback(call, user_id)
-    
-    elif callback_data.startswith("edit_type_"):
-        await handle_edit_type_callback(call, user_id)
-    
-    elif callback_data.startswith("delete_"):
-        await handle_delete_place(call)
-    
-    # Обработка избранного и отзывов
-    elif callback_data.startswith("add_fav_"):
-        await handle_add_favorite(call, user_id)
-    
-    elif callback_data.startswith("remove_fav_"):
-        await handle_remove_favorite(call, user_id)
-    
-    elif callback_data.startswith("visited_"):
-        await handle_visited_place(call, user_id)
-    
-    elif callback_data.startswith("reviews_"):
-        await handle_show_reviews(call)
+    profile = await users.get(user_id)
+    
+    # Действие и его данные разбираются один раз, обработчик - поиск по коду.
+    # Права на действия с admin=True проверяются здесь, а не в обработчиках
+    result = await actions.dispatch(call, user_id, is_admin=profile.is_admin)
+    if result == STALE:
+        # Кнопка старого формата или с испорченными данными
+        logger.warning(f"Неизвестная кнопка от {username}: {callback_data}")
+        await answer_callback(call, "⚠️ Кнопка устарела, откройте меню заново")
+    elif result == FORBIDDEN:
+        logger.warning(f"Действие администратора от {username}: {callback_data}")
+        await answer_callback(call, "⛔ Только для администраторов")
 
 # ==================== ОБРАБОТЧИКИ КНОПОК ====================
-async def handle_add_place(call, user_id: int, username: str):
+@actions.action("add_place", "ap", admin=True)
+async def handle_add_place(call, user_id: int, data):
     """Начать процесс добавления места"""
+    username = call.from_user.username or f"user_{user_id}"
     logger.info(f"Админ {username} начал добавление места")
-    await call.answer("✏️ Введите название места")
-    db.update_field("users", user_id, "status", ADMIN_STATUS["ADD_NAME"])
-    if user_id in user_sessions:
-        del user_sessions[user_id]
+    await answer_callback(call, "✏️ Введите название места")
+    profile = await users.get(user_id)
+    # Место добавляется в город, выбранный администратором на момент начала
+    await states.set(user_id, ADMIN_STATUS["ADD_NAME"], {"place_city": profile.city})
 
-async def handle_manage_places(call, user_id: int, username: str):
+@actions.action("import_places", "ip", admin=True)
+async def handle_import_places(call, user_id: int, data):
+    """Начать импорт мест из файла"""
+    await answer_callback(call)
+    await states.set(user_id, ADMIN_STATUS["IMPORT"])
+    await send_text(
+        call.message,
+        "📥 Пришлите файл .csv или .json с местами.\n"
+        "Колонки: name, type, address, city, lat, lon, photo_id "
+        "(обязательны name и type, без city - текущий город).\n"
+        "Места с тем же названием и адресом пропускаются, строки с ошибками - тоже.\n"
+        "Для отмены напишите 'отмена'."
+    )
+
+@actions.action("export_places", "ep", admin=True)
+async def handle_export_places(call, user_id: int, data):
+    """Выгрузка мест текущего города в CSV"""
+    profile = await users.get(user_id)
+    await answer_callback(call, "📤 Готовлю файл...")
+    path = temp_path(".csv")
+    try:
+        # Выгрузка читает БД порциями в отдельном потоке со своим соединением
+        loop = asyncio.get_running_loop()
+        count = await loop.run_in_executor(None, catalog.export_places,
+                                           db.database, path, "csv", profile.city)
+        logger.info(f"Экспорт мест города {profile.city}: {count}")
+        await send_document(call.message, path, f"places_{profile.city}.csv",
+                            caption=f"📤 Мест: {count}")
+    except Exception as e:
+        logger.error(f"Ошибка экспорта мест: {e}")
+        await send_text(call.message, f"❌ Ошибка экспорта: {str(e)}")
+    finally:
+        os.remove(path)
+
+@actions.action("manage_places", "mp", admin=True)
+async def handle_manage_places(call, user_id: int, data):
     """Управление местами"""
-    places = db.get_dots("city_krasnoyarsk")
+    username = call.from_user.username or f"user_{user_id}"
+    profile = await users.get(user_id)
+    places = await db.get_dots(profile.city)
     count = len(places) if places else 0
     logger.info(f"Админ {username} запросил управление местами (всего: {count})")
     
     if not places:
-        await call.answer("❌ Нет доступных мест!")
+        await answer_callback(call, "❌ Нет доступных мест!")
         return
     
-    await call.answer(f"📍 Доступно мест: {count}")
+    await answer_callback(call, f"📍 Доступно мест: {count}")
     
     try:
-        await call.message.delete()
+        await delete_message(call.message)
     except:
         pass
     
@@ -491,287 +1086,386 @@ async def handle_manage_places(call, user_id: int, username: str):
         
         keyboard = InlineKeyboardMarkup(inline_keyboard=[
             [InlineKeyboardButton(text='✏️ Изменить название', 
-                                callback_data=f'edit_name_{place_id}')],
+                                callback_data=actions.pack("edit_name", place_id))],
             [InlineKeyboardButton(text='🏷️ Изменить тип', 
-                                callback_data=f'edit_type_{place_id}')],
+                                callback_data=actions.pack("edit_type", place_id))],
+            [InlineKeyboardButton(text='📌 Изменить геопозицию', 
+                                callback_data=actions.pack("edit_location", place_id))],
+            [InlineKeyboardButton(text='🖼 Фото', 
+                                callback_data=actions.pack("edit_photos", place_id))],
             [InlineKeyboardButton(text='🗑️ Удалить', 
-                                callback_data=f'delete_{place_id}')]
+                                callback_data=actions.pack("delete_place", place_id))]
         ])
         
-        await call.message.answer(
+        await send_text(
+            call.message,
             f"📍 {name} | тип: {get_place_type_name(place_type)}",
             reply_markup=keyboard
         )
 
-async def handle_places_list(call, user_id: int, username: str):
-    """Показать список мест"""
-    places = db.get_dots("city_krasnoyarsk")
-    count = len(places) if places else 0
-    logger.info(f"Пользователь {username} запросил список мест (найдено: {count})")
+@actions.action("places_list", "pl")
+async def handle_places_list(call, user_id: int, data):
+    """Показать первую страницу списка мест"""
+    username = call.from_user.username or f"user_{user_id}"
+    city = (await users.get(user_id)).city
+    places, has_prev, has_next = await db.get_dots_page(user_id, city, limit=PLACES_PAGE_SIZE)
+    updates_logger.info("Пользователь %s запросил список мест (на странице: %d)", username, len(places))
     
     if not places:
-        await call.answer("❌ Нет доступных мест!")
+        await answer_callback(call, "❌ Нет доступных мест!")
         return
     
+    text, keyboard = create_places_page(places, has_prev, has_next, city)
     try:
-        await call.message.delete()
-    except:
-        pass
+        await edit_text(call.message, text, reply_markup=keyboard)
+    except Exception:
+        # Например, если кнопка была под фото - такое сообщение не превратить в текст
+        await send_text(call.message, text, reply_markup=keyboard)
+    await answer_callback(call)
+
+@actions.action("places_page", "pp", ("forward", bool), ("cursor", int))
+async def handle_places_page(call, user_id: int, data):
+    """Перелистнуть страницу списка мест"""
+    city = (await users.get(user_id)).city
     
-    for place in places:
-        place_id, name, place_type = place[0], place[1], place[2]
-        
-        # Получить фото
-        photo_id = place[3] if len(place) > 3 and place[3] else None
-        if not photo_id:
-            photo_id = db.get_dot_photo(place_id)
-        
-        # Проверить избранное
-        is_fav = db.is_favourite(user_id, place_id)
-        
-        # Получить количество отзывов
-        reviews = db.get_dot_reviews(place_id)
-        reviews_count = len(reviews)
-        
-        # Получить адрес
-        address = db.get_dot_address(place_id) or '—'
-        
-        # Получить среднюю оценку
-        ratings = [r[2] for r in reviews if r[2] is not None]
-        avg_rating = sum(ratings) / len(ratings) if ratings else None
-        
-        # Создать сообщение
-        message_text = f"📝 {name}\n{get_place_type_name(place_type)}\n"
-        message_text += f"📫 Адрес: {address}\n"
-        if avg_rating:
-            message_text += f"⭐ Средняя оценка: {avg_rating:.1f}/5.0   "
-        message_text += f"💬 Отзывов: {reviews_count}\n"
-        
-        # Создать клавиатуру
-        keyboard = InlineKeyboardMarkup(inline_keyboard=[
-            [InlineKeyboardButton(
-                text="💔 Убрать" if is_fav else "❤️ В избранное",
-                callback_data=f"remove_fav_{place_id}" if is_fav else f"add_fav_{place_id}"
-            )],
-            [InlineKeyboardButton(text="✅ Посетил", 
-                                callback_data=f"visited_{place_id}")],
-            [InlineKeyboardButton(text=f"💬 Отзывы ({reviews_count})", 
-                                callback_data=f"reviews_{place_id}")]
-        ])
-        
-        # Отправить сообщение
+    if data.forward:
+        page = await db.get_dots_page(user_id, city, after_id=data.cursor, limit=PLACES_PAGE_SIZE)
+    else:
+        page = await db.get_dots_page(user_id, city, before_id=data.cursor, limit=PLACES_PAGE_SIZE)
+    places, has_prev, has_next = page
+    
+    # Места могли удалить - тогда начинаем с первой страницы
+    if not places:
+        places, has_prev, has_next = await db.get_dots_page(user_id, city, limit=PLACES_PAGE_SIZE)
+    if not places:
+        await answer_callback(call, "❌ Нет доступных мест!")
+        return
+    
+    text, keyboard = create_places_page(places, has_prev, has_next, city)
+    try:
+        await edit_text(call.message, text, reply_markup=keyboard)
+    except Exception as e:
+        logger.debug(f"Не удалось обновить страницу мест: {e}")
+    await answer_callback(call)
+
+@actions.action("place", "p", ("place_id", int))
+async def handle_show_place(call, user_id: int, data):
+    """Показать карточку места со всеми действиями"""
+    place_id = data.place_id
+    place = await db.get_dot_feed(user_id, place_id)
+    
+    if not place:
+        await answer_callback(call, "❌ Место не найдено")
+        return
+    
+    await send_place_card(call, place)
+    await answer_callback(call)
+
+@actions.action("photos", "ph", ("place_id", int))
+async def handle_place_photos(call, user_id: int, data):
+    """Показать галерею места одной медиагруппой"""
+    place = await db.get_dot_feed(user_id, data.place_id)
+    photos = await db.get_dot_photos(data.place_id) if place else []
+    
+    if not photos:
+        await answer_callback(call, "❌ У места нет фото")
+        return
+    
+    await answer_callback(call)
+    caption = f"🖼 {place[1]}"
+    if len(photos) == 1:
+        await send_photo(call.message, photos[0], caption=caption)
+        return
+    for i in range(0, len(photos), MEDIA_GROUP_SIZE):
+        media = [InputMediaPhoto(media=file_id, caption=caption if not i and not j else None)
+                 for j, file_id in enumerate(photos[i:i + MEDIA_GROUP_SIZE])]
         try:
-            if photo_id:
-                await call.message.answer_photo(
-                    photo=photo_id,
-                    caption=message_text,
-                    reply_markup=keyboard
-                )
-            else:
-                await call.message.answer(message_text, reply_markup=keyboard)
+            await send_media_group(call.message, media)
         except Exception as e:
-            logger.error(f"Ошибка отправки места {place_id}: {e}")
-            await call.message.answer(message_text, reply_markup=keyboard)
+            logger.error(f"Ошибка отправки галереи места {data.place_id}: {e}")
+            return
 
-async def handle_my_places(call, user_id: int):
+@actions.action("my_places", "my")
+async def handle_my_places(call, user_id: int, data):
     """Показать 'Мои места'"""
-    places = db.get_dots("city_krasnoyarsk")
+    profile = await users.get(user_id)
+    places = await db.get_dots_feed(user_id, profile.city)
     
     if not places:
-        await call.answer("❌ У вас еще нет сохраненных мест")
+        await answer_callback(call, "❌ У вас еще нет сохраненных мест")
         return
     
     try:
-        await call.message.delete()
+        await delete_message(call.message)
     except:
         pass
     
-    for place in places:
-        place_id, name, place_type = place[0], place[1], place[2]
-        
-        keyboard = InlineKeyboardMarkup(inline_keyboard=[
-            [InlineKeyboardButton(text="⭐ Добавить в Мои", 
-                                callback_data=f"add_my_{place_id}")],
-            [InlineKeyboardButton(text="❌ Удалить из Моих", 
-                                callback_data=f"remove_my_{place_id}")]
-        ])
-        
-        await call.message.answer(
-            f"📍 {name}\n{get_place_type_name(place_type)}",
-            reply_markup=keyboard
-        )
-    
-    await call.answer()
+    await send_place_cards(call.message, places)
+    await answer_callback(call)
 
-async def handle_favorites(call, user_id: int):
+@actions.action("favorites", "fv")
+async def handle_favorites(call, user_id: int, data):
     """Показать избранные места"""
-    fav_places = db.get_favourite_dots(user_id)
+    profile = await users.get(user_id)
+    fav_places = await db.get_dots_feed(user_id, profile.city, favourites_only=True)
     
     if not fav_places:
-        await call.answer("❌ У вас еще нет избранных мест")
+        await answer_callback(call, "❌ У вас еще нет избранных мест")
         return
     
     try:
-        await call.message.delete()
+        await delete_message(call.message)
     except:
         pass
     
-    for place in fav_places:
-        place_id, name, place_type = place[0], place[1], place[2]
-        
-        # Получить фото
-        photo_id = place[3] if len(place) > 3 and place[3] else None
-        if not photo_id:
-            photo_id = db.get_dot_photo(place_id)
-        
-        # Получить количество отзывов
-        reviews = db.get_dot_reviews(place_id)
-        reviews_count = len(reviews)
-        
-        # Получить адрес
-        address = db.get_dot_address(place_id) or '—'
-        
-        # Получить среднюю оценку
-        ratings = [r[2] for r in reviews if r[2] is not None]
-        avg_rating = sum(ratings) / len(ratings) if ratings else None
-        
-        message_text = f"📝 {name}\n{get_place_type_name(place_type)}\n"
-        message_text += f"📫 Адрес: {address}\n"
-        if avg_rating:
-            message_text += f"⭐ Средняя оценка: {avg_rating:.1f}/5.0   "
-        message_text += f"💬 Отзывов: {reviews_count}\n"
-        
-        keyboard = InlineKeyboardMarkup(inline_keyboard=[
-            [InlineKeyboardButton(text="💔 Убрать из избранного", 
-                                callback_data=f"remove_fav_{place_id}")],
-            [InlineKeyboardButton(text="✅ Посетил", 
-                                callback_data=f"visited_{place_id}")],
-            [InlineKeyboardButton(text=f"💬 Отзывы ({reviews_count})", 
-                                callback_data=f"reviews_{place_id}")]
-        ])
-        
-        try:
-            if photo_id:
-                await call.message.answer_photo(
-                    photo=photo_id,
-                    caption=message_text,
-                    reply_markup=keyboard
-                )
-            else:
-                await call.message.answer(message_text, reply_markup=keyboard)
-        except:
-            await call.message.answer(message_text, reply_markup=keyboard)
+    await send_place_cards(call.message, fav_places)
+    await answer_callback(call)
+
+@actions.action("search", "s")
+async def handle_search_callback(call, user_id: int, data):
+    """Начать поиск места"""
+    await states.set(user_id, USER_STATUS["SEARCH"])
+    await send_temporary_message(call, "🔎 Что ищем? Название, адрес или слово из отзыва:", 
+                                 delay=10)
+    await answer_callback(call)
+
+@actions.action("nearby", "nb")
+async def handle_nearby_callback(call, user_id: int, data):
+    """Попросить геопозицию для поиска ближайших мест"""
+    await send_text(call.message, "🧭 Отправьте свою геопозицию - покажу ближайшие места", 
+                    reply_markup=create_location_request_keyboard())
+    await answer_callback(call)
+
+@actions.action("top", "t")
+async def handle_top_callback(call, user_id: int, data):
+    """Показать выбор типа мест для рейтинга"""
+    try:
+        await edit_text(call.message, "🏆 Лучшие места — выберите тип:",
+                        reply_markup=create_top_types_keyboard())
+    except Exception:
+        await send_text(call.message, "🏆 Лучшие места — выберите тип:",
+                        reply_markup=create_top_types_keyboard())
+    await answer_callback(call)
+
+@actions.action("top_type", "tt", ("type_dot", int))
+async def handle_top_type(call, user_id: int, data):
+    """Показать лучшие места города выбранного типа"""
+    city = (await users.get(user_id)).city
+    top = await db.get_top_dots(user_id, city, data.type_dot, limit=TOP_LIMIT)
+    
+    if not top:
+        await answer_callback(call, "❌ Пока нет оцененных мест этого типа")
+        return
     
-    await call.answer()
+    text, keyboard = create_top_results(top, data.type_dot, city)
+    try:
+        await edit_text(call.message, text, reply_markup=keyboard)
+    except Exception as e:
+        logger.debug(f"Не удалось обновить рейтинг: {e}")
+        await send_text(call.message, text, reply_markup=keyboard)
+    await answer_callback(call)
+
+@actions.action("recommend", "rc")
+async def handle_recommend(call, user_id: int, data):
+    """Показать места, похожие на избранные и высоко оцененные пользователем"""
+    city = (await users.get(user_id)).city
+    ids = await recommender.recommend(user_id, city, limit=RECOMMEND_LIMIT)
+    places = await db.get_dots_feed_by_ids(user_id, ids) if ids else []
+    
+    if not places:
+        await answer_callback(call, "✨ Добавьте места в избранное или оцените их - "
+                                    "и здесь появятся рекомендации")
+        return
+    
+    text, keyboard = create_recommendations(places)
+    await send_text(call.message, text, reply_markup=keyboard)
+    await answer_callback(call)
+
+# ==================== ВЫБОР ГОРОДА ====================
+@actions.action("choose_city", "cc")
+async def handle_choose_city(call, user_id: int, data):
+    """Показать выбор города"""
+    profile = await users.get(user_id)
+    try:
+        await edit_text(call.message, "🏙️ Выберите город:",
+                        reply_markup=create_city_keyboard(profile.city))
+    except Exception:
+        await send_text(call.message, "🏙️ Выберите город:",
+                        reply_markup=create_city_keyboard(profile.city))
+    await answer_callback(call)
+
+@actions.action("set_city", "c", ("city", str))
+async def handle_set_city(call, user_id: int, data):
+    """Сохранить выбранный город"""
+    city = data.city
+    if city not in CITIES:
+        await answer_callback(call, "❌ Неизвестный город")
+        return
+    
+    await users.update_field(user_id, "city", city)
+    profile = await users.get(user_id)
+    kb = create_admin_keyboard() if profile.is_admin else create_user_keyboard()
+    try:
+        await edit_text(call.message, f"🏙️ Ваш город: {get_city_name(city)}", reply_markup=kb)
+    except Exception as e:
+        logger.debug(f"Не удалось обновить меню: {e}")
+    await answer_callback(call, f"🏙️ {get_city_name(city)}")
 
 # ==================== ОБРАБОТКА РЕДАКТИРОВАНИЯ ====================
-async def handle_edit_name_callback(call, user_id: int):
+@actions.action("edit_name", "en", ("place_id", int), admin=True)
+async def handle_edit_name_callback(call, user_id: int, data):
     """Начать изменение названия места"""
-    place_id = int(call.data.split("edit_name_")[1])
-    db.update_field("users", user_id, "status", ADMIN_STATUS["EDIT_NAME"])
-    user_sessions[user_id] = {"edit_place_id": place_id}
+    place_id = data.place_id
+    await states.set(user_id, ADMIN_STATUS["EDIT_NAME"], {"edit_place_id": place_id})
     await send_temporary_message(call, "✏️ Введите новое название:", delay=5)
-    await call.answer()
+    await answer_callback(call)
 
-async def handle_edit_type_callback(call, user_id: int):
+@actions.action("edit_type", "et", ("place_id", int), admin=True)
+async def handle_edit_type_callback(call, user_id: int, data):
     """Начать изменение типа места"""
-    place_id = int(call.data.split("edit_type_")[1])
-    db.update_field("users", user_id, "status", ADMIN_STATUS["EDIT_TYPE"])
-    user_sessions[user_id] = {"edit_place_id": place_id}
+    place_id = data.place_id
+    await states.set(user_id, ADMIN_STATUS["EDIT_TYPE"], {"edit_place_id": place_id})
     await send_temporary_message(call, "🏷️ Введите новый тип (1-5):", delay=5)
-    await call.answer()
+    await answer_callback(call)
+
+@actions.action("edit_location", "el", ("place_id", int), admin=True)
+async def handle_edit_location_callback(call, user_id: int, data):
+    """Начать изменение геопозиции места"""
+    place_id = data.place_id
+    await states.set(user_id, ADMIN_STATUS["EDIT_LOCATION"], {"edit_place_id": place_id})
+    await send_temporary_message(call, "📌 Отправьте новую геопозицию места:", delay=10)
+    await answer_callback(call)
 
-async def handle_delete_place(call):
+@actions.action("edit_photos", "eh", ("place_id", int), admin=True)
+async def handle_edit_photos_callback(call, user_id: int, data):
+    """Начать добавление фото в галерею места"""
+    place_id = data.place_id
+    await states.set(user_id, ADMIN_STATUS["EDIT_PHOTOS"], {"edit_place_id": place_id})
+    keyboard = InlineKeyboardMarkup(inline_keyboard=[
+        [InlineKeyboardButton(text="🗑 Очистить галерею", callback_data=actions.pack("clear_photos", place_id))]
+    ])
+    await send_temporary_message(call, f"📸 Пришлите фото места (до {PLACE_PHOTOS_LIMIT}), "
+                                       "затем напишите 'готово'", delay=30, reply_markup=keyboard)
+    await answer_callback(call)
+
+@actions.action("clear_photos", "cp", ("place_id", int), admin=True)
+async def handle_clear_photos(call, user_id: int, data):
+    """Удалить все фото места"""
+    count = await db.clear_dot_photos(data.place_id)
+    logger.info(f"Удалены фото места {data.place_id}: {count}")
+    await answer_callback(call, f"🗑 Удалено фото: {count}")
+
+@actions.action("delete_place", "dp", ("place_id", int), admin=True)
+async def handle_delete_place(call, user_id: int, data):
     """Удалить место"""
-    place_id = int(call.data.split("delete_")[1])
+    place_id = data.place_id
     
     try:
-        db.cursor.execute("DELETE FROM city_krasnoyarsk WHERE id_dot = ?", (place_id,))
-        db.connection.commit()
+        await db.delete_dot(place_id)
+        cards.invalidate(place_id)
         
         try:
-            await call.message.delete()
+            await delete_message(call.message)
         except:
             pass
         
-        await call.answer(f"🗑️ Место ID {place_id} удалено!")
+        await answer_callback(call, f"🗑️ Место ID {place_id} удалено!")
     except Exception as e:
         logger.error(f"Ошибка удаления места {place_id}: {e}")
-        await call.answer("❌ Не удалось удалить место")
+        await answer_callback(call, "❌ Не удалось удалить место")
 
 # ==================== ОБРАБОТКА ИЗБРАННОГО И ОТЗЫВОВ ====================
-async def handle_add_favorite(call, user_id: int):
+@actions.action("add_favorite", "fa", ("place_id", int))
+async def handle_add_favorite(call, user_id: int, data):
     """Добавить место в избранное"""
-    place_id = int(call.data.split("add_fav_")[1])
+    place_id = data.place_id
     
-    if db.add_to_favourites(user_id, place_id):
-        await call.answer("❤️ Добавлено в избранное!")
+    if await db.add_to_favourites(user_id, place_id):
+        recommender.touch(user_id)
+        await answer_callback(call, "❤️ Добавлено в избранное!")
     else:
-        await call.answer("⚠️ Уже в избранном")
+        await answer_callback(call, "⚠️ Уже в избранном")
 
-async def handle_remove_favorite(call, user_id: int):
+@actions.action("remove_favorite", "fr", ("place_id", int))
+async def handle_remove_favorite(call, user_id: int, data):
     """Убрать место из избранного"""
-    place_id = int(call.data.split("remove_fav_")[1])
-    db.remove_from_favourites(user_id, place_id)
-    await call.answer("💔 Удалено из избранного")
+    place_id = data.place_id
+    await db.remove_from_favourites(user_id, place_id)
+    recommender.touch(user_id)
+    await answer_callback(call, "💔 Удалено из избранного")
 
-async def handle_visited_place(call, user_id: int):
+@actions.action("visited", "v", ("place_id", int))
+async def handle_visited_place(call, user_id: int, data):
     """Обработка нажатия 'Посетил'"""
-    place_id = int(call.data.split("visited_")[1])
+    place_id = data.place_id
     
-    if db.has_user_reviewed(user_id, place_id):
-        await call.answer("ℹ️ Вы уже оставляли отзыв об этом месте")
+    if await db.has_user_reviewed(user_id, place_id):
+        await answer_callback(call, "ℹ️ Вы уже оставляли отзыв об этом месте")
     else:
-        db.update_field("users", user_id, "status", USER_STATUS["ADD_REVIEW"])
-        user_sessions[user_id] = {"review_place_id": place_id}
+        await states.set(user_id, USER_STATUS["ADD_REVIEW"], {"review_place_id": place_id})
         await send_temporary_message(call, "✍️ Напишите ваш отзыв об этом месте:", delay=10)
-        await call.answer()
+        await answer_callback(call)
+
+@actions.action("reviews", "r", ("place_id", int))
+async def handle_show_reviews(call, user_id: int, data):
+    """Показать отзывы о месте: первая страница новым сообщением"""
+    text, keyboard = await render_reviews_page(user_id, data.place_id)
+    await send_text(call.message, text, reply_markup=keyboard)
+    await answer_callback(call)
 
-async def handle_show_reviews(call):
-    """Показать отзывы о месте"""
-    place_id = int(call.data.split("reviews_")[1])
-    reviews = db.get_dot_reviews(place_id, limit=20)
+@actions.action("reviews_page", "rp", ("place_id", int), ("older", bool), ("cursor", int))
+async def handle_reviews_page(call, user_id: int, data):
+    """Перелистнуть страницу отзывов (то же сообщение)"""
+    text, keyboard = await render_reviews_page(user_id, data.place_id, data.older, data.cursor)
+    try:
+        await edit_text(call.message, text, reply_markup=keyboard)
+    except Exception as e:
+        logger.debug(f"Не удалось обновить страницу отзывов: {e}")
+    await answer_callback(call)
+
+async def render_reviews_page(user_id: int, place_id: int, older: bool = True, cursor: int = None):
+    """Текст и клавиатура страницы отзывов. cursor - id крайнего отзыва
+    предыдущей страницы, older - листать к более старым отзывам"""
+    if cursor is None:
+        page = await db.get_dot_reviews_page(place_id, limit=REVIEWS_PAGE_SIZE)
+    elif older:
+        page = await db.get_dot_reviews_page(place_id, older_than=cursor, limit=REVIEWS_PAGE_SIZE)
+    else:
+        page = await db.get_dot_reviews_page(place_id, newer_than=cursor, limit=REVIEWS_PAGE_SIZE)
+    reviews, has_newer, has_older = page
     
-    # Получить информацию о месте
-    place_info = db.get_dots("city_krasnoyarsk", id_dot=place_id)
-    place_name = place_info[0][1] if place_info else f"Место #{place_id}"
+    # Отзыв-курсор могли удалить - тогда начинаем с самых новых
+    if not reviews and cursor is not None:
+        reviews, has_newer, has_older = await db.get_dot_reviews_page(place_id, limit=REVIEWS_PAGE_SIZE)
     
-    if not reviews:
-        await call.message.answer(f"💬 Отзывы о месте '{place_name}':\n\n❌ Пока нет отзывов.")
-        await call.answer()
-        return
+    place_info = await db.get_dot_feed(user_id, place_id)
+    place_name = place_info[1] if place_info else f"Место #{place_id}"
+    text = f"💬 Отзывы о месте '{place_name}':\n"
     
-    # Вычислить среднюю оценку
-    ratings = [r[2] for r in reviews if r[2] is not None]
-    avg_rating = sum(ratings) / len(ratings) if ratings else 0
+    if not reviews:
+        return text + "\n❌ Пока нет отзывов.", None
     
-    # Сформировать сообщение
-    message_text = f"💬 Отзывы о месте '{place_name}':\n"
-    if avg_rating > 0:
-        message_text += f"⭐ Средняя оценка: {avg_rating:.1f}/5.0 ({len(ratings)} оценок)\n\n"
+    # Агрегаты поддерживаются в БД и учитывают все отзывы, а не только показанные
+    reviews_count, rating_count, avg_rating, _, _ = await db.get_dot_stats(place_id)
+    if avg_rating:
+        text += f"⭐ Средняя оценка: {avg_rating:.1f}/5.0 ({rating_count} оценок)\n\n"
     else:
-        message_text += f"📊 Всего отзывов: {len(reviews)}\n\n"
+        text += f"📊 Всего отзывов: {reviews_count}\n\n"
     
-    # Добавить отзывы
-    for idx, review in enumerate(reviews, 1):
-        review_text, rating, created_at = review[1], review[2], review[3]
-        
+    for _, _, review_text, rating, created_at in reviews:
         date_str = created_at[:10] if created_at else "неизвестно"
         rating_str = f"⭐ {rating}/5" if rating else "⭐ Нет оценки"
-        
-        message_text += f"{idx}. {rating_str}\n"
-        message_text += f"   {review_text}\n"
-        message_text += f"   📅 {date_str}\n\n"
-        
-        # Разбить длинные сообщения
-        if len(message_text) > 3000:
-            await call.message.answer(message_text[:3000])
-            message_text = message_text[3000:]
-    
-    if message_text.strip():
-        await call.message.answer(message_text)
-    
-    await call.answer()
+        text += f"{rating_str}   📅 {date_str}\n"
+        text += f"   {shorten_text(review_text, REVIEW_TEXT_LIMIT)}\n\n"
+    
+    nav = []
+    if has_newer:
+        nav.append(InlineKeyboardButton(
+            text="⬅️ Новее", callback_data=actions.pack("reviews_page", place_id, False, reviews[0][0])))
+    if has_older:
+        nav.append(InlineKeyboardButton(
+            text="Старше ➡️", callback_data=actions.pack("reviews_page", place_id, True, reviews[-1][0])))
+    return text, InlineKeyboardMarkup(inline_keyboard=[nav]) if nav else None
 
 # ==================== ОБРАБОТКА ОШИБОК ====================
 @dp.error()
@@ -781,24 +1475,86 @@ async def error_handler(update, exception):
     return True
 
 # ==================== ЗАПУСК БОТА ====================
+async def startup(metrics_port=config.METRICS_PORT):
+    """Подготовка БД, состояний диалогов и очереди отправки"""
+    global metrics_server
+    if metrics_port:
+        metrics_server = metrics.MetricsServer(host=config.METRICS_HOST, port=metrics_port)
+        await metrics_server.start()
+    
+    await db.init_tables()
+    await states.start()
+    await deleter.start()
+    await recommender.start()
+    sender.start()
+    
+    # Проверка подключения к БД
+    places = await db.get_dots(DEFAULT_CITY)
+    logger.info(f"Подключение к БД: OK (мест в городе по умолчанию: {len(places) if places else 0})")
+
+async def shutdown():
+    """Остановка очереди отправки и сохранение состояний"""
+    # Невыполненные удаления сохраняются и выполнятся после перезапуска
+    await deleter.stop()
+    logger.info(f"Отложенные удаления: {deleter.stats()}")
+    await recommender.stop()
+    await sender.stop()
+    logger.info(f"Очередь отправки: {sender.stats()}")
+    await states.stop()
+    await db.close()
+    if metrics_server is not None:
+        await metrics_server.stop()
+
+async def run_polling(dispatcher=dp, **kwargs):
+    """Прием обновлений через getUpdates"""
+    # Пока у бота зарегистрирован webhook, getUpdates не работает
+    await bot.delete_webhook()
+    logger.info("Запуск polling...")
+    await dispatcher.start_polling(bot, allowed_updates=dp.resolve_used_update_types(), **kwargs)
+
+async def run_webhook(dispatcher=dp, workers=config.WEBHOOK_WORKERS):
+    """Прием обновлений через webhook (config.MODE = "webhook")"""
+    server = WebhookServer(
+        dispatcher, bot,
+        url=config.WEBHOOK_URL,
+        secret=config.WEBHOOK_SECRET,
+        path=config.WEBHOOK_PATH,
+        host=config.WEBAPP_HOST,
+        port=config.WEBAPP_PORT,
+        queue_size=config.WEBHOOK_QUEUE_SIZE,
+        workers=workers,
+        allowed_updates=dp.resolve_used_update_types()
+    )
+    logger.info("Запуск webhook...")
+    await server.start()
+    try:
+        # Работаем до остановки процесса
+        await asyncio.Event().wait()
+    finally:
+        await server.stop()
+        logger.info(f"Webhook: {server.stats()}")
+        await bot.session.close()
+
 async def main():
     """Основная функция запуска бота"""
     logger.info("=== ЗАПУСК БОТА ===")
     logger.info(f"Токен: {config.TOKEN[:10]}...")
     
     try:
-        # Проверка подключения к БД
-        places = db.get_dots("city_krasnoyarsk")
-        logger.info(f"Подключение к БД: OK (мест в базе: {len(places) if places else 0})")
-        
-        logger.info("Запуск polling...")
-        await dp.start_polling(bot, allowed_updates=dp.resolve_used_update_types())
+        await startup()
+        if config.MODE == "webhook":
+            await run_webhook()
+        else:
+            await run_polling()
         
     except Exception as e:
         logger.critical(f"Критическая ошибка при запуске: {e}", exc_info=True)
         raise
+    finally:
+        await shutdown()
 
 if __name__ == "__main__":
+    init()
     try:
         asyncio.run(main())
     except KeyboardInterrupt:
@@ -0,0 +1,597 @@
+import logging
+import time
+
+logger = logging.getLogger(__name__)
+
+# ==================== ОБЩИЙ SQL ====================
+# Полный пересчет агрегатов отзывов (используется и миграциями, и SQL.backfill_dot_stats)
+BACKFILL_DOT_STATS = """
+    UPDATE {table} SET
+        reviews_count = (SELECT COUNT(*) FROM reviews r WHERE r.dot_id = id_dot),
+        rating_sum = (SELECT COALESCE(SUM(rating), 0) FROM reviews r WHERE r.dot_id = id_dot),
+        rating_count = (SELECT COUNT(rating) FROM reviews r WHERE r.dot_id = id_dot),
+        rate = (SELECT AVG(rating) FROM reviews r WHERE r.dot_id = id_dot),
+        max_rate = (SELECT MAX(rating) FROM reviews r WHERE r.dot_id = id_dot),
+        min_rate = (SELECT MIN(rating) FROM reviews r WHERE r.dot_id = id_dot)
+"""
+
+
+# Рейтинг мест (place_scores): байесовская средняя оценка
+#   score = (PRIOR_WEIGHT * PRIOR_MEAN + сумма оценок) / (PRIOR_WEIGHT + число оценок)
+# Место как будто заранее получило PRIOR_WEIGHT оценок PRIOR_MEAN, поэтому
+# одна пятерка не поднимает место выше десятков хороших оценок. Значения
+# вшиты в триггеры: чтобы их поменять, нужна новая миграция с пересчетом.
+LEADERBOARD_PRIOR_MEAN = 3.5
+LEADERBOARD_PRIOR_WEIGHT = 5
+PLACE_SCORE = (f"CAST({LEADERBOARD_PRIOR_WEIGHT * LEADERBOARD_PRIOR_MEAN} + {{p}}.rating_sum AS REAL)"
+               f" / ({LEADERBOARD_PRIOR_WEIGHT} + {{p}}.rating_count)")
+
+
+# Длины префиксных индексов полнотекстового поиска (миграция 16). Префикс
+# длиннее максимальной FTS5 ищет перебором всех слов индекса, поэтому
+# make_search_query обрезает префикс до неё. Значения вшиты в индексы:
+# чтобы их поменять, нужна новая миграция с перестройкой индексов.
+FTS_PREFIX_LENGTHS = (2, 3, 4, 5, 6)
+
+
+# ==================== ВСПОМОГАТЕЛЬНЫЕ ФУНКЦИИ ====================
+def _has_column(cursor, table, column):
+    return any(row[1] == column for row in cursor.execute(f"PRAGMA table_info({table})"))
+
+
+def _add_column(cursor, table, column, declaration):
+    """Добавляет колонку, если её ещё нет (старые базы могли получить её до миграций)"""
+    if not _has_column(cursor, table, column):
+        cursor.execute(f"ALTER TABLE {table} ADD COLUMN {column} {declaration}")
+
+
+def _create_stats_triggers(cursor, table):
+    """Триггеры на reviews, которые поддерживают агрегаты отзывов в таблице мест"""
+    # Сумма, количество и средняя обновляются инкрементально. Максимум и минимум
+    # пересчитываются запросом только когда удаляется или меняется текущий экстремум.
+    cursor.execute(f"""
+        CREATE TRIGGER IF NOT EXISTS reviews_stats_insert AFTER INSERT ON reviews
+        BEGIN
+            UPDATE {table} SET
+                reviews_count = reviews_count + 1,
+                rating_sum = rating_sum + COALESCE(NEW.rating, 0),
+                rating_count = rating_count + (NEW.rating IS NOT NULL),
+                rate = CAST(rating_sum + COALESCE(NEW.rating, 0) AS REAL)
+                       / NULLIF(rating_count + (NEW.rating IS NOT NULL), 0),
+                max_rate = CASE
+                    WHEN NEW.rating IS NOT NULL AND (max_rate IS NULL OR NEW.rating > max_rate)
+                    THEN NEW.rating ELSE max_rate END,
+                min_rate = CASE
+                    WHEN NEW.rating IS NOT NULL AND (min_rate IS NULL OR NEW.rating < min_rate)
+                    THEN NEW.rating ELSE min_rate END
+            WHERE id_dot = NEW.dot_id;
+        END
+    """)
+    cursor.execute(f"""
+        CREATE TRIGGER IF NOT EXISTS reviews_stats_update AFTER UPDATE OF rating ON reviews
+        WHEN OLD.rating IS NOT NEW.rating
+        BEGIN
+            UPDATE {table} SET
+                rating_sum = rating_sum - COALESCE(OLD.rating, 0) + COALESCE(NEW.rating, 0),
+                rating_count = rating_count - (OLD.rating IS NOT NULL) + (NEW.rating IS NOT NULL),
+                rate = CAST(rating_sum - COALESCE(OLD.rating, 0) + COALESCE(NEW.rating, 0) AS REAL)
+                       / NULLIF(rating_count - (OLD.rating IS NOT NULL) + (NEW.rating IS NOT NULL), 0),
+                max_rate = CASE
+                    WHEN OLD.rating IS NOT NULL AND OLD.rating >= max_rate
+                    THEN (SELECT MAX(rating) FROM reviews WHERE dot_id = NEW.dot_id)
+                    WHEN NEW.rating IS NOT NULL AND (max_rate IS NULL OR NEW.rating > max_rate)
+                    THEN NEW.rating ELSE max_rate END,
+                min_rate = CASE
+                    WHEN OLD.rating IS NOT NULL AND OLD.rating <= min_rate
+                    THEN (SELECT MIN(rating) FROM reviews WHERE dot_id = NEW.dot_id)
+                    WHEN NEW.rating IS NOT NULL AND (min_rate IS NULL OR NEW.rating < min_rate)
+                    THEN NEW.rating ELSE min_rate END
+            WHERE id_dot = NEW.dot_id;
+        END
+    """)
+    cursor.execute(f"""
+        CREATE TRIGGER IF NOT EXISTS reviews_stats_delete AFTER DELETE ON reviews
+        BEGIN
+            UPDATE {table} SET
+                reviews_count = reviews_count - 1,
+                rating_sum = rating_sum - COALESCE(OLD.rating, 0),
+                rating_count = rating_count - (OLD.rating IS NOT NULL),
+                rate = CAST(rating_sum - COALESCE(OLD.rating, 0) AS REAL)
+                       / NULLIF(rating_count - (OLD.rating IS NOT NULL), 0),
+                max_rate = CASE
+                    WHEN OLD.rating IS NOT NULL AND OLD.rating >= max_rate
+                    THEN (SELECT MAX(rating) FROM reviews WHERE dot_id = OLD.dot_id)
+                    ELSE max_rate END,
+                min_rate = CASE
+                    WHEN OLD.rating IS NOT NULL AND OLD.rating <= min_rate
+                    THEN (SELECT MIN(rating) FROM reviews WHERE dot_id = OLD.dot_id)
+                    ELSE min_rate END
+            WHERE id_dot = OLD.dot_id;
+        END
+    """)
+
+
+# ==================== МИГРАЦИИ ====================
+def _base_tables(cursor):
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS users (
+            id INTEGER PRIMARY KEY,
+            status INTEGER DEFAULT (0),
+            is_admin INTEGER,
+            temp_data TEXT
+        )
+    """)
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS city_krasnoyarsk (
+            id_dot INTEGER PRIMARY KEY AUTOINCREMENT,
+            name_dot TEXT,
+            type_dot INTEGER,
+            rate INTEGER,
+            max_rate INTEGER,
+            min_rate INTEGER,
+            max_rate_text TEXT,
+            min_rate_text TEXT
+        )
+    """)
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS favourites (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            user_id INTEGER NOT NULL,
+            dot_id INTEGER NOT NULL,
+            UNIQUE(user_id, dot_id)
+        )
+    """)
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS reviews (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            user_id INTEGER NOT NULL,
+            dot_id INTEGER NOT NULL,
+            review_text TEXT,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+    """)
+
+
+def _dot_photo(cursor):
+    _add_column(cursor, "city_krasnoyarsk", "photo_id", "TEXT")
+
+
+def _review_rating(cursor):
+    _add_column(cursor, "reviews", "rating", "INTEGER")
+
+
+def _dot_address(cursor):
+    _add_column(cursor, "city_krasnoyarsk", "address", "TEXT")
+
+
+def _review_stats(cursor):
+    for column in ("reviews_count", "rating_sum", "rating_count"):
+        _add_column(cursor, "city_krasnoyarsk", column, "INTEGER NOT NULL DEFAULT 0")
+
+    _create_stats_triggers(cursor, "city_krasnoyarsk")
+
+    # Разовое заполнение агрегатов для уже существующих мест
+    cursor.execute(BACKFILL_DOT_STATS.format(table="city_krasnoyarsk"))
+
+
+def _user_state(cursor):
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS user_state (
+            user_id INTEGER PRIMARY KEY,
+            status INTEGER NOT NULL DEFAULT 0,
+            payload TEXT,
+            updated_at REAL NOT NULL
+        )
+    """)
+
+
+def _indexes(cursor):
+    # Отзывы места по дате (get_dot_reviews)
+    cursor.execute("""
+        CREATE INDEX IF NOT EXISTS idx_reviews_dot_created
+        ON reviews (dot_id, created_at, id)
+    """)
+    # MIN/MAX оценки места в триггерах агрегатов - поиск по индексу без чтения строк
+    cursor.execute("""
+        CREATE INDEX IF NOT EXISTS idx_reviews_dot_rating
+        ON reviews (dot_id, rating)
+    """)
+    # Отзыв пользователя о месте (кнопка "Посетил"), покрывающий для has_user_reviewed
+    cursor.execute("""
+        CREATE INDEX IF NOT EXISTS idx_reviews_user_dot
+        ON reviews (user_id, dot_id)
+    """)
+    # Поиск места по названию (get_id_dot_krasnoyarsk)
+    cursor.execute("""
+        CREATE INDEX IF NOT EXISTS idx_city_krasnoyarsk_name
+        ON city_krasnoyarsk (name_dot)
+    """)
+    cursor.execute("ANALYZE")
+
+
+def _places(cursor):
+    # Общая таблица мест всех городов вместо city_krasnoyarsk. id_dot сохраняются,
+    # поэтому ссылки из reviews и favourites остаются верными.
+    cursor.execute("ALTER TABLE city_krasnoyarsk RENAME TO places")
+    _add_column(cursor, "places", "city", "TEXT NOT NULL DEFAULT 'krasnoyarsk'")
+    _add_column(cursor, "users", "city", "TEXT")
+
+    # Триггеры агрегатов пересоздаются на новой таблице
+    for trigger in ("reviews_stats_insert", "reviews_stats_update", "reviews_stats_delete"):
+        cursor.execute(f"DROP TRIGGER IF EXISTS {trigger}")
+    _create_stats_triggers(cursor, "places")
+
+    # Все списки читаются в пределах города: индексы начинаются с city
+    cursor.execute("DROP INDEX IF EXISTS idx_city_krasnoyarsk_name")
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_places_city_id ON places (city, id_dot)")
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_places_city_name ON places (city, name_dot)")
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_places_city_type ON places (city, type_dot)")
+    cursor.execute("ANALYZE")
+
+
+def _search(cursor):
+    # Внешнее содержимое (content=...): тексты хранятся только в places и reviews,
+    # индекс содержит лишь токены. prefix - быстрый поиск по началу слова.
+    cursor.execute("""
+        CREATE VIRTUAL TABLE IF NOT EXISTS places_fts USING fts5(
+            name_dot, address,
+            content='places', content_rowid='id_dot',
+            tokenize='unicode61 remove_diacritics 2', prefix='2 3'
+        )
+    """)
+    cursor.execute("""
+        CREATE VIRTUAL TABLE IF NOT EXISTS reviews_fts USING fts5(
+            review_text,
+            content='reviews', content_rowid='id',
+            tokenize='unicode61 remove_diacritics 2', prefix='2 3'
+        )
+    """)
+
+    # Триггеры синхронизации: для внешнего содержимого удаление из индекса
+    # требует старых значений колонок
+    cursor.execute("""
+        CREATE TRIGGER IF NOT EXISTS places_fts_insert AFTER INSERT ON places
+        BEGIN
+            INSERT INTO places_fts (rowid, name_dot, address)
+            VALUES (NEW.id_dot, NEW.name_dot, NEW.address);
+        END
+    """)
+    cursor.execute("""
+        CREATE TRIGGER IF NOT EXISTS places_fts_delete AFTER DELETE ON places
+        BEGIN
+            INSERT INTO places_fts (places_fts, rowid, name_dot, address)
+            VALUES ('delete', OLD.id_dot, OLD.name_dot, OLD.address);
+        END
+    """)
+    cursor.execute("""
+        CREATE TRIGGER IF NOT EXISTS places_fts_update AFTER UPDATE OF name_dot, address ON places
+        BEGIN
+            INSERT INTO places_fts (places_fts, rowid, name_dot, address)
+            VALUES ('delete', OLD.id_dot, OLD.name_dot, OLD.address);
+            INSERT INTO places_fts (rowid, name_dot, address)
+            VALUES (NEW.id_dot, NEW.name_dot, NEW.address);
+        END
+    """)
+    cursor.execute("""
+        CREATE TRIGGER IF NOT EXISTS reviews_fts_insert AFTER INSERT ON reviews
+        BEGIN
+            INSERT INTO reviews_fts (rowid, review_text) VALUES (NEW.id, NEW.review_text);
+        END
+    """)
+    cursor.execute("""
+        CREATE TRIGGER IF NOT EXISTS reviews_fts_delete AFTER DELETE ON reviews
+        BEGIN
+            INSERT INTO reviews_fts (reviews_fts, rowid, review_text)
+            VALUES ('delete', OLD.id, OLD.review_text);
+        END
+    """)
+    cursor.execute("""
+        CREATE TRIGGER IF NOT EXISTS reviews_fts_update AFTER UPDATE OF review_text ON reviews
+        BEGIN
+            INSERT INTO reviews_fts (reviews_fts, rowid, review_text)
+            VALUES ('delete', OLD.id, OLD.review_text);
+            INSERT INTO reviews_fts (rowid, review_text) VALUES (NEW.id, NEW.review_text);
+        END
+    """)
+
+    # Индексация уже существующих мест и отзывов
+    cursor.execute("INSERT INTO places_fts (places_fts) VALUES ('rebuild')")
+    cursor.execute("INSERT INTO reviews_fts (reviews_fts) VALUES ('rebuild')")
+    cursor.execute("INSERT INTO places_fts (places_fts) VALUES ('optimize')")
+    cursor.execute("INSERT INTO reviews_fts (reviews_fts) VALUES ('optimize')")
+
+
+def _locations(cursor):
+    _add_column(cursor, "places", "lat", "REAL")
+    _add_column(cursor, "places", "lon", "REAL")
+
+    # R-дерево по координатам: поиск ближайших мест читает только места
+    # внутри прямоугольника вокруг пользователя. Точки хранятся как
+    # вырожденные прямоугольники (min = max).
+    cursor.execute("""
+        CREATE VIRTUAL TABLE IF NOT EXISTS places_rtree USING rtree(
+            id, min_lat, max_lat, min_lon, max_lon
+        )
+    """)
+    cursor.execute("""
+        CREATE TRIGGER IF NOT EXISTS places_rtree_insert AFTER INSERT ON places
+        WHEN NEW.lat IS NOT NULL AND NEW.lon IS NOT NULL
+        BEGIN
+            INSERT INTO places_rtree VALUES (NEW.id_dot, NEW.lat, NEW.lat, NEW.lon, NEW.lon);
+        END
+    """)
+    cursor.execute("""
+        CREATE TRIGGER IF NOT EXISTS places_rtree_update AFTER UPDATE OF lat, lon ON places
+        BEGIN
+            DELETE FROM places_rtree WHERE id = OLD.id_dot;
+            INSERT INTO places_rtree
+            SELECT NEW.id_dot, NEW.lat, NEW.lat, NEW.lon, NEW.lon
+            WHERE NEW.lat IS NOT NULL AND NEW.lon IS NOT NULL;
+        END
+    """)
+    cursor.execute("""
+        CREATE TRIGGER IF NOT EXISTS places_rtree_delete AFTER DELETE ON places
+        BEGIN
+            DELETE FROM places_rtree WHERE id = OLD.id_dot;
+        END
+    """)
+
+
+def _card_versions(cursor):
+    # Версия места растет при каждом изменении того, что видно в его карточке,
+    # в том числе агрегатов отзывов (их обновляют триггеры reviews_stats_*).
+    # По версии кэш отрисованных карточек (cache.CardCache) узнает об изменениях.
+    # Триггер не срабатывает повторно от собственного UPDATE: рекурсивные
+    # триггеры в SQLite по умолчанию выключены.
+    _add_column(cursor, "places", "version", "INTEGER NOT NULL DEFAULT 1")
+    cursor.execute("""
+        CREATE TRIGGER IF NOT EXISTS places_version
+        AFTER UPDATE OF name_dot, type_dot, photo_id, address, reviews_count, rate ON places
+        BEGIN
+            UPDATE places SET version = OLD.version + 1 WHERE id_dot = NEW.id_dot;
+        END
+    """)
+
+
+def _pending_deletions(cursor):
+    # Временные сообщения бота, которые нужно удалить (см. deleter.DeletionScheduler)
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS pending_deletions (
+            chat_id INTEGER NOT NULL,
+            message_id INTEGER NOT NULL,
+            due_at REAL NOT NULL,
+            PRIMARY KEY (chat_id, message_id)
+        ) WITHOUT ROWID
+    """)
+
+
+def _leaderboard(cursor):
+    # Готовый рейтинг мест по городу и типу: топ-N - одно чтение индекса
+    # idx_place_scores_rank. В таблице только места с оценками. Строка места
+    # обновляется триггером при изменении его агрегатов (их поддерживают
+    # триггеры reviews_stats_*), города или типа.
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS place_scores (
+            id_dot INTEGER PRIMARY KEY,
+            city TEXT NOT NULL,
+            type_dot INTEGER,
+            score REAL NOT NULL,
+            rating_count INTEGER NOT NULL
+        ) WITHOUT ROWID
+    """)
+    cursor.execute("""
+        CREATE INDEX IF NOT EXISTS idx_place_scores_rank
+        ON place_scores (city, type_dot, score DESC, id_dot)
+    """)
+    cursor.execute(f"""
+        CREATE TRIGGER IF NOT EXISTS place_scores_update
+        AFTER UPDATE OF rating_sum, rating_count, city, type_dot ON places
+        BEGIN
+            DELETE FROM place_scores WHERE id_dot = NEW.id_dot AND NEW.rating_count = 0;
+            INSERT OR REPLACE INTO place_scores (id_dot, city, type_dot, score, rating_count)
+            SELECT NEW.id_dot, NEW.city, NEW.type_dot, {PLACE_SCORE.format(p="NEW")}, NEW.rating_count
+            WHERE NEW.rating_count > 0;
+        END
+    """)
+    cursor.execute("""
+        CREATE TRIGGER IF NOT EXISTS place_scores_delete AFTER DELETE ON places
+        BEGIN
+            DELETE FROM place_scores WHERE id_dot = OLD.id_dot;
+        END
+    """)
+    cursor.execute(f"""
+        INSERT OR REPLACE INTO place_scores (id_dot, city, type_dot, score, rating_count)
+        SELECT d.id_dot, d.city, d.type_dot, {PLACE_SCORE.format(p="d")}, d.rating_count
+        FROM places d WHERE d.rating_count > 0
+    """)
+
+
+def _place_photos(cursor):
+    # Галерея места: place_photos - все фото в порядке добавления. В places
+    # остаются обложка (photo_id - первое фото галереи) и число фото
+    # (photos_count): их поддерживают триггеры, поэтому ленте мест не нужен
+    # JOIN с галереей. Число фото видно в карточке (кнопка галереи), поэтому
+    # триггер версии карточки пересоздается с photos_count.
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS place_photos (
+            id INTEGER PRIMARY KEY,
+            id_dot INTEGER NOT NULL,
+            file_id TEXT NOT NULL,
+            added_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            UNIQUE (id_dot, file_id)
+        )
+    """)
+    _add_column(cursor, "places", "photos_count", "INTEGER NOT NULL DEFAULT 0")
+    cursor.execute("""
+        CREATE TRIGGER IF NOT EXISTS place_photos_insert AFTER INSERT ON place_photos
+        BEGIN
+            UPDATE places SET
+                photos_count = photos_count + 1,
+                photo_id = COALESCE(photo_id, NEW.file_id)
+            WHERE id_dot = NEW.id_dot;
+        END
+    """)
+    cursor.execute("""
+        CREATE TRIGGER IF NOT EXISTS place_photos_delete AFTER DELETE ON place_photos
+        BEGIN
+            UPDATE places SET
+                photos_count = photos_count - 1,
+                photo_id = (SELECT file_id FROM place_photos
+                            WHERE id_dot = OLD.id_dot ORDER BY id LIMIT 1)
+            WHERE id_dot = OLD.id_dot;
+        END
+    """)
+    cursor.execute("""
+        CREATE TRIGGER IF NOT EXISTS places_photos_cleanup AFTER DELETE ON places
+        BEGIN
+            DELETE FROM place_photos WHERE id_dot = OLD.id_dot;
+        END
+    """)
+    cursor.execute("DROP TRIGGER IF EXISTS places_version")
+    cursor.execute("""
+        CREATE TRIGGER places_version
+        AFTER UPDATE OF name_dot, type_dot, photo_id, photos_count, address, reviews_count, rate
+        ON places
+        BEGIN
+            UPDATE places SET version = OLD.version + 1 WHERE id_dot = NEW.id_dot;
+        END
+    """)
+    # Единственное фото места становится первым фото его галереи
+    cursor.execute("""
+        INSERT OR IGNORE INTO place_photos (id_dot, file_id)
+        SELECT id_dot, photo_id FROM places WHERE photo_id IS NOT NULL ORDER BY id_dot
+    """)
+
+
+def _global_card_versions(cursor):
+    # Версии карточек из одного счетчика на всю базу. id мест переиспользуются
+    # (get_next_available_id - MAX + 1), и у нового места на месте удаленного
+    # версия снова начиналась с 1: пара (id, версия) могла совпасть с
+    # карточкой удаленного места в кэше. Теперь каждая вставка и каждое
+    # изменение места получают ещё не выданную версию.
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS card_version_seq (
+            id INTEGER PRIMARY KEY CHECK (id = 1),
+            value INTEGER NOT NULL
+        )
+    """)
+    cursor.execute("""
+        INSERT OR IGNORE INTO card_version_seq (id, value)
+        SELECT 1, COALESCE(MAX(version), 0) FROM places
+    """)
+    cursor.execute("DROP TRIGGER IF EXISTS places_version")
+    cursor.execute("""
+        CREATE TRIGGER places_version
+        AFTER UPDATE OF name_dot, type_dot, photo_id, photos_count, address, reviews_count, rate
+        ON places
+        BEGIN
+            UPDATE card_version_seq SET value = value + 1 WHERE id = 1;
+            UPDATE places SET version = (SELECT value FROM card_version_seq WHERE id = 1)
+            WHERE id_dot = NEW.id_dot;
+        END
+    """)
+    cursor.execute("""
+        CREATE TRIGGER IF NOT EXISTS places_version_insert AFTER INSERT ON places
+        BEGIN
+            UPDATE card_version_seq SET value = value + 1 WHERE id = 1;
+            UPDATE places SET version = (SELECT value FROM card_version_seq WHERE id = 1)
+            WHERE id_dot = NEW.id_dot;
+        END
+    """)
+
+
+def _search_prefixes(cursor):
+    # Префиксные индексы '2 3' не помогали словам от 4 букв: префиксный запрос
+    # "кафе"* перебирал индекс и на миллионе отзывов стоил ~40 мс вместо ~10.
+    # Набор префиксов задается только при создании таблицы FTS5, поэтому
+    # индексы пересоздаются (триггеры синхронизации ссылаются на них по имени
+    # и остаются прежними) и перестраиваются из places и reviews.
+    prefix = " ".join(map(str, FTS_PREFIX_LENGTHS))
+    for table, columns, content, rowid in (
+        ("places_fts", "name_dot, address", "places", "id_dot"),
+        ("reviews_fts", "review_text", "reviews", "id"),
+    ):
+        cursor.execute(f"DROP TABLE IF EXISTS {table}")
+        cursor.execute(f"""
+            CREATE VIRTUAL TABLE {table} USING fts5(
+                {columns},
+                content='{content}', content_rowid='{rowid}',
+                tokenize='unicode61 remove_diacritics 2', prefix='{prefix}'
+            )
+        """)
+        cursor.execute(f"INSERT INTO {table} ({table}) VALUES ('rebuild')")
+        cursor.execute(f"INSERT INTO {table} ({table}) VALUES ('optimize')")
+
+
+# Номер версии, описание, функция(cursor). Новые миграции - только в конец списка,
+# уже выпущенные миграции не меняются.
+MIGRATIONS = [
+    (1, "Базовые таблицы", _base_tables),
+    (2, "Фото мест", _dot_photo),
+    (3, "Оценка в отзывах", _review_rating),
+    (4, "Адреса мест", _dot_address),
+    (5, "Агрегаты отзывов", _review_stats),
+    (6, "Состояния диалогов", _user_state),
+    (7, "Индексы для отзывов и поиска по названию", _indexes),
+    (8, "Места нескольких городов", _places),
+    (9, "Полнотекстовый поиск", _search),
+    (10, "Координаты мест", _locations),
+    (11, "Версии карточек мест", _card_versions),
+    (12, "Отложенное удаление сообщений", _pending_deletions),
+    (13, "Рейтинг мест по типам", _leaderboard),
+    (14, "Галереи фото мест", _place_photos),
+    (15, "Общий счетчик версий карточек", _global_card_versions),
+    (16, "Длинные префиксы полнотекстового поиска", _search_prefixes),
+]
+
+
+# ==================== ЗАПУСК ====================
+def migrate(connection):
+    """Применяет недостающие миграции, каждую в своей транзакции.
+
+    Возвращает список (версия, описание, секунды) примененных миграций.
+    """
+    cursor = connection.cursor()
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS schema_migrations (
+            version INTEGER PRIMARY KEY,
+            description TEXT,
+            applied_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+    """)
+    connection.commit()
+    applied = {row[0] for row in cursor.execute("SELECT version FROM schema_migrations")}
+
+    started = time.perf_counter()
+    done = []
+    for version, description, apply in MIGRATIONS:
+        if version in applied:
+            continue
+        migration_started = time.perf_counter()
+        # IMMEDIATE: миграции ждут других писателей, а не падают с "database is locked"
+        cursor.execute("BEGIN IMMEDIATE")
+        try:
+            # Другой процесс мог применить миграцию, пока эта ждала блокировку
+            if cursor.execute("SELECT 1 FROM schema_migrations WHERE version = ?",
+                              (version,)).fetchone():
+                connection.rollback()
+                continue
+            apply(cursor)
+            cursor.execute(
+                "INSERT INTO schema_migrations (version, description) VALUES(?, ?)",
+                (version, description)
+            )
+            connection.commit()
+        except Exception:
+            connection.rollback()
+            logger.critical(f"Миграция {version} ({description}) не применена", exc_info=True)
+            raise
+        elapsed = time.perf_counter() - migration_started
+        logger.info(f"Миграция {version} ({description}) применена за {elapsed * 1000:.1f} мс")
+        done.append((version, description, elapsed))
+
+    total = time.perf_counter() - started
+    current = max([version for version, _, _ in MIGRATIONS])
+    logger.info(f"Схема БД: версия {current}, применено миграций: {len(done)} "
+                f"за {total * 1000:.1f} мс")
+    return done
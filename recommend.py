@@ -0,0 +1,273 @@
+"""Рекомендации мест ("Рекомендуем вам") по схожести мест (item-item).
+
+Взаимодействия пользователей с местами (избранное и отзывы с оценками, веса
+см. SQL.INTERACTIONS_QUERY) образуют разреженную матрицу пользователь x место.
+Схожесть двух мест - косинус между их столбцами: насколько одни и те же
+пользователи отмечали оба места. Для каждого места хранятся neighbours самых
+похожих мест, а рекомендации пользователю - места, похожие на его места,
+с суммой схожестей, взвешенных его оценками.
+
+Модель целиком пересчитывается в отдельном процессе (ProcessPoolExecutor),
+чтобы расчет не занимал event loop и GIL бота: периодически и после
+rebuild_changes новых взаимодействий. Новые избранные и оценки пользователя
+учитываются сразу: его рекомендации сбрасываются из кэша и считаются заново
+по действующей модели с его свежими взаимодействиями из БД.
+"""
+import asyncio
+import logging
+import multiprocessing
+import time
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+
+class ItemModel:
+    """Похожие места для каждого места в виде CSR: соседи места item_ids[i] -
+    neighbours[indptr[i]:indptr[i + 1]] (индексы в item_ids) со схожестями scores"""
+
+    def __init__(self, item_ids, item_cities, cities, indptr, neighbours, scores, stats):
+        self.item_ids = item_ids
+        self.item_cities = item_cities  # номер города места в cities
+        self.cities = {city: code for code, city in enumerate(cities)}
+        self.indptr = indptr
+        self.neighbours = neighbours
+        self.scores = scores
+        self.stats = stats
+
+    def recommend(self, interactions, city, limit=10):
+        """id мест города city, похожих на места пользователя; interactions -
+        [(id_dot, вес)]. Места, с которыми пользователь уже взаимодействовал,
+        не рекомендуются"""
+        code = self.cities.get(city)
+        if code is None or not interactions or not len(self.item_ids):
+            return []
+        items = np.array([item for item, _ in interactions], dtype=np.int64)
+        weights = np.array([weight for _, weight in interactions], dtype=np.float32)
+        index = np.searchsorted(self.item_ids, items)
+        known = index < len(self.item_ids)
+        known[known] = self.item_ids[index[known]] == items[known]
+        index, weights = index[known], weights[known]
+        if not len(index):
+            return []
+
+        # Соседи всех мест пользователя одним массивом
+        starts, lengths = self.indptr[index], self.indptr[index + 1] - self.indptr[index]
+        total = int(lengths.sum())
+        if not total:
+            return []
+        offsets = np.arange(total) - np.repeat(np.cumsum(lengths) - lengths, lengths)
+        positions = np.repeat(starts, lengths) + offsets
+        candidates = self.neighbours[positions]
+        contributions = self.scores[positions] * np.repeat(weights, lengths)
+
+        candidates, inverse = np.unique(candidates, return_inverse=True)
+        totals = np.bincount(inverse, weights=contributions)
+        allowed = (self.item_cities[candidates] == code) & ~np.isin(candidates, index)
+        candidates, totals = candidates[allowed], totals[allowed]
+        if len(candidates) > limit:
+            best = np.argpartition(-totals, limit)[:limit]
+            candidates, totals = candidates[best], totals[best]
+        order = np.lexsort((candidates, -totals))
+        return self.item_ids[candidates[order]].tolist()
+
+
+def compute_model(interactions, places, neighbours=50, max_user_items=200, shrink=5.0):
+    """Считает ItemModel по взаимодействиям [(user_id, id_dot, вес)] и местам
+    [(id_dot, city)].
+
+    Схожесть - косинус, умноженный на n / (n + shrink), где n - число общих
+    пользователей: пара мест, которую отметил один человек, не получает
+    схожесть 1. У пользователя учитываются не больше max_user_items мест с
+    наибольшим весом - число пар растет как квадрат числа мест пользователя.
+    """
+    started = time.perf_counter()
+    places = sorted(places)
+    item_ids = np.array([id_dot for id_dot, _ in places], dtype=np.int64)
+    cities = sorted({city for _, city in places})
+    city_codes = {city: code for code, city in enumerate(cities)}
+    item_cities = np.array([city_codes[city] for _, city in places], dtype=np.int32)
+    n_items = len(item_ids)
+
+    data = np.array(interactions, dtype=np.float64).reshape(-1, 3)
+    users, items, weights = data[:, 0].astype(np.int64), data[:, 1].astype(np.int64), data[:, 2]
+    # Места, удаленные после чтения взаимодействий, пропускаются
+    index = np.searchsorted(item_ids, items)
+    known = index < n_items
+    known[known] = item_ids[index[known]] == items[known]
+    users, items, weights = users[known], index[known], weights[known]
+
+    # Группы по пользователям, внутри - по убыванию веса; обрезка до max_user_items
+    order = np.lexsort((-weights, users))
+    users, items, weights = users[order], items[order], weights[order]
+    starts = np.flatnonzero(np.r_[True, users[1:] != users[:-1]]) if len(users) else np.array([], int)
+    counts = np.diff(np.r_[starts, len(users)])
+    rank = np.arange(len(users)) - np.repeat(starts, counts)
+    keep = rank < max_user_items
+    users, items, weights = users[keep], items[keep], weights[keep]
+    starts = np.flatnonzero(np.r_[True, users[1:] != users[:-1]]) if len(users) else np.array([], int)
+    counts = np.diff(np.r_[starts, len(users)])
+
+    # Все пары мест внутри каждого пользователя (включая пары места с собой -
+    # из них получаются нормы столбцов)
+    per_entry = np.repeat(counts, counts)
+    total = int(per_entry.sum())
+    left = np.repeat(np.arange(len(users)), per_entry)
+    offsets = np.arange(total) - np.repeat(np.cumsum(per_entry) - per_entry, per_entry)
+    right = np.repeat(np.repeat(starts, counts), per_entry) + offsets
+    keys, inverse = np.unique(items[left] * n_items + items[right], return_inverse=True)
+    products = np.bincount(inverse, weights=weights[left] * weights[right])
+    together = np.bincount(inverse)
+    first, second = keys // n_items, keys % n_items
+
+    norms = np.zeros(n_items)
+    diagonal = first == second
+    norms[first[diagonal]] = np.sqrt(products[diagonal])
+    pairs = ~diagonal
+    first, second = first[pairs], second[pairs]
+    similarity = products[pairs] / (norms[first] * norms[second])
+    similarity *= together[pairs] / (together[pairs] + shrink)
+
+    # neighbours самых похожих мест для каждого места
+    order = np.lexsort((-similarity, first))
+    first, second, similarity = first[order], second[order], similarity[order]
+    starts = np.searchsorted(first, np.arange(n_items))
+    keep = np.arange(len(first)) - starts[first] < neighbours
+    first, second, similarity = first[keep], second[keep], similarity[keep]
+    indptr = np.searchsorted(first, np.arange(n_items + 1))
+
+    stats = {
+        "places": n_items,
+        "interactions": len(users),
+        "pairs": total,
+        "links": len(second),
+        "seconds": round(time.perf_counter() - started, 3),
+    }
+    return ItemModel(item_ids, item_cities, cities, indptr,
+                     second.astype(np.int32), similarity.astype(np.float32), stats)
+
+
+def build_model(database, neighbours=50, max_user_items=200):
+    """Читает взаимодействия из БД и считает модель (выполняется в процессе пула)"""
+    from base import SQL
+
+    db = SQL(database, readonly=True)
+    try:
+        interactions = db.get_interactions()
+        places = db.get_dot_cities()
+    finally:
+        db.close()
+    return compute_model(interactions, places, neighbours, max_user_items)
+
+
+class Recommender:
+    """Рекомендации пользователям: модель из пула процессов и LRU-кэш ответов.
+
+    Повторный запрос рекомендаций - поиск в кэше. Кэш пользователя сбрасывается
+    при его новых взаимодействиях (touch), а весь кэш - с выходом новой модели.
+    """
+
+    def __init__(self, db, rebuild_interval=3600, rebuild_changes=200, min_rebuild_interval=60,
+                 cache_size=10000, neighbours=50, max_user_items=200):
+        self._db = db
+        self.rebuild_interval = rebuild_interval
+        self.rebuild_changes = rebuild_changes
+        self.min_rebuild_interval = min_rebuild_interval
+        self.cache_size = cache_size
+        self.neighbours = neighbours
+        self.max_user_items = max_user_items
+        self.model = None
+        self._cache = OrderedDict()  # user_id -> (модель, город, id мест)
+        self._changes = 0
+        self._wakeup = asyncio.Event()
+        self._pool = None
+        self._task = None
+        self.hits = 0
+        self.misses = 0
+
+    # ---------- Жизненный цикл ----------
+    async def start(self):
+        """Запускает пул процессов и фоновый пересчет (первый - сразу)"""
+        if self._task is None:
+            self._pool = ProcessPoolExecutor(max_workers=1,
+                                             mp_context=multiprocessing.get_context("spawn"))
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        if self._pool is not None:
+            self._pool.shutdown(wait=False, cancel_futures=True)
+            self._pool = None
+
+    # ---------- Рекомендации ----------
+    async def recommend(self, user_id, city, limit=10):
+        """id рекомендованных мест города, лучшие первыми ([] - пока нечего советовать)"""
+        model = self.model
+        entry = self._cache.get(user_id)
+        if entry is not None and entry[0] is model and entry[1] == city:
+            self._cache.move_to_end(user_id)
+            self.hits += 1
+            return entry[2][:limit]
+
+        self.misses += 1
+        if model is None:
+            return []
+        interactions = await self._db.get_user_interactions(user_id)
+        ids = model.recommend(interactions, city, limit)
+        self._cache[user_id] = (model, city, ids)
+        self._cache.move_to_end(user_id)
+        while len(self._cache) > self.cache_size:
+            self._cache.popitem(last=False)
+        return ids
+
+    def touch(self, user_id):
+        """Новое взаимодействие пользователя: пересчитать его рекомендации"""
+        self._cache.pop(user_id, None)
+        self._changes += 1
+        if self._changes >= self.rebuild_changes:
+            self._wakeup.set()
+
+    def stats(self):
+        return {
+            "model": self.model.stats if self.model is not None else None,
+            "cached": len(self._cache),
+            "hits": self.hits,
+            "misses": self.misses,
+            "changes": self._changes,
+        }
+
+    # ---------- Пересчет модели ----------
+    async def rebuild(self):
+        """Пересчитывает модель в процессе пула"""
+        loop = asyncio.get_running_loop()
+        changes = self._changes
+        model = await loop.run_in_executor(self._pool, build_model, self._db.database,
+                                           self.neighbours, self.max_user_items)
+        self._changes -= changes
+        self.model = model
+        logger.info(f"Модель рекомендаций пересчитана: {model.stats}")
+
+    async def _run(self):
+        while True:
+            self._wakeup.clear()
+            started = time.monotonic()
+            try:
+                await self.rebuild()
+            except Exception as e:
+                logger.error(f"Не удалось пересчитать рекомендации: {e}", exc_info=True)
+            # Не чаще min_rebuild_interval, даже если изменений много
+            await asyncio.sleep(max(0.0, started + self.min_rebuild_interval - time.monotonic()))
+            if self._changes < self.rebuild_changes:
+                try:
+                    await asyncio.wait_for(self._wakeup.wait(), self.rebuild_interval)
+                except asyncio.TimeoutError:
+                    pass
@@ -0,0 +1,274 @@
+import asyncio
+import heapq
+import itertools
+import logging
+import time
+from collections import deque
+
+from aiogram.exceptions import TelegramRetryAfter
+
+logger = logging.getLogger(__name__)
+
+
+class TokenBucket:
+    """Ведро токенов: rate токенов в секунду, не больше capacity за раз"""
+
+    __slots__ = ("rate", "capacity", "tokens", "updated")
+
+    def __init__(self, rate, capacity):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+
+    def _refill(self, now):
+        if now > self.updated:
+            self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+
+    def delay(self, now):
+        """Сколько секунд ждать до появления токена"""
+        self._refill(now)
+        if self.tokens >= 1:
+            return 0.0
+        return (1 - self.tokens) / self.rate
+
+    def consume(self, now):
+        self._refill(now)
+        self.tokens -= 1
+
+    def pause(self, seconds, now):
+        """Не выдавать токены ближайшие seconds секунд (ответ retry_after)"""
+        self._refill(now)
+        self.tokens = min(self.tokens, 1 - seconds * self.rate)
+
+    def is_full(self, now):
+        self._refill(now)
+        return self.tokens >= self.capacity
+
+
+class _Job:
+    __slots__ = ("factory", "future", "key", "deadline", "enqueued", "attempts")
+
+    def __init__(self, factory, future, key, deadline, enqueued):
+        self.factory = factory
+        self.future = future
+        self.key = key
+        self.deadline = deadline
+        self.enqueued = enqueued
+        self.attempts = 0
+
+
+class SendScheduler:
+    """Очередь исходящих запросов к Telegram.
+
+    Соблюдает общий лимит бота и лимит на каждый чат (ведра токенов), внутри
+    одного чата отправляет строго по порядку. На ответ retry_after чат ставится
+    на паузу, а запрос повторяется. Запросы с одинаковым key в одном чате
+    схлопываются в последний, запросы старше ttl выбрасываются (результат None).
+    """
+
+    def __init__(self, global_rate=25, chat_rate=1, chat_burst=3, max_retries=3):
+        self.max_retries = max_retries
+        self.global_rate = global_rate
+        self._global = TokenBucket(global_rate, global_rate)
+        self._chat_rate = chat_rate
+        self._chat_burst = chat_burst
+        self._queues = {}       # chat_id -> deque[_Job]
+        self._buckets = {}      # chat_id -> TokenBucket
+        self._busy = set()      # чаты, у которых запрос уже выполняется
+        self._scheduled = set() # чаты, которые лежат в куче _ready
+        self._ready = []        # куча (время готовности, seq, chat_id)
+        self._seq = itertools.count()
+        self._wakeup = asyncio.Event()
+        self._task = None
+        self._depth = 0
+        self._last_sweep = time.monotonic()
+        self._waits = deque(maxlen=1000)
+        self.sent = 0
+        self.failed = 0
+        self.retried = 0
+        self.dropped = 0
+        self.coalesced = 0
+
+    # ---------- Публичный интерфейс ----------
+    def start(self):
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+    def set_global_rate(self, rate):
+        """Меняет общий лимит бота (например, когда его делят несколько процессов)"""
+        self.global_rate = rate
+        self._global = TokenBucket(rate, rate)
+
+    def submit(self, chat_id, factory, key=None, ttl=None):
+        """Ставит запрос в очередь и возвращает future с его результатом.
+
+        factory - функция без аргументов, возвращающая корутину запроса
+        (вызывается заново при повторе). chat_id=None - запрос вне чата,
+        ограничивается только общим лимитом.
+        """
+        loop = asyncio.get_running_loop()
+        now = time.monotonic()
+        deadline = now + ttl if ttl is not None else None
+        queue = self._queues.setdefault(chat_id, deque())
+
+        if key is not None:
+            for job in queue:
+                if job.key == key and not job.future.done():
+                    # Более новый запрос заменяет ещё не отправленный
+                    job.factory = factory
+                    job.deadline = deadline
+                    self.coalesced += 1
+                    return job.future
+
+        job = _Job(factory, loop.create_future(), key, deadline, now)
+        queue.append(job)
+        self._depth += 1
+        self._schedule(chat_id)
+        return job.future
+
+    async def send(self, chat_id, factory, key=None, ttl=None):
+        """Ставит запрос в очередь и дожидается результата"""
+        return await self.submit(chat_id, factory, key=key, ttl=ttl)
+
+    def stats(self):
+        """Глубина очереди, время ожидания в очереди (сек.) и счетчики"""
+        waits = sorted(self._waits)
+        return {
+            "depth": self._depth,
+            "chats": len(self._queues),
+            "wait_avg": sum(waits) / len(waits) if waits else 0.0,
+            "wait_p95": waits[int(len(waits) * 0.95)] if waits else 0.0,
+            "wait_max": waits[-1] if waits else 0.0,
+            "sent": self.sent,
+            "failed": self.failed,
+            "retried": self.retried,
+            "dropped": self.dropped,
+            "coalesced": self.coalesced,
+        }
+
+    # ---------- Планирование ----------
+    def _bucket(self, chat_id):
+        if chat_id is None:
+            return None
+        bucket = self._buckets.get(chat_id)
+        if bucket is None:
+            bucket = self._buckets[chat_id] = TokenBucket(self._chat_rate, self._chat_burst)
+        return bucket
+
+    def _schedule(self, chat_id):
+        if chat_id in self._busy or chat_id in self._scheduled:
+            return
+        now = time.monotonic()
+        bucket = self._bucket(chat_id)
+        ready_at = now + (bucket.delay(now) if bucket else 0.0)
+        heapq.heappush(self._ready, (ready_at, next(self._seq), chat_id))
+        self._scheduled.add(chat_id)
+        self._wakeup.set()
+
+    async def _run(self):
+        while True:
+            if not self._ready:
+                self._wakeup.clear()
+                await self._wakeup.wait()
+                continue
+
+            ready_at, _, chat_id = self._ready[0]
+            now = time.monotonic()
+            if now - self._last_sweep > 60:
+                self._sweep(now)
+            delay = max(ready_at - now, self._global.delay(now))
+            if delay > 0:
+                # Ждём, но просыпаемся раньше, если появился новый запрос
+                self._wakeup.clear()
+                try:
+                    await asyncio.wait_for(self._wakeup.wait(), delay)
+                except asyncio.TimeoutError:
+                    pass
+                continue
+
+            heapq.heappop(self._ready)
+            self._scheduled.discard(chat_id)
+            bucket = self._bucket(chat_id)
+            # Пауза чата могла измениться после постановки в кучу
+            if bucket and bucket.delay(now) > 0:
+                self._schedule(chat_id)
+                continue
+
+            queue = self._queues.get(chat_id)
+            if not queue:
+                continue
+            job = queue.popleft()
+            self._depth -= 1
+
+            if job.future.done():
+                self._finish(chat_id)
+                continue
+            if job.deadline is not None and now > job.deadline:
+                self.dropped += 1
+                job.future.set_result(None)
+                self._finish(chat_id)
+                continue
+
+            self._waits.append(now - job.enqueued)
+            self._global.consume(now)
+            if bucket:
+                bucket.consume(now)
+                self._busy.add(chat_id)
+            asyncio.create_task(self._execute(chat_id, job))
+            if not bucket:
+                self._finish(chat_id)
+
+    async def _execute(self, chat_id, job):
+        try:
+            result = await job.factory()
+        except TelegramRetryAfter as e:
+            job.attempts += 1
+            if job.attempts <= self.max_retries:
+                self.retried += 1
+                logger.warning(f"Лимит Telegram для чата {chat_id}, пауза {e.retry_after} с.")
+                now = time.monotonic()
+                bucket = self._bucket(chat_id) or self._global
+                bucket.pause(e.retry_after, now)
+                self._queues.setdefault(chat_id, deque()).appendleft(job)
+                self._depth += 1
+            else:
+                self.failed += 1
+                if not job.future.done():
+                    job.future.set_exception(e)
+        except Exception as e:
+            self.failed += 1
+            if not job.future.done():
+                job.future.set_exception(e)
+        else:
+            self.sent += 1
+            if not job.future.done():
+                job.future.set_result(result)
+        finally:
+            self._busy.discard(chat_id)
+            self._finish(chat_id)
+
+    def _finish(self, chat_id):
+        """Планирует следующий запрос чата или убирает пустой чат"""
+        if self._queues.get(chat_id):
+            self._schedule(chat_id)
+            return
+        self._queues.pop(chat_id, None)
+
+    def _sweep(self, now):
+        """Удаляет ведра простаивающих чатов: полное ведро ничего не ограничивает"""
+        self._last_sweep = now
+        idle = [chat_id for chat_id, bucket in self._buckets.items()
+                if chat_id not in self._queues and bucket.is_full(now)]
+        for chat_id in idle:
+            del self._buckets[chat_id]
@@ -0,0 +1,151 @@
+import asyncio
+import json
+import logging
+import time
+
+logger = logging.getLogger(__name__)
+
+
+class UserState:
+    """Состояние диалога пользователя: статус и данные текущего шага"""
+
+    __slots__ = ("status", "data", "touched", "saved")
+
+    def __init__(self, status=0, data=None, saved=None):
+        self.status = status
+        self.data = data if data is not None else {}
+        self.touched = time.monotonic()
+        # Последнее записанное в БД состояние - чтобы писать только изменения
+        self.saved = saved
+
+    def dump(self):
+        """Компактное представление для сравнения и записи в БД"""
+        payload = json.dumps(self.data, ensure_ascii=False, separators=(",", ":")) if self.data else None
+        return self.status, payload
+
+
+class StateStore:
+    """Хранилище состояний диалогов.
+
+    Состояния живут в памяти и вытесняются, если к ним не обращались ttl секунд.
+    Все изменения раз в flush_interval секунд одной транзакцией сбрасываются в
+    таблицу user_state, поэтому шаги диалога не пишут в БД по отдельности, а
+    незавершенные диалоги переживают перезапуск бота. Данные можно менять прямо
+    в state.data - при сбросе записываются только реально изменившиеся состояния.
+    """
+
+    def __init__(self, db, ttl=1800, flush_interval=2.0, persist_ttl=7 * 24 * 3600):
+        self._db = db
+        self.ttl = ttl
+        self.flush_interval = flush_interval
+        self.persist_ttl = persist_ttl
+        self._states = {}
+        self._touched = set()  # пользователи, чьи состояния могли измениться
+        # Сколько секунд после обращения состояние ещё проверяется на изменения:
+        # обработчик может изменить state.data уже после очередного сброса
+        self.grace = 30
+        self._task = None
+
+    # ---------- Жизненный цикл ----------
+    async def start(self):
+        """Удаляет давно забытые состояния из БД и запускает фоновый сброс"""
+        await self._db.purge_user_states(time.time() - self.persist_ttl)
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        """Останавливает фоновый сброс и записывает оставшиеся изменения"""
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        await self.flush()
+
+    # ---------- Доступ к состояниям ----------
+    async def get(self, user_id) -> UserState:
+        """Возвращает состояние пользователя (из памяти или из БД)"""
+        state = self._states.get(user_id)
+        if state is None:
+            row = await self._db.get_user_state(user_id)
+            # Пока ждали БД, состояние могло появиться
+            state = self._states.get(user_id)
+            if state is None:
+                if row:
+                    status, payload = row
+                    state = UserState(status, json.loads(payload) if payload else {}, saved=row)
+                else:
+                    state = UserState(saved=(0, None))
+                self._states[user_id] = state
+        state.touched = time.monotonic()
+        self._touched.add(user_id)
+        return state
+
+    async def set_status(self, user_id, status):
+        """Меняет статус, сохраняя данные сессии"""
+        state = await self.get(user_id)
+        state.status = status
+
+    async def set(self, user_id, status, data=None):
+        """Начинает новый шаг: меняет статус и заменяет данные сессии"""
+        state = await self.get(user_id)
+        state.status = status
+        state.data = data if data is not None else {}
+
+    async def reset(self, user_id):
+        """Завершает диалог: статус 0 и пустые данные"""
+        await self.set(user_id, 0)
+
+    # ---------- Сброс в БД ----------
+    async def flush(self):
+        """Записывает изменившиеся состояния и вытесняет устаревшие из памяти"""
+        touched, self._touched = self._touched, set()
+        saved, cleared = [], []
+        now = time.time()
+        for user_id in touched:
+            state = self._states.get(user_id)
+            if state is None:
+                continue
+            dump = state.dump()
+            if dump == state.saved:
+                continue
+            if dump == (0, None):
+                cleared.append(user_id)
+            else:
+                saved.append((user_id, dump[0], dump[1], now))
+            state.saved = dump
+
+        if saved or cleared:
+            try:
+                await self._db.save_user_states(saved, cleared)
+            except Exception as e:
+                logger.error(f"Не удалось сохранить состояния: {e}")
+                # Повторим при следующем сбросе
+                for user_id in touched:
+                    state = self._states.get(user_id)
+                    if state is not None:
+                        state.saved = None
+                self._touched |= touched
+                return
+
+        recent = time.monotonic() - self.grace
+        self._touched |= {user_id for user_id in touched
+                          if user_id in self._states and self._states[user_id].touched > recent}
+        self._evict()
+
+    def _evict(self):
+        deadline = time.monotonic() - self.ttl
+        expired = [user_id for user_id, state in self._states.items()
+                   if state.touched < deadline and user_id not in self._touched]
+        for user_id in expired:
+            del self._states[user_id]
+
+    async def _run(self):
+        while True:
+            await asyncio.sleep(self.flush_interval)
+            await self.flush()
+
+    def __len__(self):
+        return len(self._states)
@@ -0,0 +1,132 @@
+import asyncio
+import hmac
+import logging
+import time
+from collections import deque
+
+from aiohttp import web
+from aiogram.types import Update
+
+logger = logging.getLogger(__name__)
+
+SECRET_HEADER = "X-Telegram-Bot-Api-Secret-Token"
+
+
+class WebhookServer:
+    """Прием обновлений Telegram через webhook на aiohttp.
+
+    Запрос проверяется по секретному заголовку, обновление кладется в
+    ограниченную очередь, и Telegram сразу получает ответ 200. Обновления из
+    очереди обрабатывают workers задач через dp.feed_update, поэтому
+    одновременно обрабатывается не больше workers обновлений. Если очередь
+    полна, сервер отвечает 503 - Telegram повторит доставку позже, а
+    обновления не копятся в памяти без предела.
+    """
+
+    def __init__(self, dp, bot, url, secret, path="/webhook", host="0.0.0.0", port=8080,
+                 queue_size=1000, workers=32, allowed_updates=None):
+        self.dp = dp
+        self.bot = bot
+        self.url = url
+        self.secret = secret
+        # compare_digest сравнивает str только из ASCII, поэтому сравниваются байты
+        self._secret_bytes = secret.encode()
+        self.path = path
+        self.host = host
+        self.port = port
+        self.workers = workers
+        self.allowed_updates = allowed_updates
+        self._queue = asyncio.Queue(maxsize=queue_size)
+        self._tasks = []
+        self._runner = None
+        self._waits = deque(maxlen=1000)
+        self.received = 0
+        self.rejected = 0
+        self.overflowed = 0
+        self.processed = 0
+        self.failed = 0
+
+    # ---------- Жизненный цикл ----------
+    async def start(self, register=True):
+        """Запускает HTTP-сервер и обработчики; register - сообщить адрес Telegram"""
+        app = web.Application()
+        app.router.add_post(self.path, self._handle)
+        self._runner = web.AppRunner(app, access_log=None)
+        await self._runner.setup()
+        await web.TCPSite(self._runner, self.host, self.port).start()
+        self._tasks = [asyncio.create_task(self._worker()) for _ in range(self.workers)]
+        logger.info(f"Webhook слушает {self.host}:{self.port}{self.path}")
+
+        if register:
+            await self.bot.set_webhook(
+                self.url,
+                secret_token=self.secret,
+                allowed_updates=self.allowed_updates,
+                max_connections=min(100, self.workers)
+            )
+            logger.info(f"Webhook зарегистрирован: {self.url}")
+
+    async def stop(self, timeout=10):
+        """Перестает принимать обновления и дорабатывает уже принятые"""
+        if self._runner is not None:
+            await self._runner.cleanup()
+            self._runner = None
+        try:
+            await asyncio.wait_for(self._queue.join(), timeout)
+        except asyncio.TimeoutError:
+            logger.warning(f"Webhook: не обработано обновлений: {self._queue.qsize()}")
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+
+    def stats(self):
+        """Очередь, время ожидания в ней (сек.) и счетчики"""
+        waits = sorted(self._waits)
+        return {
+            "depth": self._queue.qsize(),
+            "wait_avg": sum(waits) / len(waits) if waits else 0.0,
+            "wait_p95": waits[int(len(waits) * 0.95)] if waits else 0.0,
+            "received": self.received,
+            "rejected": self.rejected,
+            "overflowed": self.overflowed,
+            "processed": self.processed,
+            "failed": self.failed,
+        }
+
+    # ---------- Прием и обработка ----------
+    async def _handle(self, request):
+        token = request.headers.get(SECRET_HEADER)
+        if token is None or not hmac.compare_digest(
+            token.encode("utf-8", "surrogateescape"), self._secret_bytes
+        ):
+            self.rejected += 1
+            return web.Response(status=401)
+
+        try:
+            update = Update.model_validate(await request.json(), context={"bot": self.bot})
+        except Exception as e:
+            logger.warning(f"Webhook: некорректное обновление: {e}")
+            self.rejected += 1
+            return web.Response(status=400)
+
+        try:
+            self._queue.put_nowait((time.monotonic(), update))
+        except asyncio.QueueFull:
+            self.overflowed += 1
+            return web.Response(status=503)
+        self.received += 1
+        return web.Response()
+
+    async def _worker(self):
+        while True:
+            enqueued, update = await self._queue.get()
+            self._waits.append(time.monotonic() - enqueued)
+            try:
+                await self.dp.feed_update(self.bot, update)
+                self.processed += 1
+            except Exception as e:
+                self.failed += 1
+                logger.error(f"Webhook: ошибка обработки обновления {update.update_id}: {e}")
+            finally:
+                self._queue.task_done()
@@ -0,0 +1,182 @@
+"""Многопроцессный режим бота.
+
+Процесс-распределитель получает обновления (polling или webhook, как в
+config.MODE) и раскладывает их по N процессам-обработчикам по id пользователя.
+Каждый обработчик - полноценный бот из main.py со своим пулом соединений к
+общей SQLite (WAL), кэшем профилей и состояниями диалогов. Так как
+пользователь всегда попадает в один и тот же процесс, кэши и состояния не
+расходятся между процессами, а его обновления обрабатываются по порядку.
+
+Запуск:
+    python workers.py
+"""
+import asyncio
+import logging
+import multiprocessing
+import queue
+import signal
+from collections import deque
+
+import config
+
+logger = logging.getLogger(__name__)
+
+
+def shard_of(user_id, shards):
+    """Номер процесса для пользователя (id Telegram - целые числа, распределены
+    равномерно, поэтому достаточно остатка от деления)"""
+    return user_id % shards
+
+
+def update_user_id(update):
+    """id пользователя, от которого пришло обновление"""
+    event = update.event
+    user = getattr(event, "from_user", None)
+    if user is not None:
+        return user.id
+    chat = getattr(event, "chat", None)
+    if chat is not None:
+        return chat.id
+    # Обновления без пользователя порядка не требуют
+    return update.update_id
+
+
+# ==================== РАСПРЕДЕЛИТЕЛЬ ====================
+class ShardRouter:
+    """Внешний middleware диспетчера распределителя: вместо обработки
+    отправляет обновление в очередь процесса, отвечающего за пользователя"""
+
+    def __init__(self, queues):
+        self.queues = queues
+        self.routed = [0] * len(queues)
+
+    async def __call__(self, handler, update, data):
+        shard = shard_of(update_user_id(update), len(self.queues))
+        raw = update.model_dump_json(exclude_none=True)
+        try:
+            self.queues[shard].put_nowait(raw)
+        except queue.Full:
+            # Обработчик не успевает - ждём места, не блокируя event loop.
+            # Обновления отправляются по одному, поэтому порядок сохраняется.
+            await asyncio.get_running_loop().run_in_executor(None, self.queues[shard].put, raw)
+        self.routed[shard] += 1
+
+
+async def run_front(queues):
+    import main
+    from aiogram import Dispatcher
+
+    main.init()
+    # Миграции применяются один раз здесь, до того как обработчики откроют БД
+    await main.db.init_tables()
+    await main.db.close()
+
+    router = ShardRouter(queues)
+    front = Dispatcher()
+    front.update.outer_middleware(router)
+    try:
+        if config.MODE == "webhook":
+            # Один обработчик webhook - распределение должно сохранять порядок
+            await main.run_webhook(front, workers=1)
+        else:
+            await main.run_polling(front, handle_as_tasks=False)
+    finally:
+        logger.info(f"Распределено обновлений по процессам: {router.routed}")
+
+
+# ==================== ОБРАБОТЧИК ====================
+class UserLanes:
+    """Обработка обновлений: разные пользователи - параллельно, обновления
+    одного пользователя - строго по очереди"""
+
+    def __init__(self, process):
+        self.process = process
+        self._lanes = {}  # user_id -> deque ожидающих обновлений
+        self._idle = asyncio.Event()
+        self._idle.set()
+
+    def submit(self, user_id, update):
+        lane = self._lanes.get(user_id)
+        if lane is not None:
+            lane.append(update)
+            return
+        self._lanes[user_id] = deque([update])
+        self._idle.clear()
+        asyncio.create_task(self._drain(user_id))
+
+    async def _drain(self, user_id):
+        lane = self._lanes[user_id]
+        while lane:
+            try:
+                await self.process(lane[0])
+            except Exception as e:
+                logger.error(f"Ошибка обработки обновления: {e}", exc_info=True)
+            lane.popleft()
+        del self._lanes[user_id]
+        if not self._lanes:
+            self._idle.set()
+
+    async def wait_idle(self):
+        await self._idle.wait()
+
+
+async def run_worker(index, shards, updates):
+    import main
+    from aiogram.types import Update
+
+    main.init()
+    # Общий лимит Telegram делится между процессами
+    main.sender.set_global_rate(main.sender.global_rate / shards)
+    # Временные сообщения своих чатов удаляет только этот процесс
+    main.deleter.owns = lambda chat_id: shard_of(chat_id, shards) == index
+    lanes = UserLanes(lambda update: main.dp.feed_update(main.bot, update))
+    loop = asyncio.get_running_loop()
+
+    # Каждый обработчик отдает свои метрики на своем порту: METRICS_PORT + номер
+    await main.startup(metrics_port=config.METRICS_PORT + index + 1 if config.METRICS_PORT else None)
+    logger.info(f"Обработчик {index + 1}/{shards} запущен")
+    try:
+        while True:
+            raw = await loop.run_in_executor(None, updates.get)
+            if raw is None:
+                break
+            update = Update.model_validate_json(raw, context={"bot": main.bot})
+            lanes.submit(update_user_id(update), update)
+        await lanes.wait_idle()
+    finally:
+        await main.shutdown()
+        await main.bot.session.close()
+        logger.info(f"Обработчик {index + 1}/{shards} остановлен")
+
+
+def worker_process(index, shards, updates):
+    # Остановка - по сигналу распределителя (None в очереди), а не по Ctrl+C
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    asyncio.run(run_worker(index, shards, updates))
+
+
+# ==================== ЗАПУСК ====================
+def run(shards=config.WORKER_PROCESSES, queue_size=config.WORKER_QUEUE_SIZE):
+    context = multiprocessing.get_context("spawn")
+    queues = [context.Queue(maxsize=queue_size) for _ in range(shards)]
+    processes = [
+        context.Process(target=worker_process, args=(index, shards, queues[index]),
+                        name=f"worker-{index + 1}")
+        for index in range(shards)
+    ]
+    for process in processes:
+        process.start()
+
+    try:
+        asyncio.run(run_front(queues))
+    except KeyboardInterrupt:
+        pass
+    finally:
+        for updates in queues:
+            updates.put(None)
+        for process in processes:
+            process.join()
+
+
+if __name__ == "__main__":
+    run()